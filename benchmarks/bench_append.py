@@ -0,0 +1,65 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Benchmark: Ingester.append() with and without the escaping caches,
+and the pre-compiled writer of Ingester.schema()
+
+Usage: python benchmarks/bench_append.py"""
+
+import time
+from universal_tsdb import Client, Ingester, backends
+
+POINTS = 200000
+HOSTS = ['server{:03d}'.format(i) for i in range(100)]
+
+
+def bench(protocol):
+    """Return the mean append duration (in µs)"""
+    serie = Ingester(Client(protocol, 'http://localhost', database='bench'))
+    start = time.perf_counter()
+    for i in range(POINTS):
+        serie.append(1585934895000 + i, measurement='cpu',
+                     tags={'host': HOSTS[i % len(HOSTS)], 'region': 'eu-west', 'rack': 'r 12'},
+                     usage_user=0.5, usage_system=1.5, running=3, status='ok')
+    duration = time.perf_counter() - start
+    serie.purge()
+    return duration / POINTS * 1e6
+
+
+def bench_schema(protocol):
+    """Return the mean duration (in µs) of a schema writer call"""
+    serie = Ingester(Client(protocol, 'http://localhost', database='bench'))
+    writer = serie.schema('cpu', ('host', 'region', 'rack'),
+                          {'usage_user': float, 'usage_system': float, 'running': int,
+                           'status': str})
+    start = time.perf_counter()
+    for i in range(POINTS):
+        writer(1585934895000 + i, (HOSTS[i % len(HOSTS)], 'eu-west', 'r 12'), 0.5, 1.5, 3, 'ok')
+    duration = time.perf_counter() - start
+    serie.purge()
+    return duration / POINTS * 1e6
+
+
+def main():
+    cached = (backends.InfluxBackend.escape, backends.Warp10Backend.escape,
+              backends._series_statement)
+    print("{:>10} {:>16} {:>16} {:>16} {:>8}".format("protocol", "cached (µs/pt)",
+                                                     "uncached (µs/pt)", "schema (µs/pt)",
+                                                     "speedup"))
+    for protocol in ('influx', 'warp10'):
+        # best of 3 runs (a single run is noisy), compared in the speedup column
+        with_cache = min(bench(protocol) for _ in range(3))
+        escape_influx, escape_warp10, backends._series_statement = (
+            func.__wrapped__ for func in cached)
+        backends.InfluxBackend.escape = staticmethod(escape_influx)
+        backends.Warp10Backend.escape = staticmethod(escape_warp10)
+        without_cache = bench(protocol)
+        backends.InfluxBackend.escape = staticmethod(cached[0])
+        backends.Warp10Backend.escape = staticmethod(cached[1])
+        backends._series_statement = cached[2]
+        with_schema = min(bench_schema(protocol) for _ in range(3))
+        print("{:>10} {:>16.2f} {:>16.2f} {:>16.2f} {:>7.1f}x".format(
+            protocol, with_cache, without_cache, with_schema, with_cache / with_schema))
+    print(Ingester.cache_info())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Benchmark: append cost versus batch size
+
+The per-point cost of Ingester.append() must stay flat as the batch grows.
+Usage: python benchmarks/bench_buffer.py"""
+
+import time
+from universal_tsdb import Client, Ingester
+
+BATCH_SIZES = (1000, 5000, 20000, 100000, 500000)
+REFERENCE_MAX_SIZE = 20000 # quadratic: larger batches take minutes
+
+
+class _StringIngester(Ingester):
+    """Reference implementation, concatenating the payload into a single string"""
+
+    def __init__(self, client):
+        super().__init__(client)
+        self._payload = ''
+
+    def _append(self, timestamp, series, measurement, fields):
+        self._payload += "{} value={} {}\n".format(series, fields['value'], timestamp * 1000000)
+        self._length += 1
+
+
+def bench(factory, size):
+    """Return the mean append duration (in µs) for a batch of `size` points"""
+    serie = factory(Client('influx', 'http://localhost:8086', database='bench'))
+    start = time.perf_counter()
+    for i in range(size):
+        serie.append(1585934895000 + i, tags={'host': 'server01'}, measurement='cpu',
+                     value=float(i))
+    duration = time.perf_counter() - start
+    serie.purge()
+    return duration / size * 1e6
+
+
+def main():
+    print("{:>10} {:>16} {:>16}".format("batch", "buffer (µs/pt)", "str += (µs/pt)"))
+    for size in BATCH_SIZES:
+        reference = '-'
+        if size <= REFERENCE_MAX_SIZE:
+            reference = "{:.2f}".format(bench(_StringIngester, size))
+        print("{:>10} {:>16.2f} {:>16}".format(size, bench(Ingester, size), reference))
+
+
+if __name__ == '__main__':
+    main()
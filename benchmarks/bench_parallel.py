@@ -0,0 +1,55 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Benchmark: Ingester.ingest_parallel() scaling with the number of worker processes,
+sending to a local stub server (see suite.py)
+
+Usage: python benchmarks/bench_parallel.py [PROCESSES...]"""
+
+import os
+import sys
+import time
+from suite import StubServer, points
+from universal_tsdb import Client, Ingester
+
+POINTS = 200000
+PARTITIONS = 32
+BATCH = 5000
+
+
+def records(count):
+    """Return `count` records, as read from a JSON lines file"""
+    return [{'timestamp': timestamp, 'measurement': 'bench', 'tags': tags, 'fields': fields}
+            for timestamp, tags, fields in points(count, 5, 1000, 'num')]
+
+
+def bench(url, partitions, processes):
+    """Return the throughput (points/s) of ingest() (processes=0) or ingest_parallel()"""
+    serie = Ingester(Client('influx', url, database='bench'), batch=BATCH)
+    start = time.perf_counter()
+    if processes:
+        serie.ingest_parallel(partitions, processes=processes)
+    else:
+        for partition in partitions:
+            serie.ingest(partition)
+    serie.commit()
+    return sum(map(len, partitions)) / (time.perf_counter() - start)
+
+
+def main(argv):
+    counts = [int(arg) for arg in argv] or sorted({1, 2, 4, os.cpu_count()})
+    data = records(POINTS)
+    size = POINTS // PARTITIONS
+    partitions = [data[i:i + size] for i in range(0, POINTS, size)]
+    server = StubServer()
+    try:
+        single = bench(server.url, partitions, 0)
+        print("{:>10} {:>12} {:>8}".format("processes", "points/s", "speedup"))
+        print("{:>10} {:>12.0f} {:>8}".format("ingest()", single, ""))
+        for processes in counts:
+            rate = bench(server.url, partitions, processes)
+            print("{:>10} {:>12.0f} {:>7.1f}x".format(processes, rate, rate / single))
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
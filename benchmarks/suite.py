@@ -0,0 +1,223 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Benchmark suite: throughput of the ingest path, with a regression check
+
+Scenarios cover Ingester.append() (encoding only), the backend escaping and
+commit() against a local stub HTTP server, for both protocols, varying the
+number of fields, the tag cardinality, string or numeric values and the batch size.
+For each scenario: points/s, bytes/s, peak memory (tracemalloc) and memory blocks
+retained per point (the net change of sys.getallocatedblocks(), not the number
+of allocations: blocks allocated then freed during the run are not counted).
+
+Usage:
+    python benchmarks/suite.py [--quick] [--output results.json]
+    python benchmarks/suite.py --compare baseline.json [--threshold 10]
+
+With --compare, exits with status 1 when the throughput of a scenario is more
+than --threshold % below the baseline."""
+
+import argparse
+import http.server
+import itertools
+import json
+import platform
+import socketserver
+import sys
+import threading
+import time
+import tracemalloc
+from universal_tsdb import Client, Ingester
+
+PROTOCOLS = ('influx', 'warp10')
+DEFAULT_POINTS = 20000
+QUICK_POINTS = 2000
+DEFAULT_THRESHOLD = 10 # in %
+
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    """Read the request body, answer 204"""
+
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def do_POST(self): # pylint: disable=invalid-name
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Threaded HTTP server (http.server.ThreadingHTTPServer is Python 3.7+)"""
+
+    daemon_threads = True
+
+
+class StubServer:
+    """Local stand-in HTTP backend"""
+
+    def __init__(self):
+        self._server = _ThreadingServer(('127.0.0.1', 0), _StubHandler)
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def points(count, fields, cardinality, kind):
+    """Return `count` points: (timestamp, tags, fields)"""
+    tags = [{'host': 'server{:05d}'.format(i), 'region': 'eu-west', 'rack': 'r {}'.format(i % 7)}
+            for i in range(cardinality)]
+    if kind == 'str':
+        values = [{'field{}'.format(j): 'value {}'.format((i + j) % 50) for j in range(fields)}
+                  for i in range(50)]
+    else:
+        values = [{'field{}'.format(j): (float(i + j) if j % 2 else i + j) for j in range(fields)}
+                  for i in range(50)]
+    return [(1585934895000 + i, tags[i % cardinality], values[i % 50]) for i in range(count)]
+
+
+def _append(client, data, batch):
+    serie = Ingester(client, batch=batch)
+    blocks = sys.getallocatedblocks()
+    for timestamp, tags, fields in data:
+        serie.append(timestamp, tags=tags, measurement='bench', **fields)
+    blocks = sys.getallocatedblocks() - blocks
+    size = serie.size()
+    serie.purge()
+    return size, blocks
+
+
+def _commit(client, data, batch):
+    serie = Ingester(client, batch=batch)
+    blocks = sys.getallocatedblocks()
+    for timestamp, tags, fields in data:
+        serie.append(timestamp, tags=tags, measurement='bench', **fields)
+    serie.commit()
+    blocks = sys.getallocatedblocks() - blocks
+    return serie._report['bytes'], blocks # pylint: disable=protected-access
+
+
+def _escape(client, data, batch): # pylint: disable=unused-argument
+    # the escaping function itself: the names repeat, its cache would only measure hits
+    escape = getattr(client.backend.escape, '__wrapped__', client.backend.escape)
+    size = 0
+    blocks = sys.getallocatedblocks()
+    for _, tags, _ in data:
+        for key, val in tags.items():
+            size += len(escape(key)) + len(escape(val))
+    return size, sys.getallocatedblocks() - blocks
+
+
+OPERATIONS = {'append': _append, 'commit': _commit, 'escape': _escape}
+
+
+def scenarios(quick=False):
+    """Return the scenarios: dicts of operation, protocol, fields, cardinality, kind, batch"""
+    matrix = []
+    for protocol, fields, cardinality, kind in itertools.product(
+            PROTOCOLS, (1, 10), (1, 1000), ('num', 'str')):
+        matrix.append({'operation': 'append', 'protocol': protocol, 'fields': fields,
+                       'cardinality': cardinality, 'kind': kind, 'batch': 0})
+    for protocol, batch in itertools.product(PROTOCOLS, (1000, 10000)):
+        matrix.append({'operation': 'commit', 'protocol': protocol, 'fields': 5,
+                       'cardinality': 100, 'kind': 'num', 'batch': batch})
+    for protocol, cardinality in itertools.product(PROTOCOLS, (100, 100000)):
+        matrix.append({'operation': 'escape', 'protocol': protocol, 'fields': 1,
+                       'cardinality': cardinality, 'kind': 'str', 'batch': 0})
+    if quick:
+        matrix = [scenario for scenario in matrix
+                  if scenario['fields'] < 10 and scenario['cardinality'] < 100000]
+    for scenario in matrix:
+        scenario['name'] = "{operation}-{protocol}-f{fields}-t{cardinality}-{kind}-b{batch}" \
+            .format(**scenario)
+    return matrix
+
+
+def run(scenario, count, url, repeat=3):
+    """Run a scenario, return its results (best of `repeat` runs)"""
+    client = Client(scenario['protocol'], url, database='bench')
+    data = points(count, scenario['fields'], scenario['cardinality'], scenario['kind'])
+    operation = OPERATIONS[scenario['operation']]
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size, blocks = operation(client, data, scenario['batch'])
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    tracemalloc.start()
+    operation(client, data, scenario['batch'])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'points_per_s': count / best, 'bytes_per_s': size / best, 'peak_memory': peak,
+            'retained_blocks_per_point': blocks / count}
+
+
+def compare(results, baseline, threshold):
+    """Print the throughput changes, return the names of the regressed scenarios"""
+    regressions = []
+    print("{:<40} {:>14} {:>14} {:>8}".format("scenario", "baseline (pt/s)", "current (pt/s)",
+                                             "change"))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['points_per_s']
+        change = (result['points_per_s'] - before) / before * 100
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print("{:<40} {:>14.0f} {:>14.0f} {:>+7.1f}%{}".format(
+            name, before, result['points_per_s'], change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quick', action='store_true', help="fewer points and scenarios")
+    parser.add_argument('--points', type=int, help="points per scenario")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scenario (best kept)")
+    parser.add_argument('--filter', default='', help="only run scenarios containing this string")
+    parser.add_argument('--output', help="save the results to a JSON file")
+    parser.add_argument('--compare', help="baseline JSON file")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="maximum throughput loss, in %% (default: %(default)s)")
+    args = parser.parse_args(argv)
+    count = args.points or (QUICK_POINTS if args.quick else DEFAULT_POINTS)
+
+    server = StubServer()
+    results = {}
+    print("{:<40} {:>12} {:>12} {:>12} {:>10}".format(
+        "scenario", "points/s", "MB/s", "peak (KiB)", "retained/pt"))
+    try:
+        for scenario in scenarios(args.quick):
+            if args.filter not in scenario['name']:
+                continue
+            result = run(scenario, count, server.url, args.repeat)
+            results[scenario['name']] = result
+            print("{:<40} {:>12.0f} {:>12.2f} {:>12.0f} {:>10.2f}".format(
+                scenario['name'], result['points_per_s'], result['bytes_per_s'] / 1e6,
+                result['peak_memory'] / 1024, result['retained_blocks_per_point']))
+    finally:
+        server.close()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'python': platform.python_version(), 'points': count,
+                       'results': results}, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline)['results'], args.threshold)
+        if regressions:
+            print("{} scenario(s) regressed by more than {}%".format(len(regressions),
+                                                                    args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
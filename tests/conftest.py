@@ -0,0 +1,80 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab
+# pylint: disable=missing-function-docstring
+
+"""Shared fixtures"""
+
+import http.server
+import socketserver
+import threading
+import urllib.parse
+import pytest
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Record requests, answer with the server status"""
+
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def do_POST(self): # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status = self.server.status
+        if callable(status):
+            status = status(body)
+        with self.server.lock:
+            self.server.requests.append({'path': self.path, 'headers': dict(self.headers),
+                                         'body': body, 'client': self.client_address,
+                                         'status': status})
+        self.send_response(status)
+        for key, val in self.server.headers.items():
+            self.send_header(key, val)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self): # pylint: disable=invalid-name
+        path = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(path.query))
+        content = self.server.content
+        if callable(content):
+            content = content(params)
+        with self.server.lock:
+            self.server.requests.append({'path': path.path, 'params': params,
+                                         'headers': dict(self.headers),
+                                         'client': self.client_address})
+        self.send_response(200 if self.server.status == 204 else self.server.status)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Threaded HTTP server (http.server.ThreadingHTTPServer is Python 3.7+)"""
+
+    daemon_threads = True
+
+    def __init__(self, handler):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.status = 204
+        self.headers = {}
+        self.content = b''
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+@pytest.fixture
+def http_server():
+    """Local stand-in HTTP backend.
+    server.requests lists the received requests, server.status is the response status
+    (or a function of the request body returning the status), server.headers are
+    additional response headers, server.content is the body of GET responses
+    (or a function of the query parameters returning the body)"""
+    server = _Server(_Handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05},
+                              daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
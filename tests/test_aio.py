@@ -0,0 +1,170 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab
+# pylint: disable=missing-function-docstring,redefined-outer-name,protected-access
+
+"""Test for asyncio client and ingester"""
+
+import asyncio
+import pytest
+from universal_tsdb import AsyncClient, AsyncIngester, MaxErrorsException, RetryPolicy
+
+pytest.importorskip('aiohttp')
+
+
+def run(coroutine):
+    # asyncio.run() is Python 3.7+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class TestAsync:
+    """A set of tests with the asyncio ingester, against a local HTTP server"""
+
+    def test_commit(self, http_server):
+        async def main():
+            backend = AsyncClient('influx', http_server.url, database='metrics',
+                                  backend_username='user', backend_password='passwd')
+            serie = AsyncIngester(backend)
+            await serie.append(1585934985000, measurement='mes', tags={'tag1': 'tval1'}, name=42)
+            await serie.append_columns([1585934986000], measurement='mes', name=[43])
+            assert serie.payload() == ("mes,tag1=tval1 name=42i 1585934985000000000\n"
+                                       "mes name=43i 1585934986000000000\n")
+            await serie.commit()
+            await backend.close()
+        run(main())
+        assert len(http_server.requests) == 1
+        assert http_server.requests[0]['path'] == '/write?db=metrics&u=user&p=passwd'
+        assert http_server.requests[0]['body'] == (b"mes,tag1=tval1 name=42i 1585934985000000000\n"
+                                                   b"mes name=43i 1585934986000000000\n")
+
+    def test_token(self, http_server):
+        async def main():
+            backend = AsyncClient('warp10', http_server.url + '/api/v0', token='ABCDEF0123456789')
+            async with AsyncIngester(backend) as serie:
+                await serie.append(1585934895000, name='value')
+            await backend.close()
+        run(main())
+        assert http_server.requests[0]['path'] == '/api/v0/update'
+        assert http_server.requests[0]['headers']['X-Warp10-Token'] == 'ABCDEF0123456789'
+        assert http_server.requests[0]['body'] == b"1585934895000000// name{} 'value'\n"
+
+    def test_max_bytes(self, http_server):
+        async def main():
+            backend = AsyncClient('influx', http_server.url, database='metrics')
+            async with AsyncIngester(backend, max_bytes=100) as serie:
+                for i in range(10):
+                    await serie.append(1585934985000+i, name=i)
+            await backend.close()
+            return serie
+        serie = run(main())
+        assert sorted(len(req['body']) for req in http_server.requests) == [33, 99, 99, 99]
+        assert serie._report['trigger_bytes'] == 3
+
+    def test_schema(self, http_server):
+        async def main():
+            backend = AsyncClient('influx', http_server.url, database='metrics')
+            async with AsyncIngester(backend, batch=2) as serie:
+                writer = serie.schema('mes', ('host',), {'name': int})
+                for i in range(3):
+                    await writer(1585934985000 + i * 1000, ('a',), i)
+            await backend.close()
+        run(main())
+        assert sorted(req['body'] for req in http_server.requests) == [
+            b"mes,host=a name=0i 1585934985000000000\nmes,host=a name=1i 1585934986000000000\n",
+            b"mes,host=a name=2i 1585934987000000000\n"]
+
+    def test_ingest(self, http_server, tmp_path):
+        path = tmp_path / 'points.txt'
+        path.write_text("mes name=0i 1585934985000000000\nmes name=1i 1585934986000000000\n"
+                        "mes name=2i 1585934987000000000\n")
+
+        async def records():
+            for i in range(3, 5):
+                yield {'timestamp': 1585934988000 + i, 'measurement': 'mes', 'fields': {'name': i}}
+
+        async def main():
+            backend = AsyncClient('influx', http_server.url, database='metrics')
+            async with AsyncIngester(backend, batch=2) as serie:
+                await serie.ingest_file(str(path), file_format='line')
+                await serie.ingest(records())
+            await backend.close()
+            return serie
+        serie = run(main())
+        assert len(http_server.requests) == 3
+        assert b"".join(sorted(req['body'] for req in http_server.requests)).count(b"\n") == 5
+        assert serie.stats()['series'] == 5
+
+    def test_unsupported(self, http_server):
+        backend = AsyncClient('influx', http_server.url, database='metrics')
+        serie = AsyncIngester(backend)
+        with pytest.raises(TypeError):
+            serie.ingest_parallel([[{'fields': {'name': 0}}]], processes=1)
+        with pytest.raises(TypeError):
+            with serie:
+                pass
+        assert serie.length() == 0
+
+    def test_hooks(self, http_server):
+        calls = []
+
+        async def main():
+            backend = AsyncClient('influx', http_server.url, database='metrics')
+            async with AsyncIngester(backend, on_append=calls.append,
+                                     on_commit_end=lambda *args: calls.append(args[0])) as serie:
+                await serie.append(1585934985000, name=1)
+                await serie.append_columns([1585934986000], name=[2])
+            await backend.close()
+            return serie
+        serie = run(main())
+        assert calls == [1, 1, 'success']
+        assert serie.stats()['requests'] == 1
+
+    @pytest.mark.parametrize('max_in_flight', [1, 4])
+    def test_batch(self, max_in_flight, http_server):
+        async def main():
+            backend = AsyncClient('influx', http_server.url, database='metrics',
+                                  max_in_flight=max_in_flight)
+            async with AsyncIngester(backend, batch=10) as serie:
+                for i in range(95):
+                    await serie.append(1585934985000+i, name=i)
+                    assert serie.queue_depth() <= max_in_flight
+            await backend.close()
+            return serie
+        serie = run(main())
+        assert len(http_server.requests) == 10
+        assert serie._report['successes'] == 10
+        assert sum(len(req['body'].splitlines()) for req in http_server.requests) == 95
+        # connections are reused
+        assert len({req['client'] for req in http_server.requests}) <= max_in_flight
+
+    def test_max_errors(self, http_server):
+        http_server.status = 500
+        async def main():
+            backend = AsyncClient('warp10', http_server.url + '/api/v0')
+            serie = AsyncIngester(backend, batch=1)
+            await serie.append(1585934985000, name=1)
+            with pytest.raises(MaxErrorsException):
+                await serie.commit()
+            await backend.close()
+            return serie
+        serie = run(main())
+        assert len(http_server.requests) == AsyncIngester.MAX_ERRORS
+        assert serie._report['dropped'] == 1
+
+    def test_retry(self, http_server):
+        statuses = [503]
+        http_server.status = lambda body: statuses.pop(0) if statuses else 204
+        http_server.headers['Retry-After'] = '0'
+        async def main():
+            backend = AsyncClient('influx', http_server.url, database='metrics',
+                                  retry=RetryPolicy(backoff_base=0.01))
+            async with AsyncIngester(backend) as serie:
+                await serie.append(1585934985000, name=1)
+            await backend.close()
+            return serie
+        serie = run(main())
+        assert [req['status'] for req in http_server.requests] == [503, 204]
+        assert serie._report['retries'] == 1
+        assert serie._report['successes'] == 1
@@ -1,5 +1,6 @@
 # vim: ai:ts=4:sw=4:sts=4:expandtab
 # pylint: disable=line-too-long,missing-function-docstring,no-self-use,too-few-public-methods,unused-argument,redefined-outer-name
+# pylint: disable=protected-access,too-many-lines
 
 """Test for metrics"""
 
@@ -8,10 +9,19 @@
 #TODO(gmasse): test unsupported backend
 
 
+import json
 import logging
+import os
+import threading
+import time
+import tracemalloc
+import weakref
+import zlib
 import requests
 import pytest
-from universal_tsdb import Client, Ingester, MaxErrorsException
+from universal_tsdb import Aggregator, Backend, Client, Ingester, MaxErrorsException, MultiIngester, QueryCache, QueryException, QueueFullException, RetryPolicy, Spool
+from universal_tsdb import backends, query, retry, trace
+from universal_tsdb.buffer import split_lines
 
 @pytest.fixture
 def mock_send_ok(monkeypatch):
@@ -42,6 +52,24 @@ def mock_send_ko(monkeypatch):
     monkeypatch.setattr(requests.sessions.Session, 'send', mock_send)
 
 
+@pytest.fixture
+def mock_send_capture(monkeypatch):
+    """Session.send() mocked to return HTTP 200 and record request bodies"""
+    bodies = []
+
+    def mock_send(self, request, **kwargs):
+        # pylint: disable=unused-argument
+        bodies.append(request.body)
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        response.url = 'http://127.0.0.1'
+        return response
+
+    monkeypatch.setattr(requests.sessions.Session, 'send', mock_send)
+    return bodies
+
+
 class TestGeneric:
     """A set of generic tests (no backend dependant)"""
 
@@ -85,6 +113,1443 @@ class TestGeneric:
             serie.append(timestamp=1585934987000, name=3)
         assert serie.length() == 3
 
+    def test_payload_buffer(self, mock_send_capture):
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend)
+        serie.append(1585934985000, measurement='mes', name='vâlue')
+        serie.append(1585934986000, measurement='mes', name=42)
+        expected = 'mes name="vâlue" 1585934985000000000\nmes name=42i 1585934986000000000\n'
+        assert serie.payload() == expected
+        assert serie.size() == len(expected.encode('utf-8'))
+        serie.commit()
+        assert mock_send_capture == [expected.encode('utf-8')]
+        assert serie.size() == 0
+        assert serie.payload() == ''
+
+    @pytest.mark.parametrize('protocol', ['influx', 'warp10'])
+    @pytest.mark.parametrize('batch_size', [0, 3, 4])
+    def test_append_columns(self, protocol, batch_size, mock_send_capture):
+        backend = Client(protocol, 'http://localhost', database='metrics')
+        columns = {
+            'timestamps': [1585934985000+1000*i for i in range(9)],
+            'fstr': ["va lue{}".format(i) for i in range(9)],
+            'fint': list(range(9)),
+            'ffloat': [i/2 for i in range(9)],
+            'fbool': [i%2 == 0 for i in range(9)],
+            'fmixed': [1, 'one', 1.0]*3,
+        }
+        fields = {key: val for key, val in columns.items() if key != 'timestamps'}
+        serie = Ingester(backend, batch=batch_size)
+        for i, timestamp in enumerate(columns['timestamps']):
+            serie.append(timestamp, tags={'tag 1': 'tval'}, measurement='mes',
+                         **{key: val[i] for key, val in fields.items()})
+        expected = [body.decode() for body in mock_send_capture] + [serie.payload()]
+        serie.purge()
+        mock_send_capture.clear()
+        serie.append_columns(columns['timestamps'], tags={'tag 1': 'tval'}, measurement='mes',
+                             **fields)
+        assert [body.decode() for body in mock_send_capture] + [serie.payload()] == expected
+        serie.purge()
+
+    def test_append_columns_numpy(self):
+        numpy = pytest.importorskip('numpy')
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend)
+        serie.append_columns(numpy.array([1585934985000, 1585934986000]), measurement='mes',
+                             fint=numpy.array([1, 2]), ffloat=numpy.array([0.1, 2.0]))
+        assert serie.payload() == ("mes fint=1i,ffloat=0.1 1585934985000000000\n"
+                                   "mes fint=2i,ffloat=2.0 1585934986000000000\n")
+
+    def test_append_columns_invalid(self):
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend)
+        with pytest.raises(ValueError):
+            serie.append_columns([1585934985000, 1585934986000], name=[1])
+        with pytest.raises(ValueError):
+            serie.append_columns([1585934985000.0], name=[1])
+        with pytest.raises(ValueError):
+            serie.append_columns([1585934985000], name=[None])
+        assert serie.length() == 0
+
+    @pytest.mark.parametrize('protocol, expected', [
+        ('influx', "mes,t=1 a=1i 1585934985000000000\nmes,t=True a=1i 1585934985000000000\n"
+                   "mes,t=1.0 a=1i 1585934985000000000\n"),
+        ('warp10', "1585934985000000// mes.a{t=1} 1\n1585934985000000// mes.a{t=True} 1\n"
+                   "1585934985000000// mes.a{t=1.0} 1\n")
+    ])
+    def test_series_cache(self, protocol, expected):
+        backend = Client(protocol, 'http://localhost', database='metrics')
+        serie = Ingester(backend)
+        hits = Ingester.cache_info()['series'].hits
+        for value in (1, True, 1.0, 1):
+            serie.append(1585934985000, tags={'t': value}, measurement='mes', a=1)
+        assert serie.payload() == expected + expected.split('\n')[0] + '\n'
+        assert Ingester.cache_info()['series'].hits >= hits + 1
+
+    @pytest.mark.parametrize('compression, wbits', [('gzip', 31), ('deflate', 15)])
+    def test_compression(self, compression, wbits, http_server):
+        backend = Client('influx', http_server.url, database='metrics', compression=compression,
+                         compression_level=9)
+        serie = Ingester(backend, batch=5000)
+        for i in range(6000):
+            serie.append(1585934985000+i, measurement='mes', tags={'host': 'server01'}, name=i)
+        # compressed as points are appended
+        assert serie._buffer.chunks()
+        assert serie.payload().startswith("mes,host=server01 name=5000i 1585934990000000000\n")
+        serie.commit()
+        assert len(http_server.requests) == 2
+        raw = b''
+        for request in http_server.requests:
+            assert request['headers']['Content-Encoding'] == compression
+            raw += zlib.decompress(request['body'], wbits)
+        assert raw.splitlines()[-1] == b"mes,host=server01 name=5999i 1585934990999000000"
+        assert serie._report['bytes'] == len(raw)
+        assert serie._report['bytes_sent'] == sum(len(req['body']) for req in http_server.requests)
+        assert serie._report['bytes_sent'] * 5 < serie._report['bytes']
+        assert serie._report['compression_time'] > 0
+
+    def test_compression_prepare_request(self):
+        backend = Client('warp10', 'http://localhost/api/v0', compression='gzip')
+        request = backend.prepare_request("1585934895000000// name{} 'value'\n")
+        assert request.headers['Content-Encoding'] == 'gzip'
+        assert zlib.decompress(request.body, 31) == b"1585934895000000// name{} 'value'\n"
+        with pytest.raises(ValueError):
+            Client('warp10', 'http://localhost/api/v0', compression='lzma')
+
+class CSVBackend(Backend): # pylint: disable=abstract-method
+    """Minimal third-party backend"""
+
+    name = 'csv'
+
+    @classmethod
+    def statement(cls, measurement, tag_keys, tag_values):
+        return ';'.join([measurement or 'data'] + list(tag_values))
+
+    def encode(self, timestamp, series, measurement, fields):
+        return ''.join("{},{},{},{}\n".format(timestamp, series, key, self.format_value(key, val))
+                       for key, val in fields.items()), len(fields)
+
+    def request(self, payload):
+        return requests.Request(method='POST', url=self.url + '/csv', data=payload)
+
+
+class TestBackends:
+    """Backend registry and plugins"""
+
+    def test_registry(self):
+        assert backends.get_backend('influx') is backends.InfluxBackend
+        assert backends.get_backend('warp10') is backends.Warp10Backend
+        assert backends.get_backend(CSVBackend) is CSVBackend
+        with pytest.raises(ValueError):
+            backends.get_backend('unknown')
+        with pytest.raises(ValueError):
+            Client('unknown', 'http://localhost')
+        with pytest.raises(ValueError):
+            Client('influx', 'http://localhost', database='metrics', token='secret')
+        assert Client('warp10', 'http://localhost', token='secret')._session.headers['X-Warp10-Token'] == 'secret'
+
+    def test_plugin(self, http_server):
+        backend = Client(CSVBackend, http_server.url)
+        assert backend.protocol == 'csv'
+        serie = Ingester(backend)
+        serie.append(1585934985000, tags={'host': 'a'}, measurement='cpu', user=0.5, state='up')
+        serie.commit()
+        assert http_server.requests[0]['path'] == '/csv'
+        assert http_server.requests[0]['body'] == b'1585934985000,cpu;a,user,0.5\n1585934985000,cpu;a,state,"up"\n'
+        assert serie._report['series'] == 2
+        with pytest.raises(NotImplementedError):
+            serie.append_columns([1585934985000], user=[0.5])
+        with pytest.raises(ValueError):
+            Ingester(backend, condensed=True)
+
+    def test_entry_point(self, monkeypatch):
+        class EntryPoint:
+            """Entry point of an installed plugin"""
+            name = 'csv-plugin'
+            value = 'tests.test_metrics:CSVBackend'
+
+            @staticmethod
+            def load():
+                return CSVBackend
+
+        monkeypatch.setattr(backends, '_entry_points', lambda: [EntryPoint])
+        monkeypatch.setattr(backends, 'BACKENDS', dict(backends.BACKENDS))
+        assert Client('csv-plugin', 'http://localhost').backend.__class__ is CSVBackend
+        assert backends.BACKENDS['csv-plugin'] is CSVBackend
+
+class TestTriggers:
+    """Count, size and linger flush triggers"""
+
+    def test_max_bytes(self, mock_send_capture):
+        backend = Client('influx', 'http://localhost', database='metrics')
+        serie = Ingester(backend, batch=100, max_bytes=100)
+        for i in range(10):
+            serie.append(1585934985000 + i, name=i) # 33 bytes per line
+        serie.commit()
+        # flushed before the point crossing max_bytes
+        assert [len(body) for body in mock_send_capture] == [99, 99, 99, 33]
+        assert serie._report['trigger_bytes'] == 3
+        assert serie._report['trigger_manual'] == 1
+        assert serie._report['series'] == 10
+        serie.append_columns([1585934985000 + i for i in range(10)], name=list(range(10)))
+        serie.commit()
+        assert mock_send_capture[4:] == mock_send_capture[:4]
+        assert serie._report['trigger_bytes'] == 6
+        serie = Ingester(backend, max_bytes=10)
+        serie.append(1585934985000, name=1) # larger than max_bytes: alone in its payload
+        serie.append(1585934985001, name=2)
+        assert mock_send_capture[-2:] == [b"data name=1i 1585934985000000000\n",
+                                          b"data name=2i 1585934985001000000\n"]
+
+    def test_max_bytes_condensed(self, mock_send_capture, tmp_path):
+        backend = Client('warp10', 'http://localhost/api/v0')
+        serie = Ingester(backend, condensed=True, max_bytes=50)
+        for i in range(5):
+            serie.append(1585934985000 + i, name=i)
+        serie.commit()
+        # line: 28 bytes, continuation line: 22 bytes
+        assert mock_send_capture == [b"1585934985000000// name{} 0\n=1585934985001000// 1\n",
+                                     b"1585934985002000// name{} 2\n=1585934985003000// 3\n",
+                                     b"1585934985004000// name{} 4\n"]
+        path = tmp_path / 'points.txt'
+        # continuation lines crossing max_bytes are expanded to full lines
+        path.write_bytes(b"1585934985000000// name{} 0\n" + b"".join(
+            "={}// {}\n".format(1585934985000000 + i * 1000, i).encode() for i in range(1, 5)))
+        mock_send_capture.clear()
+        serie = Ingester(backend, max_bytes=50)
+        serie.ingest_file(str(path), file_format='line', chunk_size=40)
+        serie.commit()
+        assert mock_send_capture == [b"1585934985000000// name{} 0\n=1585934985001000// 1\n",
+                                     b"1585934985002000// name{} 2\n=1585934985003000// 3\n",
+                                     b"1585934985004000// name{} 4\n"]
+
+    def test_count(self, mock_send_capture):
+        backend = Client('warp10', 'http://localhost')
+        serie = Ingester(backend, batch=2, max_bytes=1000)
+        for i in range(5):
+            serie.append(1585934985000 + i, name=i)
+        serie.commit()
+        assert len(mock_send_capture) == 3
+        assert serie._report['trigger_count'] == 2
+        assert serie._report['trigger_manual'] == 1
+
+    def test_linger(self, http_server):
+        backend = Client('influx', http_server.url, database='metrics')
+        with Ingester(backend, batch=1000, linger_ms=50) as serie:
+            serie.append(1585934985000, name=1)
+            for _ in range(100):
+                if http_server.requests:
+                    break
+                time.sleep(0.02)
+            assert len(http_server.requests) == 1
+            assert serie.length() == 0
+            assert serie._report['trigger_linger'] == 1
+            serie.append(1585934986000, name=2)
+        assert len(http_server.requests) == 2
+
+    def test_linger_error(self, http_server):
+        http_server.status = 400
+        backend = Client('influx', http_server.url, database='metrics')
+        serie = Ingester(backend, linger_ms=20)
+        serie.append(1585934985000, name=1)
+        for _ in range(100):
+            if http_server.requests:
+                break
+            time.sleep(0.02)
+        time.sleep(0.05)
+        with pytest.raises(requests.exceptions.HTTPError):
+            serie.append(1585934986000, name=2)
+        serie.purge()
+        serie.close()
+
+    def test_collected(self, caplog, tmp_path):
+        before = set(threading.enumerate())
+        spool = Spool(str(tmp_path), fsync=False, drain_interval=0.01)
+        serie = Ingester(Client('warp10', 'http://localhost/api/v0'), batch=10, senders=2, linger_ms=60000, spool=spool)
+        serie.append(1585934985000, name=1)
+        threads = set(threading.enumerate()) - before
+        assert len(threads) == 4
+        ref = weakref.ref(serie)
+        with caplog.at_level(logging.WARNING):
+            del serie
+        # background threads do not keep an ingester which is not closed alive
+        assert ref() is None
+        assert "non-flushed payload" in caplog.text
+        for thread in threads:
+            thread.join(1)
+            assert not thread.is_alive()
+
+class TestSchema:
+    """Pre-compiled point writers"""
+
+    FIELDS = {'user usage': float, 'count': int, 'up': bool, 'state': str}
+
+    @pytest.mark.parametrize('protocol', ['influx', 'warp10'])
+    def test_payload(self, protocol):
+        backend = Client(protocol, 'http://localhost', database='metrics')
+        serie = Ingester(backend)
+        writer = serie.schema('cpu', ('host', 'dc'), self.FIELDS)
+        writer(1585934985000, ('a,b', 1), 0.5, 3, True, 'it\'s 100%')
+        writer(1585934986000, ('a,b', 1), 2, 4, False, 'ok')
+        expected = serie.payload()
+        serie.purge()
+        serie.append(1585934985000, tags={'host': 'a,b', 'dc': 1}, measurement='cpu',
+                     **{'user usage': 0.5, 'count': 3, 'up': True, 'state': 'it\'s 100%'})
+        serie.append(1585934986000, tags={'host': 'a,b', 'dc': 1}, measurement='cpu',
+                     **{'user usage': 2.0, 'count': 4, 'up': False, 'state': 'ok'})
+        assert serie.payload() == expected
+        assert serie._report['series'] == 2 * serie.length()
+        assert serie._report['values'] == 16
+
+    @pytest.mark.parametrize('protocol', ['influx', 'warp10'])
+    def test_no_tags(self, protocol):
+        backend = Client(protocol, 'http://localhost', database='metrics')
+        serie = Ingester(backend)
+        serie.schema(fields={'value': int})(1585934985000, (), 1)
+        payload = serie.payload()
+        serie.purge()
+        serie.append(1585934985000, value=1)
+        assert serie.payload() == payload
+
+    def test_invalid(self):
+        backend = Client('influx', 'http://localhost', database='metrics')
+        serie = Ingester(backend)
+        with pytest.raises(ValueError):
+            serie.schema('cpu', fields={})
+        with pytest.raises(ValueError):
+            serie.schema('cpu', fields={'value': list})
+        writer = serie.schema('cpu', ('host',), {'value': int})
+        with pytest.raises(ValueError):
+            writer(1585934985000, ('a',), 1, 2)
+        with pytest.raises(ValueError):
+            writer(1585934985000, ('a',), True)
+        with pytest.raises(ValueError):
+            writer(1585934985000, ('a',), 1.0)
+        with pytest.raises(ValueError):
+            writer(1585934985000, ('a', 'b'), 1)
+        with pytest.raises(ValueError):
+            writer(1585934985000.0, ('a',), 1)
+        assert serie.length() == 0
+
+    def test_series_cache(self):
+        backend = Client('influx', 'http://localhost', database='metrics')
+        serie = Ingester(backend)
+        writer = serie.schema('mes', ('t',), {'a': int})
+        for value in (1, True, '1', 1.0):
+            writer(1585934985000, (value,), 1)
+        assert [line.split(' ')[0] for line in serie.payload().splitlines()] == [
+            'mes,t=1', 'mes,t=True', 'mes,t=1', 'mes,t=1.0']
+
+    def test_tag_list(self):
+        backend = Client('influx', 'http://localhost', database='metrics')
+        serie = Ingester(backend)
+        writer = serie.schema('mes', ('t', 'u'), {'a': int})
+        writer(1585934985000, ['x', 'y'], 1)
+        writer(1585934986000, ('x', 'y'), 2)
+        writer(1585934987000, ['x', 'y'], 3)
+        assert serie.payload() == ("mes,t=x,u=y a=1i 1585934985000000000\n"
+                                   "mes,t=x,u=y a=2i 1585934986000000000\n"
+                                   "mes,t=x,u=y a=3i 1585934987000000000\n")
+        with pytest.raises(ValueError):
+            writer(1585934988000, ['x'], 4)
+
+    @pytest.mark.parametrize('linger_ms', [None, 60000])
+    def test_batch(self, linger_ms, mock_send_capture):
+        backend = Client('warp10', 'http://localhost')
+        with Ingester(backend, batch=4, linger_ms=linger_ms) as serie:
+            writer = serie.schema('mes', ('host',), {'a': int, 'b': float})
+            for i in range(5):
+                writer(1585934985000 + i, ('h',), i, 0.5)
+        assert len(mock_send_capture) == 3
+        assert serie._report['trigger_count'] == 2
+
+    def test_condensed(self):
+        backend = Client('warp10', 'http://localhost')
+        serie = Ingester(backend, condensed=True)
+        writer = serie.schema('mes', (), {'a': int})
+        writer(1585934985000, (), 1)
+        writer(1585934986000, (), 2)
+        assert serie.payload() == "1585934985000000// mes.a{} 1\n=1585934986000000// 2\n"
+
+class TestStats:
+    """Public statistics and instrumentation hooks"""
+
+    def test_stats(self, http_server):
+        backend = Client('influx', http_server.url, database='metrics')
+        serie = Ingester(backend, batch=2)
+        serie.append(1585934985000, name=1)
+        serie.append(1585934986000, name=2)
+        serie.append(1585934987000, name=3)
+        stats = serie.stats()
+        assert not [key for key in stats if key.startswith('_')]
+        assert stats['requests'] == 1
+        assert stats['successes'] == 1
+        assert stats['series'] == 3
+        assert stats['length'] == 1
+        assert stats['bytes_sent'] == 66
+        assert stats['queue_depth'] == 0
+        assert stats['encode_time'] > 0
+        assert stats['network_time'] > 0
+        assert stats['latency'][float('inf')] == 1
+        assert list(stats['latency']) == list(Ingester.LATENCY_BUCKETS) + [float('inf')]
+        assert all(a <= b for a, b in zip(list(stats['latency'].values()),
+                                          list(stats['latency'].values())[1:]))
+        serie.commit()
+
+    def test_hooks(self, http_server):
+        calls = []
+        backend = Client('influx', http_server.url, database='metrics')
+        serie = Ingester(backend, retry=RetryPolicy(max_attempts=1),
+                         on_append=lambda points: calls.append(('append', points)),
+                         on_commit_start=lambda *args: calls.append(('start',) + args),
+                         on_commit_end=lambda result, latency, size: calls.append(
+                             ('end', result, latency > 0, size)))
+        serie.append(1585934985000, name=1)
+        serie.append_columns([1585934986000, 1585934987000], name=[2, 3])
+        serie.schema(fields={'name': int})(1585934988000, (), 4)
+        serie.commit()
+        http_server.status = 400
+        serie.append(1585934989000, name=5)
+        with pytest.raises(requests.exceptions.HTTPError):
+            serie.commit()
+        http_server.status = 503
+        serie.append(1585934990000, name=6)
+        with pytest.raises(MaxErrorsException):
+            serie.commit()
+        serie.purge()
+        assert calls == [('append', 1), ('append', 2), ('append', 1),
+                         ('start', 4, 132), ('end', 'success', True, 132),
+                         ('append', 1), ('start', 1, 33), ('end', 'rejected', True, 33),
+                         ('append', 1), ('start', 1, 33), ('end', 'failed', True, 33)]
+        assert serie.stats()['requests'] == 3
+
+class TestTrace:
+    """Lazy payload dumps on the trace logger"""
+
+    def test_head(self):
+        data = b"a 1\nb 2\nc 3\n"
+        assert trace.head(data) == (data, False)
+        assert trace.head(data, 2) == (b"a 1\nb 2\n", True)
+        assert trace.head(data, 3) == (data, False)
+        assert trace.head(data, 5) == (data, False)
+        compressor = zlib.compressobj(-1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(data * 10000) + compressor.flush()
+        assert trace.head(compressed, 2, 'gzip') == (b"a 1\nb 2\n", True)
+        assert trace.head(compressed, None, 'gzip') == (data * 10000, False)
+
+    def test_truncated_payload(self, caplog, mock_send_ok):
+        backend = Client('influx', 'http://localhost:8086', database='metrics',
+                         compression='gzip', trace_lines=1)
+        serie = Ingester(backend)
+        serie.append(1585934985000, name=1)
+        serie.append(1585934986000, name=2)
+        with caplog.at_level(logging.DEBUG, logger='universal_tsdb.trace'):
+            serie.commit()
+        records = [record for record in caplog.records if record.name == 'universal_tsdb.trace']
+        assert records[0].message == ("Data: data name=1i 1585934985000000000\n"
+                                      "[... truncated to 1 lines]")
+
+    def test_failure_dump(self, caplog, mock_send_ko):
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend)
+        serie.append(1585934985000, name=1)
+        with caplog.at_level(logging.DEBUG, logger='universal_tsdb.trace'):
+            with pytest.raises(requests.exceptions.HTTPError):
+                serie.commit()
+        assert "HTTP RESPONSE" in caplog.records[-1].message
+        assert "400 http://127.0.0.1" in caplog.records[-1].message
+        assert "HTTP REQUEST" in caplog.records[-1].message
+        assert "data name=1i 1585934985000000000" in caplog.records[-1].message
+
+    def test_sink(self, caplog, mock_send_ok):
+        logger = logging.getLogger('universal_tsdb.trace')
+        dumps = []
+        handler = logging.Handler()
+        handler.emit = lambda record: dumps.append(record.getMessage())
+        logger.addHandler(handler)
+        logger.propagate = False
+        try:
+            with caplog.at_level(logging.DEBUG):
+                serie = Ingester(Client('warp10', 'http://localhost/api/v0'))
+                serie.append(1585934985000, name=1)
+                serie.commit()
+        finally:
+            logger.removeHandler(handler)
+            logger.propagate = True
+        assert dumps == ["Data: 1585934985000000// name{} 1"]
+        assert "1585934985000000//" not in caplog.text
+
+    @pytest.mark.parametrize('level', [logging.INFO, logging.DEBUG])
+    def test_memory(self, caplog, mock_send_ok, level):
+        backend = Client('influx', 'http://localhost:8086', database='metrics', trace_lines=10)
+        serie = Ingester(backend)
+        for i in range(20000):
+            serie.append(1585934985000 + i, name=i)
+        size = serie.size()
+        tracemalloc.start()
+        b''.join(serie._buffer.chunks()) # pylint: disable=protected-access
+        _, join_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with caplog.at_level(level):
+            tracemalloc.start()
+            serie.commit()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        # no payload copy besides the joined body sent
+        assert peak < join_peak + size / 2
+
+class TestIngest:
+    """Streaming ingestion from iterables and files"""
+
+    RECORDS = [{'timestamp': 1585934985000, 'measurement': 'mes', 'tags': {'host': 'a'},
+                'fields': {'value': 1, 'tags': 'x'}},
+               {'timestamp': 1585934986000, 'fields': {'value': 2.5}},
+               {'timestamp': 1585934987000, 'measurement': 'mes', 'fields': {'value': 3}}]
+    EXPECTED = ("mes,host=a value=1i,tags=\"x\" 1585934985000000000\n"
+                "data value=2.5 1585934986000000000\n"
+                "mes value=3i 1585934987000000000\n")
+
+    def test_ingest(self, mock_send_capture):
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend, batch=2)
+        serie.ingest(iter(self.RECORDS))
+        assert [body.decode() for body in mock_send_capture] == [
+            "".join(self.EXPECTED.splitlines(True)[:2])]
+        assert serie.payload() == self.EXPECTED.splitlines(True)[2]
+        serie.commit()
+        assert b"".join(mock_send_capture).decode() == self.EXPECTED
+        assert serie.stats()['series'] == 3
+
+    def test_ingest_write_ahead(self, http_server, tmp_path):
+        spool = Spool(str(tmp_path), fsync=False, write_ahead=True)
+        serie = Ingester(Client('influx', http_server.url, database='metrics'), batch=2, spool=spool)
+        serie.ingest({'timestamp': 1585934985000 + i, 'fields': {'value': i}} for i in range(6))
+        serie.commit()
+        # the overlapped sender does not replay the batches queued behind it
+        assert sum(req['body'].count(b'\n') for req in http_server.requests) == 6
+        assert serie._report['replayed'] == 0
+        assert not spool.segments()
+
+    def test_csv(self, tmp_path, mock_send_capture):
+        path = tmp_path / 'points.csv'
+        path.write_text("timestamp,host,value,state,count\n"
+                        "1585934985000,a,1.5,ok,1\n"
+                        "1585934986000,\"b,c\",2,,2\n")
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend)
+        serie.ingest_file(str(path), tags=('host',), fields={'value': float}, measurement='mes')
+        assert serie.payload() == ("mes,host=a value=1.5,state=\"ok\",count=1i 1585934985000000000\n"
+                                   "mes,host=b\\,c value=2.0,count=2i 1585934986000000000\n")
+        serie.purge()
+
+    def test_jsonl(self, tmp_path):
+        path = tmp_path / 'points.jsonl'
+        path.write_text("\n".join(json.dumps(record) for record in self.RECORDS) + "\n\n")
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend)
+        serie.ingest_file(str(path), file_format='jsonl')
+        assert serie.payload() == self.EXPECTED
+        serie.purge()
+        path.write_text('{"timestamp": 1585934985000}\n')
+        with pytest.raises(ValueError):
+            serie.ingest_file(str(path), file_format='jsonl')
+        with pytest.raises(ValueError):
+            serie.ingest_file(str(path), file_format='xml')
+
+    @pytest.mark.parametrize('chunk_size', [1, 16, 1024])
+    def test_lines(self, tmp_path, mock_send_capture, chunk_size):
+        path = tmp_path / 'points.txt'
+        path.write_bytes(b"# comment\n" + self.EXPECTED.encode() + b"\nmes,host=b\\ c value=4i")
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend, batch=2)
+        serie.ingest_file(str(path), file_format='line', chunk_size=chunk_size)
+        assert serie.length() == 0
+        assert b"".join(mock_send_capture).decode() == self.EXPECTED + "mes,host=b\\ c value=4i\n"
+        assert [len(body.splitlines()) for body in mock_send_capture] == [2, 2]
+        assert serie.stats()['series'] == 4
+
+    def test_lines_condensed(self, tmp_path, mock_send_capture):
+        path = tmp_path / 'points.txt'
+        path.write_text("1585934985000000// name{} 1\n=1585934986000000// 2\n"
+                        "1585934987000000// other{a=b} 'c'\n")
+        backend = Client('warp10', 'http://localhost/api/v0')
+        serie = Ingester(backend, batch=1)
+        serie.ingest_file(str(path), file_format='line')
+        assert [body.decode() for body in mock_send_capture] == [
+            "1585934985000000// name{} 1\n=1585934986000000// 2\n",
+            "1585934987000000// other{a=b} 'c'\n"]
+
+    @pytest.mark.parametrize('protocol,line', [('influx', "mes value=1i\nmes\n"),
+                                               ('influx', "mes value\n"),
+                                               ('warp10', "1585934985000000// name 1\n")])
+    def test_invalid_lines(self, tmp_path, protocol, line):
+        path = tmp_path / 'points.txt'
+        path.write_text(line)
+        backend = Client(protocol, 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend)
+        with pytest.raises(ValueError):
+            serie.ingest_file(str(path), file_format='line')
+        serie.purge()
+
+    def test_overlap(self, http_server):
+        sent = []
+        http_server.status = lambda body: sent.append(threading.current_thread()) or 204
+        backend = Client('influx', http_server.url, database='metrics')
+        serie = Ingester(backend, batch=1, on_commit_start=lambda *args: sent.append(
+            threading.current_thread()))
+        serie.ingest(self.RECORDS)
+        assert len(http_server.requests) == 3
+        assert threading.main_thread() not in sent
+        assert serie.queue_depth() == 0
+        http_server.status = 503
+        with pytest.raises(MaxErrorsException):
+            serie.ingest(self.RECORDS)
+        assert serie.stats()['dropped'] == 3
+
+    @staticmethod
+    def _expand(bodies):
+        """Return the lines of Warp10 payloads, continuation lines expanded"""
+        lines = []
+        for line in b"".join(bodies).splitlines(True):
+            if line.startswith(b"="):
+                line = backends.Warp10Backend.expand(line, first)
+            else:
+                first = line
+            lines.append(line)
+        return lines
+
+    def test_parallel(self, mock_send_capture):
+        records = [{'timestamp': 1585934985000 + i, 'measurement': 'mes', 'tags': {'host': str(i // 40)},
+                    'fields': {'value': i, 'state': 'ok'} if i % 10 else {'value': i}}
+                   for i in range(100)]
+        partitions = [records[:30], records[30:35], records[35:]]
+        backend = Client('warp10', 'http://localhost/api/v0')
+        serie = Ingester(backend, batch=17, condensed=True)
+        serie.ingest(records)
+        serie.commit()
+        expected = list(mock_send_capture)
+        mock_send_capture.clear()
+        report = serie.stats()
+        serie = Ingester(backend, batch=17, condensed=True)
+        serie.ingest_parallel(partitions, processes=2)
+        serie.commit()
+        # batches are cut on lines, not points
+        assert [len(body.splitlines()) for body in mock_send_capture] == [17] * 11 + [3]
+        assert not [body for body in mock_send_capture if body.startswith(b"=")]
+        assert self._expand(mock_send_capture) == self._expand(expected)
+        stats = serie.stats()
+        for key in ('series', 'values', 'commits', 'successes', 'trigger_count'):
+            assert stats[key] == report[key]
+
+    def test_parallel_files(self, tmp_path, mock_send_capture):
+        paths = []
+        for i in range(3):
+            paths.append(str(tmp_path / 'points{}.jsonl'.format(i)))
+            with open(paths[-1], 'w', encoding='utf-8') as stream:
+                stream.write(json.dumps(self.RECORDS[i]) + "\n")
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend, max_bytes=60)
+        serie.ingest_parallel(paths, processes=2, file_format='jsonl')
+        serie.commit()
+        assert b"".join(mock_send_capture).decode() == self.EXPECTED
+        assert [len(body) for body in mock_send_capture] == [49, 35, 33]
+        with pytest.raises(ValueError):
+            serie.ingest_parallel(paths, file_format='xml')
+        paths = [str(tmp_path / 'points.txt')]
+        with open(paths[0], 'w', encoding='utf-8') as stream:
+            stream.write("mes value\n")
+        with pytest.raises(ValueError):
+            serie.ingest_parallel(paths, processes=1, file_format='line')
+
+class TestQuery:
+    """Query API, against a local HTTP server"""
+
+    INFLUX = (b'{"results":[{"statement_id":0,"series":[{"name":"mes","tags":{"host":"a"},'
+              b'"columns":["time","value","state"],"values":[[1585934985000,1.5,"ok"],'
+              b'[1585934986000,2,null]]}],"partial":true}]}\n'
+              b'{"results":[{"statement_id":0,"series":[{"name":"mes","tags":{"host":"b"},'
+              b'"columns":["time","value","state"],"values":[[1585934987000,3,"ko"]]}]}]}\n')
+    WARP10 = (b"1585934985000000// mes.value{host=a%2Cb} 1.5\n=1585934986000000// 2\n"
+              b"1585934987000000/48.0:2.0/ mes.state{host=c}{attr=x} 'not%20ok'\n"
+              b"1585934988000000// mes.up{} T\n")
+
+    def test_influx(self, http_server):
+        http_server.content = self.INFLUX
+        backend = Client('influx', http_server.url, database='metrics')
+        rows = backend.query("SELECT * FROM mes WHERE time >= $start AND time < $end GROUP BY *",
+                             1585934985000, 1585934988000)
+        assert next(rows) == (1585934985000, {'host': 'a'}, {'value': 1.5, 'state': 'ok'})
+        assert list(rows) == [(1585934986000, {'host': 'a'}, {'value': 2}),
+                              (1585934987000, {'host': 'b'}, {'value': 3, 'state': 'ko'})]
+        request = http_server.requests[0]
+        assert request['path'] == '/query'
+        assert request['params']['db'] == 'metrics'
+        assert request['params']['epoch'] == 'ms'
+        assert request['params']['chunked'] == 'true'
+        assert json.loads(request['params']['params']) == {'start': 1585934985000000000,
+                                                           'end': 1585934988000000000}
+
+    def test_influx_errors(self, http_server):
+        http_server.content = b'{"results":[{"statement_id":0,"error":"database not found"}]}\n'
+        backend = Client('influx', http_server.url, database='metrics')
+        with pytest.raises(QueryException):
+            list(backend.query("SELECT * FROM mes"))
+        http_server.status = 400
+        with pytest.raises(requests.exceptions.HTTPError):
+            list(backend.query("SELECT * FROM mes"))
+
+    def test_warp10(self, http_server):
+        http_server.content = self.WARP10
+        backend = Client('warp10', http_server.url + '/api/v0', token='READ')
+        assert list(backend.query('~mes.*{}', 1585934985000, 1585934989000)) == [
+            (1585934985000, {'host': 'a,b'}, {'mes.value': 1.5}),
+            (1585934986000, {'host': 'a,b'}, {'mes.value': 2}),
+            (1585934987000, {'host': 'c'}, {'mes.state': 'not ok'}),
+            (1585934988000, {}, {'mes.up': True})]
+        request = http_server.requests[0]
+        assert request['path'] == '/api/v0/fetch'
+        assert request['headers']['X-Warp10-Token'] == 'READ'
+        assert request['params'] == {'selector': '~mes.*{}', 'start': '1585934985000000',
+                                     'stop': '1585934988999999', 'format': 'text'}
+        with pytest.raises(ValueError):
+            list(backend.query('~mes.*{}'))
+
+    def test_streaming(self):
+        def lines():
+            yield b"1585934985000000// mes.value{} 1"
+            raise requests.exceptions.ConnectionError
+
+        rows = backends.Warp10Backend('http://localhost/api/v0').decode(lines())
+        assert next(rows) == (1585934985000, {}, {'mes.value': 1})
+        with pytest.raises(requests.exceptions.ConnectionError):
+            next(rows)
+
+    def test_parallel(self, http_server):
+        def content(params):
+            start = int(params['start']) // 1000
+            return "".join("{}// value{{}} {}\n".format(timestamp * 1000, timestamp)
+                           for timestamp in range(start, int(params['stop']) // 1000 + 1)).encode()
+        http_server.content = content
+        backend = Client('warp10', http_server.url + '/api/v0')
+        rows = list(backend.query('value{}', 0, 2000, parallel=4))
+        assert [row[0] for row in rows] == list(range(2000))
+        assert sorted(int(req['params']['start']) for req in http_server.requests) == \
+            [0, 500000, 1000000, 1500000]
+        rows = backend.query('value{}', 0, 2000, parallel=4)
+        assert next(rows)[0] == 0
+        rows.close()
+        with pytest.raises(ValueError):
+            list(backend.query('value{}', parallel=4))
+
+    def test_split_range(self):
+        assert query.split_range(0, 2000, 4) == [(0, 500), (500, 1000), (1000, 1500),
+                                                 (1500, 2000)]
+        assert query.split_range(0, 10, 4) == [(0, 3), (3, 6), (6, 9), (9, 10)]
+        assert query.split_range(0, 2000, 1) == [(0, 2000)]
+        # cut on the multiples of the GROUP BY interval
+        assert query.split_range(0, 2000, 4, interval=300) == [(0, 600), (600, 1200),
+                                                               (1200, 1800), (1800, 2000)]
+        assert query.split_range(150, 2000, 2, interval=300) == [(150, 1200), (1200, 2000)]
+        assert query.split_range(150, 500, 4, interval=300) == [(150, 300), (300, 500)]
+        with pytest.raises(ValueError):
+            query.split_range(0, 2000, 4, interval=0)
+
+    def test_cache(self, http_server):
+        http_server.content = self.INFLUX
+        backend = Client('influx', http_server.url, database='metrics')
+        cache = QueryCache(max_entries=2)
+        expected = list(backend.query("SELECT *", 0, 100, cache=cache))
+        assert list(backend.query("SELECT *", 0, 100, cache=cache)) == expected
+        assert len(http_server.requests) == 1
+        assert (cache.hits, cache.misses) == (1, 1)
+        list(backend.query("SELECT *", 0, 100, parallel=2, cache=cache))
+        assert len(http_server.requests) == 3
+        assert len(cache) == 2
+        list(backend.query("SELECT *", cache=cache))
+        assert len(cache) == 2
+        now = int(time.time()*1000)
+        list(backend.query("SELECT *", now - 1000, now + 60000, cache=cache))
+        list(backend.query("SELECT *", now - 1000, now + 60000, cache=cache))
+        assert len(http_server.requests) == 6
+        assert len(cache) == 2
+
+    def test_cache_credentials(self, http_server):
+        http_server.content = self.INFLUX
+        cache = QueryCache()
+        for username in ('reader', 'reader', 'other'):
+            backend = Client('influx', http_server.url, database='metrics',
+                             backend_username=username, backend_password='secret')
+            list(backend.query("SELECT *", 0, 100, cache=cache))
+        backend = Client('influx', http_server.url, database='metrics',
+                         http_username='reader', http_password='secret')
+        list(backend.query("SELECT *", 0, 100, cache=cache))
+        assert len(http_server.requests) == 3
+        assert (cache.hits, cache.misses) == (1, 3)
+
+    def test_columns(self, http_server):
+        http_server.content = self.INFLUX
+        backend = Client('influx', http_server.url, database='metrics')
+        assert backend.query_columns("SELECT * FROM mes GROUP BY *") == {
+            'timestamp': [1585934985000, 1585934986000, 1585934987000],
+            'host': ['a', 'a', 'b'], 'value': [1.5, 2, 3], 'state': ['ok', None, 'ko']}
+
+class TestCompact:
+    """Deduplication and compaction of pending points"""
+
+    def test_merge(self, mock_send_capture):
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend, compact='merge')
+        serie.append(1585934985000, tags={'host': 'a'}, measurement='mes', cpu=1.5)
+        serie.append(1585934985000, tags={'host': 'b'}, measurement='mes', cpu=2.5)
+        serie.append(1585934985000, tags={'host': 'a'}, measurement='mes', mem=10)
+        serie.append(1585934985000, tags={'host': 'a'}, measurement='mes', cpu=1.5, mem=10)
+        serie.append(1585934986000, tags={'host': 'a'}, measurement='mes', cpu=1.5)
+        assert serie.length() == 3
+        assert serie.payload() == ("mes,host=a cpu=1.5,mem=10i 1585934985000000000\n"
+                                   "mes,host=b cpu=2.5 1585934985000000000\n"
+                                   "mes,host=a cpu=1.5 1585934986000000000\n")
+        serie.commit()
+        stats = serie.stats()
+        assert (stats['merged'], stats['duplicates']) == (1, 1)
+        assert (stats['series'], stats['values']) == (3, 4)
+
+    def test_conflict(self):
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend, compact='merge')
+        serie.append(1585934985000, measurement='mes', cpu=1, mem=2)
+        serie.append(1585934985000, measurement='mes', cpu=1.0)
+        serie.append(1585934985000, measurement='mes', cpu=1.0, mem=2)
+        assert serie.payload() == ("mes cpu=1i,mem=2i 1585934985000000000\n"
+                                   "mes cpu=1.0,mem=2i 1585934985000000000\n")
+        assert serie.length() == 2
+        serie.purge()
+        serie = Ingester(backend, compact='last')
+        serie.append(1585934985000, measurement='mes', cpu=1, mem=2)
+        serie.append(1585934985000, measurement='mes', cpu=3)
+        serie.append(1585934985000, measurement='mes', cpu=3)
+        assert serie.payload() == "mes cpu=3i,mem=2i 1585934985000000000\n"
+        assert (serie.stats()['merged'], serie.stats()['duplicates']) == (1, 1)
+        serie.purge()
+
+    def test_warp10(self, mock_send_capture):
+        backend = Client('warp10', 'http://localhost/api/v0')
+        serie = Ingester(backend, batch=3, compact='merge')
+        serie.append(1585934985000, measurement='mes', cpu=1)
+        serie.append(1585934985000, measurement='mes', cpu=1, mem=2)
+        assert serie.length() == 2
+        serie.append(1585934985000, measurement='mes', disk=3)
+        assert mock_send_capture == [b"1585934985000000// mes.cpu{} 1\n"
+                                     b"1585934985000000// mes.mem{} 2\n"
+                                     b"1585934985000000// mes.disk{} 3\n"]
+
+    def test_conflict_unchanged(self):
+        backend = Client('warp10', 'http://localhost/api/v0')
+        serie = Ingester(backend, compact='merge')
+        serie.append(1, a=1)
+        serie.append(1, b=2, a=3)
+        # the pending point is written as it was, before the conflicting one
+        assert serie.payload() == "1000// a{} 1\n1000// b{} 2\n1000// a{} 3\n"
+        assert serie.length() == 3
+        serie.purge()
+
+    def test_bounded(self):
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend, compact='merge', compact_size=2)
+        for timestamp in (1, 2, 3, 1, 3):
+            serie.append(timestamp, value=timestamp)
+        # the full index is written when point 3 is appended: point 1 is sent twice
+        assert serie.payload() == ("data value=1i 1000000\ndata value=2i 2000000\n"
+                                   "data value=3i 3000000\ndata value=1i 1000000\n")
+        assert serie.stats()['duplicates'] == 1
+        serie.purge()
+        # same bound in the worker processes
+        serie = Ingester(backend, compact='merge', compact_size=2)
+        serie.ingest_parallel([[{'timestamp': timestamp, 'fields': {'value': timestamp}}
+                                for timestamp in (1, 2, 3, 1, 3)]], processes=1)
+        assert serie.payload() == ("data value=1i 1000000\ndata value=2i 2000000\n"
+                                   "data value=3i 3000000\ndata value=1i 1000000\n")
+        serie.purge()
+
+    def test_writers(self):
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend, compact='merge')
+        serie.append_columns([1, 2, 1], value=[1, 2, 1])
+        serie.schema(fields={'value': int, 'other': float})(2, (), 2, 0.5)
+        assert serie.payload() == "data value=1i 1000000\ndata value=2i,other=0.5 2000000\n"
+        assert serie.stats()['duplicates'] == 1
+        serie.purge()
+
+    @pytest.mark.parametrize('compact', ['merge', 'last'])
+    def test_accessors(self, compact):
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend, compact=compact)
+        serie.append(1, tags={'a': 'b'}, measurement='m', x=1)
+        assert serie.size() == len("m,a=b x=1i 1000000\n")
+        assert serie.payload() == "m,a=b x=1i 1000000\n"
+        # read-only: later points are still merged
+        serie.append(1, tags={'a': 'b'}, measurement='m', y=2)
+        assert serie.payload() == "m,a=b x=1i,y=2i 1000000\n"
+        assert serie.size() == len("m,a=b x=1i,y=2i 1000000\n")
+        serie.purge()
+
+    def test_invalid(self):
+        backend = Client('warp10', 'http://localhost/api/v0')
+        with pytest.raises(ValueError):
+            Ingester(backend, compact='first')
+        with pytest.raises(ValueError):
+            Ingester(backend, compact='merge', condensed=True)
+        with pytest.raises(ValueError):
+            Ingester(backend, compact='merge', compact_size=0)
+        with pytest.raises(ValueError):
+            Ingester(backend, compact='merge', max_bytes=1000)
+        with pytest.raises(ValueError):
+            Ingester(backend, reorder=True, max_bytes=1000)
+
+class TestAggregate:
+    """Pre-aggregation over tumbling windows"""
+
+    def test_windows(self):
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        serie = Ingester(backend)
+        aggregator = Aggregator(serie, window=1000, functions=('min', 'max', 'mean', 'sum', 'count', 'last'))
+        aggregator.append(1585934985500, tags={'host': 'b'}, value=2)
+        aggregator.append(1585934985600, tags={'host': 'b'}, other=3)
+        for timestamp in range(1585934985000, 1585934987000, 100):
+            aggregator.append(timestamp, tags={'host': 'a'}, measurement='mes', value=timestamp % 1000)
+            aggregator.append(timestamp, measurement='mes', value=1.5)
+        assert serie.length() == 3
+        aggregator.append(1585934987000, tags={'host': 'a'}, measurement='mes', value=0)
+        assert serie.payload() == (
+            "data,host=b value_min=2.0,value_max=2.0,value_mean=2.0,value_sum=2.0,value_count=1i,"
+            "value_last=2.0,other_min=3.0,other_max=3.0,other_mean=3.0,other_sum=3.0,"
+            "other_count=1i,other_last=3.0 1585934985000000000\n"
+            "mes,host=a value_min=0.0,value_max=900.0,value_mean=450.0,value_sum=4500.0,"
+            "value_count=10i,value_last=900.0 1585934985000000000\n"
+            "mes value_min=1.5,value_max=1.5,value_mean=1.5,value_sum=15.0,"
+            "value_count=10i,value_last=1.5 1585934985000000000\n"
+            "mes,host=a value_min=0.0,value_max=900.0,value_mean=450.0,value_sum=4500.0,"
+            "value_count=10i,value_last=900.0 1585934986000000000\n"
+            "mes value_min=1.5,value_max=1.5,value_mean=1.5,value_sum=15.0,"
+            "value_count=10i,value_last=1.5 1585934986000000000\n")
+        assert aggregator.stats() == {'points': 43, 'late': 0, 'windows': 5, 'open': 1}
+        serie.purge()
+
+    def test_grace(self, mock_send_capture):
+        backend = Client('warp10', 'http://localhost/api/v0')
+        serie = Ingester(backend)
+        with Aggregator(serie, window=1000, functions=('last', 'count'), grace=500) as aggregator:
+            aggregator.append(1585934985000, value=1)
+            aggregator.append(1585934986400, value=2)
+            aggregator.append(1585934985900, value=3) # late, within the grace period
+            aggregator.append(1585934985800, value=4) # not the last value
+            aggregator.append(1585934986500, value=5) # closes the first window
+            aggregator.append(1585934985999, value=6) # too late
+            assert serie.payload() == ("1585934985000000// value_last{} 3.0\n"
+                                       "1585934985000000// value_count{} 3\n")
+        assert mock_send_capture == [b"1585934985000000// value_last{} 3.0\n"
+                                     b"1585934985000000// value_count{} 3\n"
+                                     b"1585934986000000// value_last{} 5.0\n"
+                                     b"1585934986000000// value_count{} 2\n"]
+        assert aggregator.stats() == {'points': 6, 'late': 1, 'windows': 2, 'open': 0}
+
+    def test_invalid(self):
+        serie = Ingester(Client('warp10', 'http://localhost/api/v0'))
+        with pytest.raises(ValueError):
+            Aggregator(serie, window=1000, functions=('median',))
+        with pytest.raises(ValueError):
+            Aggregator(serie, window=0)
+        aggregator = Aggregator(serie, window=1000)
+        with pytest.raises(ValueError):
+            aggregator.append(1585934985000, value='ok')
+        with pytest.raises(ValueError):
+            aggregator.append(1585934985000, value=True)
+
+class TestMultiIngester:
+    """Fan-out to several backends"""
+
+    @staticmethod
+    def clients(url):
+        return {'influx': Client('influx', url, database='metrics'),
+                'warp10': Client('warp10', url + '/api/v0', token='TOKEN')}
+
+    def test_routing(self):
+        multi = MultiIngester(self.clients('http://localhost'), senders=0,
+                              routes={'warp10': {'measurement': ('cpu', 'mem'), 'tags': {'dc': 'eu'}}})
+        multi.append(1585934985000, tags={'dc': 'eu'}, measurement='cpu', user=0.5, state='up')
+        multi.append(1585934986000, tags={'dc': 'us'}, measurement='cpu', user=0.25)
+        multi.append(1585934987000, tags={'dc': 'eu'}, measurement='disk', used=10)
+        multi.append_columns([1585934988000, 1585934989000], tags={'dc': 'eu'}, measurement='mem', used=[1, 2])
+        assert multi.ingesters['influx'].payload() == (
+            'cpu,dc=eu user=0.5,state="up" 1585934985000000000\n'
+            'cpu,dc=us user=0.25 1585934986000000000\n'
+            'disk,dc=eu used=10i 1585934987000000000\n'
+            'mem,dc=eu used=1i 1585934988000000000\n'
+            'mem,dc=eu used=2i 1585934989000000000\n')
+        assert multi.ingesters['warp10'].payload() == (
+            "1585934985000000// cpu.user{dc=eu} 0.5\n"
+            "1585934985000000// cpu.state{dc=eu} 'up'\n"
+            "1585934988000000// mem.used{dc=eu} 1\n"
+            "1585934989000000// mem.used{dc=eu} 2\n")
+        multi.purge()
+
+    def test_validated_once(self):
+        multi = MultiIngester(self.clients('http://localhost'), senders=0,
+                              routes={'warp10': lambda measurement, tags: measurement == 'cpu'})
+        multi.append(measurement='cpu', user=1)
+        influx = multi.ingesters['influx'].payload()
+        warp10 = multi.ingesters['warp10'].payload()
+        # timestamped once: the same point in both backends
+        assert influx.split()[-1] == warp10.split('//')[0] + '000'
+        multi.purge()
+        for kwargs in ({'timestamp': 1.5}, {'tags': ['dc']}, {'measurement': 1}, {'value': [1]}):
+            with pytest.raises(ValueError):
+                multi.append(**dict({'value': 1}, **kwargs))
+        # invalid points are written to no backend
+        assert multi.ingesters['influx'].length() == 0
+        assert multi.ingesters['warp10'].length() == 0
+        # backend options update the shared ones
+        multi = MultiIngester(self.clients('http://localhost'), batch=10, options={'warp10': {'batch': 20}})
+        assert multi.ingesters['warp10']._batch == 20
+        assert multi.ingesters['warp10']._sender is not None
+        assert multi.ingesters['influx']._batch == 10
+        multi.close()
+        with pytest.raises(ValueError):
+            MultiIngester(self.clients('http://localhost'), routes={'other': {}})
+        with pytest.raises(ValueError):
+            MultiIngester(self.clients('http://localhost'), routes={'influx': {'host': 'a'}})
+
+    def test_isolation(self, http_server):
+        http_server.status = lambda body: 400 if body.startswith(b'158') else 204 # warp10 fails
+        multi = MultiIngester(self.clients(http_server.url), batch=2, retry=RetryPolicy(max_attempts=1))
+        for timestamp in range(1585934985000, 1585934991000, 1000):
+            multi.append(timestamp, value=1)
+        with pytest.raises(requests.RequestException):
+            multi.commit()
+        assert not multi.errors
+        stats = multi.stats()
+        assert stats['influx']['successes'] == 3
+        assert stats['influx']['values'] == 6
+        assert stats['warp10']['successes'] == 0
+        assert stats['warp10']['rejected'] > 0
+        http_server.status = 204
+        multi.append(1585934991000, value=1)
+        multi.close()
+        assert multi.stats()['warp10']['successes'] == 1
+        assert sum(1 for request in http_server.requests if request['path'].startswith('/write')) == 4
+
+class TestBackground:
+    """A set of tests with the background sender"""
+
+    @pytest.fixture
+    def mock_send_blocked(self, monkeypatch):
+        """Session.send() mocked to wait for an event, then return HTTP 200"""
+        started = threading.Event()
+        release = threading.Event()
+        bodies = []
+
+        def mock_send(self, request, **kwargs):
+            started.set()
+            release.wait()
+            bodies.append(request.body)
+            response = requests.Response()
+            response.status_code = 200
+            return response
+
+        monkeypatch.setattr(requests.sessions.Session, 'send', mock_send)
+        return started, release, bodies
+
+    @pytest.mark.parametrize('senders', [1, 3])
+    def test_commit(self, senders, mock_send_capture):
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        with Ingester(backend, batch=2, senders=senders) as serie:
+            for i in range(7):
+                serie.append(1585934985000+i, name=i)
+            serie.commit()
+            assert serie.length() == 0
+            assert serie.queue_depth() == 0
+            assert len(mock_send_capture) == 4
+            assert serie._report['successes'] == 4
+        assert sorted(b''.join(mock_send_capture).splitlines()) == [
+            "data name={}i {}".format(i, 1585934985000000000+i*1000000).encode() for i in range(7)]
+
+    def test_max_errors(self, mock_send_ko):
+        backend = Client('warp10', 'http://localhost/api/v0')
+        serie = Ingester(backend, batch=1, senders=1)
+        serie.append(timestamp=1585934985000, name=1)
+        with pytest.raises(MaxErrorsException):
+            serie.commit()
+        assert serie._report['commits'] == 1
+        assert serie._report['retries'] == Ingester.MAX_ERRORS - 1
+        assert serie._report['dropped'] == 1
+        serie.close()
+
+    def test_backpressure_raise(self, mock_send_blocked):
+        started, release, bodies = mock_send_blocked
+        backend = Client('warp10', 'http://localhost/api/v0')
+        serie = Ingester(backend, batch=1, senders=1, queue_size=1, backpressure='raise')
+        serie.append(timestamp=1585934985000, name=1) # in flight
+        started.wait()
+        serie.append(timestamp=1585934986000, name=2) # queued
+        with pytest.raises(QueueFullException):
+            serie.append(timestamp=1585934987000, name=3)
+        release.set()
+        serie.close()
+        assert len(bodies) == 2
+
+    def test_backpressure_drop_oldest(self, mock_send_blocked):
+        started, release, bodies = mock_send_blocked
+        backend = Client('warp10', 'http://localhost/api/v0')
+        serie = Ingester(backend, batch=1, senders=1, queue_size=1, backpressure='drop_oldest')
+        serie.append(timestamp=1585934985000, name=1) # in flight
+        started.wait()
+        serie.append(timestamp=1585934986000, name=2) # dropped
+        serie.append(timestamp=1585934987000, name=3)
+        release.set()
+        serie.close()
+        assert bodies == [b"1585934985000000// name{} 1\n", b"1585934987000000// name{} 3\n"]
+        assert serie._report['dropped'] == 1
+
+class TestShards:
+    """A set of tests with sharded commits, against a local HTTP server"""
+
+    def test_split_lines(self):
+        data = b"a 1\nb 2\n=3\n=4\nc 5\nd 6\n"
+        assert split_lines(data, 1) == [data]
+        assert split_lines(data, 3) == [b"a 1\nb 2\n=3\n=4\n", b"c 5\n", b"d 6\n"]
+        assert split_lines(data, 100) == [b"a 1\n", b"b 2\n=3\n=4\n", b"c 5\n", b"d 6\n"]
+        assert split_lines(b"", 4) == [b""]
+
+    @pytest.mark.parametrize('compression', [None, 'gzip'])
+    def test_commit(self, compression, http_server):
+        backend = Client('influx', http_server.url, database='metrics', pool_maxsize=4,
+                         compression=compression)
+        with Ingester(backend, shards=4) as serie:
+            for i in range(1000):
+                serie.append(1585934985000+i, name=i)
+            serie.commit()
+            assert serie.length() == 0
+        assert len(http_server.requests) == 4
+        bodies = [req['body'] for req in http_server.requests]
+        if compression:
+            bodies = [zlib.decompress(body, 31) for body in bodies]
+        assert all(body.endswith(b"\n") for body in bodies)
+        assert sorted(b''.join(bodies).splitlines()) == sorted(
+            "data name={}i {}".format(i, 1585934985000000000+i*1000000).encode()
+            for i in range(1000))
+        assert serie._report['shards'] == 4
+        assert serie._report['successes'] == 1
+        assert serie._report['bytes'] == sum(map(len, bodies))
+
+    def test_partial_failure(self, http_server):
+        failures = []
+        def status(body):
+            if b"name=500i" in body and not failures:
+                failures.append(body)
+                return 503
+            return 204
+        http_server.status = status
+        backend = Client('influx', http_server.url, database='metrics', pool_maxsize=4)
+        serie = Ingester(backend, shards=4)
+        for i in range(1000):
+            serie.append(1585934985000+i, name=i)
+        with pytest.raises(requests.exceptions.HTTPError):
+            serie.commit()
+        assert serie.length() == len(failures[0].splitlines())
+        assert serie.payload().encode() == failures[0]
+        serie.commit()
+        assert serie.length() == 0
+        assert len(http_server.requests) == 5
+        assert http_server.requests[-1]['body'] == failures[0]
+        assert serie._report['shards'] == 4
+        assert serie._report['shards_failed'] == 1
+        serie.close()
+
+    def test_pool_size(self, http_server):
+        def pool_size(backend):
+            adapter = backend._session.get_adapter(http_server.url)
+            return adapter.poolmanager.connection_pool_kw['maxsize']
+        backend = Client('influx', http_server.url, database='metrics')
+        Ingester(backend, shards=4).close()
+        assert backend.pool_maxsize is None
+        Ingester(backend, shards=16).close()
+        assert backend.pool_maxsize == 16
+        assert pool_size(backend) == 16
+        backend = Client('influx', http_server.url, database='metrics', pool_maxsize=32)
+        serie = Ingester(backend, shards=16)
+        assert pool_size(backend) == 32
+        for i in range(1000):
+            serie.append(1585934985000+i, name=i)
+        serie.close()
+        assert len(http_server.requests) == 16
+
+    def test_max_errors(self, http_server):
+        http_server.status = 500
+        backend = Client('warp10', http_server.url)
+        serie = Ingester(backend, batch=2, shards=2)
+        serie.append(timestamp=1585934985000, name=1, other=2)
+        serie.append(timestamp=1585934986000, name=3)
+        assert serie.length() == 3
+        with pytest.raises(MaxErrorsException):
+            serie.append(timestamp=1585934987000, name=4)
+        assert serie.length() == 4
+        serie.purge()
+        serie.close()
+
+class TestRetry:
+    """A set of tests with retry policies, against a local HTTP server"""
+
+    @pytest.fixture
+    def sleeps(self, monkeypatch):
+        """Clock of the retry module mocked: sleep() records delays and advances the clock"""
+        delays = []
+
+        class Clock:
+            """time module stand-in"""
+            now = 1000.0
+            time = time.time
+
+            @classmethod
+            def monotonic(cls):
+                return cls.now
+
+            @classmethod
+            def sleep(cls, delay):
+                delays.append(delay)
+                cls.now += delay
+
+        monkeypatch.setattr(retry, 'time', Clock)
+        return delays
+
+    @staticmethod
+    def statuses(*statuses):
+        """Return successive statuses, then 204"""
+        statuses = list(statuses)
+        return lambda body: statuses.pop(0) if statuses else 204
+
+    def test_backoff(self):
+        policy = RetryPolicy(backoff_base=1, backoff_max=5, jitter=False)
+        assert [policy.backoff(attempt) for attempt in range(1, 6)] == [1, 2, 4, 5, 5]
+        policy = RetryPolicy(backoff_base=1, backoff_max=5)
+        assert all(0 <= policy.backoff(attempt) <= 5 for attempt in range(1, 20))
+
+    def test_retry_after(self):
+        response = requests.Response()
+        error = requests.exceptions.HTTPError(response=response)
+        assert RetryPolicy.retry_after(error) is None
+        response.headers['Retry-After'] = '120'
+        assert RetryPolicy.retry_after(error) == 120
+        response.headers['Retry-After'] = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        assert RetryPolicy.retry_after(error) == 0
+        assert RetryPolicy(backoff_base=0.1, jitter=False).backoff(1, error) == 0.1
+        response.headers['Retry-After'] = '120'
+        assert RetryPolicy(backoff_base=0.1, jitter=False).backoff(1, error) == 120
+
+    def test_retry(self, http_server, sleeps):
+        http_server.status = self.statuses(503, 500)
+        backend = Client('influx', http_server.url, database='metrics',
+                         retry=RetryPolicy(backoff_base=0.1, jitter=False))
+        serie = Ingester(backend)
+        serie.append(1585934985000, name=1)
+        serie.commit()
+        assert [req['status'] for req in http_server.requests] == [503, 500, 204]
+        assert sleeps == [0.1, 0.2]
+        assert serie._report['retries'] == 2
+        assert serie._report['backoff_time'] == pytest.approx(0.3)
+        assert serie.length() == 0
+
+    def test_retry_after_header(self, http_server, sleeps):
+        http_server.status = self.statuses(429)
+        http_server.headers['Retry-After'] = '7'
+        backend = Client('influx', http_server.url, database='metrics')
+        serie = Ingester(backend, retry=RetryPolicy(backoff_base=0.1))
+        serie.append(1585934985000, name=1)
+        serie.commit()
+        assert sleeps == [7]
+
+    def test_rejected(self, http_server, sleeps):
+        http_server.status = 400
+        backend = Client('influx', http_server.url, database='metrics')
+        serie = Ingester(backend, batch=10, retry=RetryPolicy())
+        serie.append(1585934985000, name=1)
+        with pytest.raises(requests.exceptions.HTTPError):
+            serie.commit()
+        assert len(http_server.requests) == 1
+        assert not sleeps
+        assert serie.length() == 0
+        assert serie._report['rejected'] == 1
+
+    @pytest.mark.parametrize('policy, attempts', [
+        (RetryPolicy(max_attempts=4, backoff_base=0.1), 4),
+        (RetryPolicy(max_attempts=10, backoff_base=0.1, jitter=False, deadline=0.5), 3),
+    ], ids=['attempts', 'deadline'])
+    def test_max_errors(self, policy, attempts, http_server, sleeps):
+        http_server.status = 503
+        backend = Client('influx', http_server.url, database='metrics')
+        serie = Ingester(backend, batch=10, retry=policy)
+        serie.append(1585934985000, name=1)
+        with pytest.raises(MaxErrorsException):
+            serie.commit()
+        assert len(http_server.requests) == attempts
+        assert serie.length() == 1
+        serie.purge()
+
+    def test_background(self, http_server, sleeps):
+        http_server.status = self.statuses(503, 400)
+        backend = Client('warp10', http_server.url)
+        serie = Ingester(backend, batch=1, senders=1, retry=RetryPolicy(backoff_base=0.1))
+        serie.append(1585934985000, name=1)
+        with pytest.raises(requests.exceptions.HTTPError):
+            serie.commit()
+        assert len(sleeps) == 1
+        assert serie._report['rejected'] == 1
+        serie.append(1585934986000, name=2)
+        serie.close()
+        assert serie._report['successes'] == 1
+
+class TestSpool:
+    """A set of tests with an on-disk spool, against a local HTTP server"""
+
+    def test_segments(self, tmp_path):
+        spool = Spool(str(tmp_path), fsync=False)
+        first = spool.push(b"a 1\n", 1)
+        second = spool.push(b"compressed", 2, 'gzip')
+        assert spool.segments() == [first, second]
+        assert Spool.parse(first) == (1, None)
+        assert Spool.parse(second) == (2, 'gzip')
+        assert spool.read(first) == b"a 1\n"
+        assert spool.depth() == {'segments': 2, 'bytes': 14}
+        spool.remove(first)
+        assert Spool(str(tmp_path)).push(b"b 2\n", 1) > second # sequence resumed
+
+    def test_expire(self, tmp_path):
+        spool = Spool(str(tmp_path), fsync=False, max_bytes=10)
+        for i in range(4):
+            spool.push(b"abcd", i + 1)
+        assert [Spool.parse(name)[0] for name in spool.segments()] == [3, 4]
+        assert spool.dropped == 3
+        spool.push(b"x" * 100, 5) # the newest segment is always kept
+        assert [Spool.parse(name)[0] for name in spool.segments()] == [5]
+        spool = Spool(str(tmp_path), fsync=False, max_age=3600)
+        old = spool.segments()[0]
+        os.utime(str(tmp_path / old), (time.time() - 7200,) * 2)
+        spool.push(b"abcd", 6)
+        assert [Spool.parse(name)[0] for name in spool.segments()] == [6]
+        assert spool.dropped == 5
+
+    def test_replay(self, http_server, tmp_path):
+        http_server.status = 503
+        spool = Spool(str(tmp_path), fsync=False)
+        backend = Client('influx', http_server.url, database='metrics')
+        serie = Ingester(backend, retry=RetryPolicy(max_attempts=1), spool=spool)
+        serie.append(1585934985000, name=1)
+        with pytest.raises(MaxErrorsException):
+            serie.commit()
+        assert serie.length() == 0
+        assert len(spool.segments()) == 1
+        serie.append(1585934986000, name=2)
+        with pytest.raises(MaxErrorsException):
+            serie.commit() # replay failed, the new payload is spooled as well
+        assert len(http_server.requests) == 2
+        assert len(spool.segments()) == 2
+        http_server.status = 204
+        serie.append(1585934987000, name=3)
+        serie.commit()
+        assert [req['body'] for req in http_server.requests[2:]] == [
+            b"data name=1i 1585934985000000000\n", b"data name=2i 1585934986000000000\n",
+            b"data name=3i 1585934987000000000\n"]
+        assert not spool.segments()
+        assert serie._report['spooled'] == 2
+        assert serie._report['replayed'] == 2
+        assert serie._report['successes'] == 1
+
+    @pytest.mark.parametrize('use_mmap', [False, True], ids=['read', 'mmap'])
+    def test_replay_encoding(self, use_mmap, http_server, tmp_path):
+        spool = Spool(str(tmp_path), fsync=False, use_mmap=use_mmap)
+        spool.push(zlib.compress(b"data name=1 1585934985000000000\n"), 1, 'deflate')
+        spool.push(b"data name=2 1585934986000000000\n", 1)
+        serie = Ingester(Client('influx', http_server.url, database='metrics',
+                                compression='deflate'), spool=spool)
+        assert serie.replay()
+        assert zlib.decompress(http_server.requests[0]['body']) == b"data name=1 1585934985000000000\n"
+        assert zlib.decompress(http_server.requests[1]['body']) == b"data name=2 1585934986000000000\n"
+        assert all(req['headers']['Content-Encoding'] == 'deflate' for req in http_server.requests)
+        assert serie._report['replayed'] == 2
+
+    def test_replay_rejected(self, http_server, tmp_path):
+        http_server.status = 400
+        spool = Spool(str(tmp_path), fsync=False)
+        spool.push(b"invalid\n", 1)
+        serie = Ingester(Client('influx', http_server.url, database='metrics'), spool=spool)
+        assert serie.replay()
+        assert not spool.segments()
+        assert serie._report['rejected'] == 1
+
+    def test_write_ahead(self, http_server, tmp_path):
+        spool = Spool(str(tmp_path), fsync=False, write_ahead=True)
+        backend = Client('influx', http_server.url, database='metrics')
+        serie = Ingester(backend, spool=spool)
+        serie.append(1585934985000, name=1)
+        serie.commit()
+        assert not spool.segments()
+        http_server.status = 500
+        serie.append(1585934986000, name=2)
+        with pytest.raises(requests.exceptions.HTTPError):
+            serie.commit()
+        assert serie.length() == 0
+        assert len(spool.segments()) == 1
+        with pytest.raises(ValueError):
+            Ingester(backend, shards=2, spool=spool)
+
+    def test_write_ahead_in_flight(self, http_server, tmp_path):
+        spool = Spool(str(tmp_path), fsync=False, write_ahead=True, drain_interval=0.001)
+        serie = Ingester(Client('influx', http_server.url, database='metrics'), batch=1, senders=1, spool=spool)
+        for timestamp in range(1585934985000, 1585934990000, 1000):
+            serie.append(timestamp, name=1)
+        serie.close()
+        # batches queued or being sent are not replayed by the sender nor by the drainer
+        assert len(http_server.requests) == 5
+        assert serie._report['replayed'] == 0
+        assert serie._report['successes'] == 5
+        assert not spool.segments()
+
+    def test_background(self, http_server, tmp_path):
+        http_server.status = 503
+        spool = Spool(str(tmp_path), fsync=False)
+        backend = Client('warp10', http_server.url)
+        serie = Ingester(backend, batch=1, senders=1, spool=spool)
+        serie.append(1585934985000, name=1)
+        with pytest.raises(MaxErrorsException):
+            serie.commit()
+        assert len(spool.segments()) == 1
+        assert serie._report['dropped'] == 0
+        http_server.status = 200
+        serie.append(1585934986000, name=2)
+        serie.close()
+        assert not spool.segments()
+        assert serie._report['replayed'] == 1
+        assert serie._report['successes'] == 1
+
+    def test_close(self, http_server, tmp_path):
+        http_server.status = 503
+        spool = Spool(str(tmp_path), fsync=False)
+        serie = Ingester(Client('warp10', http_server.url), batch=10, spool=spool)
+        serie.append(1585934985000, name=1)
+        serie.close()
+        assert len(spool.segments()) == 1
+        assert serie.length() == 0
+
+    def test_drain(self, http_server, tmp_path):
+        spool = Spool(str(tmp_path), fsync=False, drain_interval=0.05)
+        spool.push(b"1585934985000000// data{} 1\n", 1)
+        serie = Ingester(Client('warp10', http_server.url), spool=spool)
+        for _ in range(100):
+            if not spool.segments():
+                break
+            time.sleep(0.05)
+        serie.close()
+        assert not spool.segments()
+        assert len(http_server.requests) == 1
+
 class TestWarp10:
     """A set of tests with Warp10 as backend"""
 
@@ -153,6 +1618,63 @@ class TestWarp10:
         assert request.body == "1585934895000000// name{} 'value'\n"
 
 
+    def test_condensed(self):
+        backend = Client('warp10', 'http://localhost/api/v0')
+        serie = Ingester(backend, condensed=True)
+        serie.append(1585934985000, tags={'tag1': 'tval1'}, name=42)
+        serie.append(1585934986000, tags={'tag1': 'tval1'}, name=43)
+        serie.append(1585934987000, tags={'tag1': 'tval1'}, name=44, other='value')
+        serie.append(1585934988000, tags={'tag1': 'tval1'}, other=True)
+        assert serie.payload() == ("1585934985000000// name{tag1=tval1} 42\n"
+                                   "=1585934986000000// 43\n"
+                                   "=1585934987000000// 44\n"
+                                   "1585934987000000// other{tag1=tval1} 'value'\n"
+                                   "=1585934988000000// T\n")
+        assert serie.length() == 5
+
+    def test_condensed_reorder(self, mock_send_capture):
+        backend = Client('warp10', 'http://localhost/api/v0')
+        serie = Ingester(backend, batch=6, reorder=True)
+        serie.append_columns([1585934985000, 1585934986000, 1585934987000], measurement='mes',
+                             cpu=[1.0, 2.0, 3.0], mem=[4, 5, 6])
+        assert mock_send_capture == [b"1585934985000000// mes.cpu{} 1.0\n"
+                                     b"=1585934986000000// 2.0\n"
+                                     b"=1585934987000000// 3.0\n"
+                                     b"1585934985000000// mes.mem{} 4\n"
+                                     b"=1585934986000000// 5\n"
+                                     b"=1585934987000000// 6\n"]
+        assert serie._report['series'] == 6
+
+    def test_reorder_accessors(self):
+        backend = Client('warp10', 'http://localhost/api/v0')
+        serie = Ingester(backend, reorder=True)
+        serie.append(1585934985000, measurement='mes', cpu=1.0)
+        assert serie.payload() == "1585934985000000// mes.cpu{} 1.0\n"
+        assert serie.size() == len(serie.payload())
+        serie.append(1585934986000, measurement='mes', cpu=2.0)
+        assert serie.payload() == "1585934985000000// mes.cpu{} 1.0\n=1585934986000000// 2.0\n"
+        serie.purge()
+
+    def test_condensed_size(self):
+        backend = Client('warp10', 'http://localhost/api/v0')
+        sizes = {}
+        for mode in ('default', 'condensed', 'reorder'):
+            serie = Ingester(backend, condensed=mode == 'condensed', reorder=mode == 'reorder')
+            for i in range(1000):
+                serie.append(1585934985000+i, measurement='system',
+                             tags={'host': 'server01', 'dc': 'eu-west-1'}, cpu=0.5, mem=1024,
+                             load=1.5)
+            sizes[mode] = serie.size()
+            serie.purge()
+        assert sizes['condensed'] == sizes['default']
+        assert sizes['reorder'] * 2 < sizes['default']
+
+    def test_condensed_influx(self):
+        backend = Client('influx', 'http://localhost:8086', database='metrics')
+        with pytest.raises(ValueError):
+            Ingester(backend, condensed=True)
+
+
 class TestInflux:
     """A set of tests with InfluxDB as backend"""
 
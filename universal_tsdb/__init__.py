@@ -1,8 +1,18 @@
 """Initialize the universal_tsdb package."""
 
-from .metrics import Client, Ingester
-from .exceptions import MaxErrorsException
+from .aggregate import Aggregator
+from .backends import Backend
+from .client import Client
+from .metrics import Ingester
+from .fanout import MultiIngester
+from .aio import AsyncClient, AsyncIngester
+from .exceptions import MaxErrorsException, QueryException, QueueFullException
+from .query import QueryCache
+from .retry import RetryPolicy
+from .spool import Spool
 
 __all__ = [
-    'Client', 'Ingester', 'MaxErrorsException'
+    'Aggregator', 'Backend', 'Client', 'Ingester', 'MultiIngester', 'AsyncClient', 'AsyncIngester',
+    'RetryPolicy', 'Spool', 'QueryCache', 'MaxErrorsException', 'QueryException',
+    'QueueFullException'
 ]
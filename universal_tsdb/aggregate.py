@@ -0,0 +1,157 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Client-side pre-aggregation: tumbling windows per series"""
+
+import array
+import heapq
+import itertools
+import threading
+from .metrics import Ingester
+
+FUNCTIONS = ('min', 'max', 'mean', 'sum', 'count', 'last')
+# accumulator of a field: count, sum, min, max, last value, timestamp of the last value
+_COUNT, _SUM, _MIN, _MAX, _LAST, _LAST_TS = range(6)
+_STRIDE = 6
+
+
+class _Series: # pylint: disable=too-few-public-methods
+    """Open windows of a series: one array of accumulators per window start"""
+
+    __slots__ = ('measurement', 'tags', 'slots', 'windows')
+
+    def __init__(self, measurement, tags):
+        self.measurement = measurement
+        self.tags = tags
+        self.slots = {} # field name -> index of its accumulator
+        self.windows = {}
+
+
+class Aggregator:
+    """Ingester wrapper aggregating the numeric fields of each series over tumbling windows
+    of `window` ms (aligned on the epoch), with the `functions` (see FUNCTIONS).
+    A window is emitted, as one point per series timestamped at the start of the window
+    and with a `<field>_<function>` field per function, once a point at least `grace` ms
+    past its end has been appended. Points of an emitted window are dropped (as late)."""
+
+    def __init__(self, ingester, window, functions=('mean',), grace=0):
+        if window <= 0:
+            raise ValueError("Invalid window")
+        if grace < 0:
+            raise ValueError("Invalid grace period")
+        for function in functions:
+            if function not in FUNCTIONS:
+                raise ValueError("Unsupported function: {}".format(function))
+        if not functions:
+            raise ValueError("No function")
+        self.ingester = ingester
+        self.window = window
+        self.grace = grace
+        self.functions = tuple(functions)
+        self._series = {}
+        self._closing = [] # heap of (window end, sequence, series key, window start)
+        self._sequence = itertools.count()
+        self._watermark = None # latest timestamp appended
+        self._report = {'points': 0, 'late': 0, 'windows': 0}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, timestamp=None, tags=None, measurement=None, **kwargs):
+        """Add a point to the window of its series, emit the windows it closes"""
+        # pylint: disable=protected-access
+        timestamp = Ingester._check_point(timestamp, tags, measurement)
+        for key, val in kwargs.items():
+            if isinstance(val, bool) or not isinstance(val, (int, float)):
+                raise ValueError("Invalid or unsupported value (key: {})".format(key))
+        with self._lock:
+            self._report['points'] += 1
+            start = timestamp - timestamp % self.window
+            if self._watermark is not None and start + self.window + self.grace <= self._watermark:
+                self._report['late'] += 1
+                return
+            key = (measurement, tuple(sorted(tags.items())) if tags else ())
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(measurement, dict(tags) if tags else None)
+            accumulators = series.windows.get(start)
+            if accumulators is None:
+                accumulators = series.windows[start] = array.array(
+                    'd', _empty() * len(series.slots))
+                heapq.heappush(self._closing,
+                               (start + self.window, next(self._sequence), key, start))
+            for name, val in kwargs.items():
+                slot = series.slots.get(name)
+                if slot is None:
+                    slot = series.slots[name] = len(series.slots)
+                if len(accumulators) <= slot * _STRIDE:
+                    accumulators.extend(_empty() * (slot + 1 - len(accumulators) // _STRIDE))
+                _accumulate(accumulators, slot * _STRIDE, val, timestamp)
+            if self._watermark is None or timestamp > self._watermark:
+                self._watermark = timestamp
+                self._emit(self._watermark - self.grace)
+
+    def _emit(self, until):
+        """Emit the windows ending at or before `until` (None: all windows)"""
+        while self._closing and (until is None or self._closing[0][0] <= until):
+            _, _, key, start = heapq.heappop(self._closing)
+            series = self._series[key]
+            accumulators = series.windows.pop(start)
+            fields = {}
+            for name, slot in series.slots.items():
+                offset = slot * _STRIDE
+                if offset >= len(accumulators) or not accumulators[offset + _COUNT]:
+                    continue
+                for function in self.functions:
+                    fields[name + '_' + function] = _result(accumulators, offset, function)
+            if not series.windows:
+                del self._series[key]
+            self._report['windows'] += 1
+            self.ingester.append(start, tags=series.tags, measurement=series.measurement,
+                                 **fields)
+
+    def flush(self):
+        """Emit all the open windows"""
+        with self._lock:
+            self._emit(None)
+
+    def close(self):
+        """Emit all the open windows and commit the ingester"""
+        self.flush()
+        self.ingester.commit()
+
+    def stats(self):
+        """Return the counters: points appended, late points dropped, windows emitted,
+        and open windows"""
+        with self._lock:
+            stats = dict(self._report)
+            stats['open'] = len(self._closing)
+        return stats
+
+
+def _empty():
+    return [0.0, 0.0, float('inf'), float('-inf'), 0.0, float('-inf')]
+
+
+def _accumulate(accumulators, offset, val, timestamp):
+    accumulators[offset + _COUNT] += 1
+    accumulators[offset + _SUM] += val
+    if val < accumulators[offset + _MIN]:
+        accumulators[offset + _MIN] = val
+    if val > accumulators[offset + _MAX]:
+        accumulators[offset + _MAX] = val
+    if timestamp >= accumulators[offset + _LAST_TS]:
+        accumulators[offset + _LAST] = val
+        accumulators[offset + _LAST_TS] = timestamp
+
+
+def _result(accumulators, offset, function):
+    if function == 'count':
+        return int(accumulators[offset + _COUNT])
+    if function == 'mean':
+        return accumulators[offset + _SUM] / accumulators[offset + _COUNT]
+    return accumulators[offset + {'min': _MIN, 'max': _MAX, 'sum': _SUM,
+                                  'last': _LAST}[function]]
@@ -0,0 +1,256 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""asyncio Client and Ingester (requires aiohttp)"""
+
+import asyncio
+import time
+import requests
+from . import readers, trace
+from .client import Client
+from .metrics import Ingester
+
+try:
+    import aiohttp
+except ImportError: # pragma: no cover
+    aiohttp = None
+
+
+class AsyncClient(Client):
+    """Multi-backend abstraction class, sending over asyncio.
+    At most `max_in_flight` write requests are sent concurrently,
+    over a pool of reused connections."""
+
+    DEFAULT_MAX_IN_FLIGHT = 4
+    # headers computed by aiohttp itself
+    _SKIPPED_HEADERS = ('Content-Length', 'Connection')
+
+    def __init__(self, protocol, url, max_in_flight=DEFAULT_MAX_IN_FLIGHT, **kwargs):
+        if aiohttp is None:
+            raise ImportError("aiohttp is required: pip install universal_tsdb[async]")
+        if max_in_flight < 1:
+            raise ValueError("Invalid number of in-flight requests")
+        super().__init__(protocol, url, **kwargs)
+        self.max_in_flight = max_in_flight
+        self._aio_session = None
+        self._in_flight = None
+
+    def _get_session(self):
+        """Return the aiohttp session, created in the running event loop"""
+        if self._aio_session is None or self._aio_session.closed:
+            self._aio_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+                timeout=aiohttp.ClientTimeout(sock_connect=3.05, sock_read=self._timeout))
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        return self._aio_session
+
+    # a coroutine, unlike Client.send()
+    async def send(self, prepped): # pylint: disable=invalid-overridden-method
+        """Send to backend.
+        Errors are raised as requests' exceptions, like Client.send()"""
+        session = self._get_session()
+        headers = {key: val for key, val in prepped.headers.items()
+                   if key not in self._SKIPPED_HEADERS}
+        async with self._in_flight:
+            try:
+                async with session.request(prepped.method, prepped.url, headers=headers,
+                                           data=prepped.body) as response:
+                    content = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                raise requests.exceptions.ConnectionError(err) from err
+        if response.status >= 400:
+            # requests' Response, for error handling and retry policies
+            resp = requests.Response()
+            resp.status_code = response.status
+            resp.reason = response.reason
+            resp.url = str(response.url)
+            resp.headers.update(response.headers)
+            resp._content = content # pylint: disable=protected-access
+            trace.LOGGER.debug("%s", trace.Exchange(prepped, resp, self.trace_lines))
+            raise requests.exceptions.HTTPError("{} Error: {} for url: {}".format(
+                response.status, response.reason, response.url), response=resp)
+
+    async def close(self):
+        """Close the connection pool"""
+        if self._aio_session is not None:
+            await self._aio_session.close()
+            self._aio_session = None
+
+
+class AsyncIngester(Ingester):
+    """Ingester class for AsyncClient: append(), append_columns() and commit() are coroutines.
+    Full batches are sent in background tasks, up to client.max_in_flight at once."""
+    # the entry points and _flush() are coroutines, overriding the sync ones of Ingester:
+    # the sync entry points which are not overridden raise TypeError
+    # pylint: disable=invalid-overridden-method
+
+    def __init__(self, client, batch=0, condensed=False, reorder=False, retry=None,
+                 max_bytes=None, on_append=None, on_commit_start=None, on_commit_end=None,
+                 compact=None, compact_size=Ingester.COMPACT_SIZE):
+        # the options of Ingester (see README.md)
+        # pylint: disable=too-many-arguments
+        super().__init__(client, batch, condensed=condensed, reorder=reorder, retry=retry,
+                         max_bytes=max_bytes, on_append=on_append,
+                         on_commit_start=on_commit_start, on_commit_end=on_commit_end,
+                         compact=compact, compact_size=compact_size)
+        self._pending = set()
+        self._error = None
+
+    def __enter__(self):
+        raise TypeError("AsyncIngester does not support with: use async with")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def append(self, timestamp=None, tags=None, measurement=None, **kwargs):
+        """Write a new point"""
+        await self._point(timestamp, tags, measurement, kwargs)
+
+    async def _point(self, timestamp, tags, measurement, fields, checked=False):
+        trigger = self._add_point(timestamp, tags, measurement, fields, checked)
+        if trigger is not None:
+            await self._flush(trigger)
+
+    def schema(self, measurement=None, tags_keys=(), fields=None):
+        """Return a writer (coroutine function) of points with a fixed shape:
+        await writer(timestamp, tag_values, *values)"""
+        encode = self._schema_encoder(measurement, tags_keys, fields)
+
+        async def writer(timestamp, tag_values, *values):
+            trigger = encode(timestamp, tag_values, *values)
+            if trigger is not None:
+                await self._flush(trigger)
+        return writer
+
+    async def append_columns(self, timestamps, tags=None, measurement=None, **kwargs):
+        """Write a block of points sharing the same tags and measurement"""
+        start = time.perf_counter()
+        for trigger in self._write_columns(timestamps, tags, measurement, kwargs):
+            self._report['encode_time'] += time.perf_counter() - start
+            await self._flush(trigger)
+            start = time.perf_counter()
+        self._report['encode_time'] += time.perf_counter() - start
+        if self.on_append is not None:
+            self.on_append(len(timestamps))
+
+    async def ingest(self, records):
+        """Write a stream of points: an iterable or an asynchronous iterable
+        of records (see Ingester.ingest())"""
+        if hasattr(records, '__aiter__'):
+            async for record in records:
+                await self._point(record.get('timestamp'), record.get('tags'),
+                                  record.get('measurement'), record['fields'])
+            return
+        for record in records:
+            await self._point(record.get('timestamp'), record.get('tags'),
+                              record.get('measurement'), record['fields'])
+
+    async def ingest_file(self, path, file_format='csv', tags=(), fields=None, measurement=None,
+                          chunk_size=readers.CHUNK_SIZE):
+        """Write the points of a file (see Ingester.ingest_file()).
+        The file is read in the event loop, a chunk at a time"""
+        records = self._records(path, file_format, tags, fields, measurement)
+        if records is not None:
+            await self.ingest(records)
+            return
+        for chunk in readers.read_chunks(path, chunk_size):
+            start = time.perf_counter()
+            length = self._length
+            count = 0
+            for trigger in self._write_lines(chunk):
+                self._report['encode_time'] += time.perf_counter() - start
+                count += self._length - length
+                await self._flush(trigger)
+                start = time.perf_counter()
+                length = 0
+            self._report['encode_time'] += time.perf_counter() - start
+            if self.on_append is not None:
+                self.on_append(count + self._length - length)
+        trigger = self._full()
+        if trigger is not None:
+            await self._flush(trigger)
+
+    def ingest_parallel(self, *args, **kwargs):
+        """Not supported (TypeError): the payloads encoded by the worker processes are sent
+        by a blocking loop"""
+        raise TypeError("AsyncIngester does not support ingest_parallel()")
+
+    def _check(self):
+        """Raise (once) the first error encountered by the sending tasks"""
+        err, self._error = self._error, None
+        if err is not None:
+            raise err
+
+    def _done(self, task):
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None and self._error is None:
+            self._error = task.exception()
+
+    async def _flush(self, trigger='manual'):
+        """Send the current payload in a new task,
+        waiting while max_in_flight requests are pending.
+        A point held back by max_bytes is then written to the payload"""
+        try:
+            self._check()
+            self._trigger = trigger
+            while len(self._pending) >= self.client.max_in_flight:
+                done, _ = await asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    self._done(task)
+            task = asyncio.ensure_future(self._asend_batch(self._detach()))
+            self._pending.add(task)
+            task.add_done_callback(self._done)
+        finally:
+            self._write_carry()
+
+    async def _asend_batch(self, batch):
+        """Send a detached batch"""
+        buffer, length, timer_batch, _ = batch
+        data = buffer.getvalue()
+        prepped = self.client.prepare_request(data, compressed=buffer.compression is not None)
+        policy = self._default_policy()
+        self._report['commits'] += 1
+        if self.on_commit_start is not None:
+            self.on_commit_start(length, len(prepped.body))
+        start = time.perf_counter()
+        stats = {}
+        try:
+            await policy.acall(lambda: self._atimed_send(prepped), stats)
+        except requests.exceptions.RequestException as err:
+            if self.on_commit_end is not None:
+                self.on_commit_end('failed' if policy.is_retryable(err) else 'rejected',
+                                   time.perf_counter() - start, len(prepped.body))
+            self._abort(length, err, policy)
+        finally:
+            self._account_retries(stats)
+        if self.on_commit_end is not None:
+            self.on_commit_end('success', time.perf_counter() - start, len(prepped.body))
+        self._succeeded(length, timer_batch, len(buffer), len(data), buffer.compression_time)
+
+    async def _atimed_send(self, prepped):
+        """Send a request, account for its latency"""
+        start = time.perf_counter()
+        try:
+            await self.client.send(prepped)
+        finally:
+            self._observe(time.perf_counter() - start)
+
+    def queue_depth(self):
+        """Return the number of batches being sent"""
+        return len(self._pending)
+
+    async def commit(self):
+        """Send previous added points to backend and wait for all pending requests"""
+        if self._length > 0:
+            await self._flush()
+        if self._pending:
+            done, _ = await asyncio.wait(self._pending)
+            for task in done:
+                self._done(task)
+        self._check()
+
+    async def close(self):
+        """Commit the current payload"""
+        await self.commit()
@@ -0,0 +1,487 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Backend protocols: encoding and HTTP requests
+
+A backend is resolved once, when the Client is created: the Ingester calls its
+encoder directly, without comparing protocol names for every point.
+Backends are looked up by name in a registry, filled by register() and by the
+'universal_tsdb.backends' entry points of installed packages:
+
+    [options.entry_points]
+    universal_tsdb.backends =
+        opentsdb = mypackage.backend:OpenTSDBBackend
+"""
+
+import functools
+import json
+import logging
+import re
+import urllib.parse
+import requests
+from .exceptions import QueryException
+
+ESCAPE_CACHE_SIZE = 16384
+SERIES_CACHE_SIZE = 4096
+ENTRY_POINT_GROUP = 'universal_tsdb.backends'
+
+BACKENDS = {}
+
+
+def register(backend, name=None):
+    """Register a Backend class under its name (usable as a class decorator)"""
+    BACKENDS[name or backend.name] = backend
+    return backend
+
+
+def _entry_points():
+    try:
+        from importlib.metadata import entry_points # pylint: disable=import-outside-toplevel
+    except ImportError: # Python < 3.8
+        try:
+            import pkg_resources # pylint: disable=import-outside-toplevel
+        except ImportError:
+            return []
+        return pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)
+    points = entry_points()
+    if hasattr(points, 'select'):
+        return points.select(group=ENTRY_POINT_GROUP)
+    return points.get(ENTRY_POINT_GROUP, [])
+
+
+def get_backend(name):
+    """Return the Backend class registered (or declared as an entry point) for a protocol name"""
+    if isinstance(name, type) and issubclass(name, Backend):
+        return name
+    if name not in BACKENDS:
+        for entry_point in _entry_points():
+            if entry_point.name == name:
+                logging.debug("Loading %s backend from %s", name, entry_point.value
+                              if hasattr(entry_point, 'value') else entry_point)
+                register(entry_point.load(), name)
+                break
+        else:
+            raise ValueError("Unsupported backend: {}".format(name))
+    return BACKENDS[name]
+
+
+def column(values):
+    """Convert a column (list, tuple, NumPy array...) to a list of Python objects"""
+    if hasattr(values, 'tolist'):
+        return values.tolist()
+    return list(values)
+
+
+def scale_column(timestamps, factor):
+    """Scale a column of ms timestamps to the backend precision"""
+    dtype = getattr(timestamps, 'dtype', None)
+    if dtype is not None and dtype.kind in 'iu':
+        return (timestamps * factor).tolist()
+    timestamps = column(timestamps)
+    for timestamp in timestamps:
+        if not isinstance(timestamp, int):
+            raise ValueError('Invalid timestamp')
+    return [timestamp * factor for timestamp in timestamps]
+
+
+@functools.lru_cache(maxsize=ESCAPE_CACHE_SIZE)
+def _escape_warp10(value):
+    return urllib.parse.quote(value, safe='')
+
+
+@functools.lru_cache(maxsize=ESCAPE_CACHE_SIZE)
+def _escape_influx(value):
+    value = value.replace(
+        "\\", "\\\\"
+        ).replace(
+            " ", "\\ "
+            ).replace(
+                ",", "\\,"
+                ).replace(
+                    "=", "\\="
+                    ).replace(
+                        "\n", "\\n"
+                        ).replace(
+                            "'", "\\'"
+                            ).replace(
+                                "\"", "\\\""
+                                )
+    if value.endswith('\\'):
+        value += ' '
+    return value
+
+
+def _printf(fmt):
+    """Return the printf-style placeholder of a value format"""
+    if isinstance(fmt, dict): # booleans are converted by the caller
+        return '%s'
+    return fmt.replace('%', '%%').replace('{!s}', '%s').replace('{}', '%s')
+
+
+@functools.lru_cache(maxsize=SERIES_CACHE_SIZE)
+def _series_statement(backend, measurement, tag_keys, tag_values):
+    """Escaped series statement of a (measurement, tags) couple"""
+    return backend.statement(measurement, tag_keys, tag_values)
+
+
+class Backend:
+    """Backend base class: a protocol encoder and its HTTP request builder
+
+    Subclasses set `name`, `escape` (a str -> str function), `timestamp_factor`
+    (from ms to the backend precision) and `formats` (value formatting per type),
+    and implement statement(), encode() and request(), and for queries,
+    query_request() and decode().
+    Backends supporting continuation lines set `condensed` and implement values(),
+    line(), continuation() and expand().
+    `line_pattern` (a bytes regex), if set, validates pre-formatted lines."""
+
+    name = None
+    token_header = None
+    timestamp_factor = 1
+    condensed = False
+    formats = {str: '"{}"', bool: {True: 'T', False: 'F'}, int: '{}', float: '{!s}'}
+    escape = staticmethod(str)
+    line_pattern = None
+
+    def __init__(self, url, database=None, backend_auth=(None, None), token=None):
+        self.url = url
+        self.database = database
+        self.backend_auth = backend_auth
+        self.token = token
+        if token and self.token_header is None:
+            raise ValueError("Token authentification not supported for {} backend"
+                             .format(self.name))
+
+    def headers(self):
+        """Return the HTTP headers of the session"""
+        if self.token:
+            return {self.token_header: self.token}
+        return {}
+
+    def series(self, measurement, tag_keys, tag_values):
+        """Return the escaped series statement (cached)"""
+        return _series_statement(type(self), measurement, tag_keys, tag_values)
+
+    @classmethod
+    def statement(cls, measurement, tag_keys, tag_values):
+        """Return the escaped series statement of a measurement and its tags"""
+        raise NotImplementedError
+
+    def format_value(self, key, val):
+        """Format a field value"""
+        if isinstance(val, str):
+            return self.formats[str].format(self.escape(str(val)))
+        if isinstance(val, bool):
+            return self.formats[bool][val]
+        if isinstance(val, int):
+            return self.formats[int].format(int(val))
+        if isinstance(val, float):
+            return self.formats[float].format(float(val))
+        raise ValueError("Invalid or unsupported value (key: {})".format(key))
+
+    def format_column(self, key, values):
+        """Format a column of values, detecting the type once for the whole column"""
+        # exact types: a bool is an int, an int is not a float field value
+        # pylint: disable=unidiomatic-typecheck
+        kind = type(values[0])
+        if kind in self.formats and all(type(val) is kind for val in values):
+            fmt = self.formats[kind]
+            if kind is str:
+                return [fmt.format(self.escape(val)) for val in values]
+            if kind is bool:
+                return [fmt[val] for val in values]
+            return [fmt.format(val) for val in values]
+        # mixed column: fall back to value-per-value detection
+        return [self.format_value(key, val) for val in values]
+
+    def encode(self, timestamp, series, measurement, fields):
+        """Return the encoded point (ms timestamp) and its number of lines"""
+        raise NotImplementedError
+
+    def encode_columns(self, timestamps, series, measurement, columns):
+        """Return the encoded rows of a block of points, and the number of lines per row"""
+        raise NotImplementedError
+
+    @staticmethod
+    def lines(fields): # pylint: disable=unused-argument
+        """Return the number of lines of an encoded point (one line per field
+        in some backends)"""
+        return 1
+
+    def renderer(self, measurement, fields):
+        """Return a function rendering a point with fixed fields (names and types),
+        render(timestamp, series, values), built on a pre-escaped template,
+        and the number of lines of a point.
+        String values are escaped and booleans converted by the caller."""
+        raise NotImplementedError
+
+    def request(self, payload):
+        """Return the write request (requests.Request) of a payload"""
+        raise NotImplementedError
+
+    def query_request(self, query, start=None, end=None):
+        """Return the read request (requests.Request) of a query over [start, end)
+        (ms timestamps)"""
+        raise NotImplementedError
+
+    def decode(self, lines):
+        """Decode the lines (bytes) of a query response as they are received,
+        yield (timestamp, tags, fields) rows (ms timestamps)"""
+        raise NotImplementedError
+
+
+@register
+class Warp10Backend(Backend):
+    """Warp10 GTS input format"""
+
+    name = 'warp10'
+    token_header = 'X-Warp10-Token'
+    timestamp_factor = 1000 # in µs
+    condensed = True
+    formats = {str: "'{}'", bool: {True: 'T', False: 'F'}, int: '{}', float: '{!s}'}
+    escape = staticmethod(_escape_warp10)
+    # TS/LAT:LON/ELEV CLASS{LABELS} VALUE, or a continuation line: =TS/LAT:LON/ELEV VALUE
+    line_pattern = re.compile(rb'(?:\d*/[^\s/]*/\S* [^\s{]+\{[^\s}]*\}|=\d*/[^\s/]*/\S*) \S')
+
+    @classmethod
+    def statement(cls, measurement, tag_keys, tag_values):
+        return '{' + ','.join(cls.escape(key) + '=' + cls.escape(val)
+                              for key, val in zip(tag_keys, tag_values)) + '}'
+
+    def values(self, timestamp, series, measurement, fields):
+        """Return the (timestamp, selector, value) triplets of a point"""
+        micro_ts = timestamp * 1000 # in µs
+        values = []
+        for key, val in fields.items():
+            if measurement is not None:
+                key = measurement+'.'+key
+            values.append((micro_ts, self.escape(key) + series, self.format_value(key, val)))
+        return values
+
+    @staticmethod
+    def line(micro_ts, selector, val):
+        """Return a GTS line"""
+        return "{}// {} {}\n".format(micro_ts, selector, val)
+
+    @staticmethod
+    def continuation(micro_ts, val):
+        """Return a continuation line (same selector as the previous line)
+        https://www.warp10.io/content/03_Documentation/03_Interacting_with_Warp_10/03_Ingesting_data/02_GTS_input_format#continuation-lines"""
+        return "={}// {}\n".format(micro_ts, val)
+
+    @staticmethod
+    def expand(continuation, line):
+        """Return an encoded continuation line as a full line (bytes),
+        `line` being the (encoded) first line of its series"""
+        position, value = continuation[1:].split(b' ', 1)
+        return b' '.join((position, line.split(b' ', 2)[1], value))
+
+    @staticmethod
+    def lines(fields):
+        """One line per field"""
+        return len(fields)
+
+    def encode(self, timestamp, series, measurement, fields):
+        micro_ts = timestamp * 1000 # in µs
+        prefix = '' if measurement is None else measurement + '.'
+        return ''.join(["{}// {}{} {}\n".format(micro_ts, self.escape(prefix + key), series,
+                                                 self.format_value(prefix + key, val))
+                        for key, val in fields.items()]), len(fields)
+
+    def renderer(self, measurement, fields):
+        prefix = '' if measurement is None else measurement + '.'
+        selectors = [self.escape(prefix + key) for key in fields]
+        placeholders = [_printf(self.formats[kind]) for kind in fields.values()]
+        size = len(fields)
+        templates = {}
+
+        def render(timestamp, series, values):
+            template = templates.get(series)
+            if template is None:
+                # one template per series: selectors are written once
+                template = ''.join('%s// ' + (selector + series).replace('%', '%%') + ' '
+                                   + placeholder + '\n'
+                                   for selector, placeholder in zip(selectors, placeholders))
+                if len(templates) >= SERIES_CACHE_SIZE:
+                    templates.clear()
+                templates[series] = template
+            args = [str(timestamp * 1000), None] * size # in µs
+            args[1::2] = values
+            return template % tuple(args)
+        return render, size
+
+    def encode_columns(self, timestamps, series, measurement, columns):
+        """One GTS block (one line per field) per timestamp"""
+        selectors = []
+        values = []
+        for key, values_column in columns.items():
+            if measurement is not None:
+                key = measurement+'.'+key
+            selectors.append("// {}{} ".format(self.escape(key), series))
+            values.append(self.format_column(key, values_column))
+        timestamps = scale_column(timestamps, self.timestamp_factor)
+        return [''.join("{}{}{}\n".format(micro_ts, selector, val)
+                        for selector, val in zip(selectors, row))
+                for micro_ts, row in zip(timestamps, zip(*values))], len(columns)
+
+    def request(self, payload):
+        # https://www.warp10.io/content/03_Documentation/03_Interacting_with_Warp_10/03_Ingesting_data/01_Ingress
+        # $ curl -H 'X-Warp10-Token: TOKEN_WRITE' -H 'Transfer-Encoding: chunked' \
+        #  -T METRICS_FILE 'https://HOST:PORT/api/v0/update'
+        return requests.Request(
+            method='POST',
+            url=self.url + '/update',
+            data=payload
+        )
+
+    def query_request(self, query, start=None, end=None):
+        # https://www.warp10.io/content/03_Documentation/03_Interacting_with_Warp_10/04_Fetching_data/01_Fetching_data
+        # $ curl -H 'X-Warp10-Token: TOKEN_READ' \
+        #  'https://HOST:PORT/api/v0/fetch?selector=~class{labels}&start=START&stop=STOP'
+        if start is None or end is None:
+            raise ValueError("Warp10 fetch needs a time range")
+        return requests.Request(
+            method='GET',
+            url=self.url + '/fetch',
+            # start and stop are inclusive, in µs
+            params={'selector': query, 'start': start * self.timestamp_factor,
+                    'stop': end * self.timestamp_factor - 1, 'format': 'text'}
+        )
+
+    @staticmethod
+    def parse_value(value):
+        """Return a GTS value as a Python value"""
+        if value.startswith("'"):
+            return urllib.parse.unquote(value[1:-1])
+        if value in ('T', 'true'):
+            return True
+        if value in ('F', 'false'):
+            return False
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=SERIES_CACHE_SIZE)
+    def parse_selector(selector):
+        """Return the (class name, labels) of a GTS selector: class{labels}[{attributes}]"""
+        brace = selector.index('{')
+        labels = {}
+        for label in selector[brace + 1:selector.index('}', brace)].split(','):
+            if label:
+                key, val = label.split('=', 1)
+                labels[urllib.parse.unquote(key)] = urllib.parse.unquote(val)
+        return urllib.parse.unquote(selector[:brace]), labels
+
+    def decode(self, lines):
+        """One row per line: {class name: value}"""
+        name = labels = None
+        for line in lines:
+            if not line:
+                continue
+            line = line.decode('utf-8')
+            if line.startswith('='):
+                position, value = line[1:].split(' ', 1)
+            else:
+                position, selector, value = line.split(' ', 2)
+                name, labels = self.parse_selector(selector)
+            timestamp = int(position[:position.index('/')]) // self.timestamp_factor
+            yield timestamp, dict(labels), {name: self.parse_value(value)}
+
+
+@register
+class InfluxBackend(Backend):
+    """InfluxDB line protocol"""
+
+    name = 'influx'
+    timestamp_factor = 1000000 # in ns
+    default_measurement = 'data'
+    formats = {str: '"{}"', bool: {True: 'T', False: 'F'}, int: '{}i', float: '{!s}'}
+    escape = staticmethod(_escape_influx)
+    # measurement[,tags] field=value[,...] [timestamp]
+    line_pattern = re.compile(rb'(?:[^\s\\]|\\.)+ (?:[^\s=\\]|\\.)+=\S')
+
+    def __init__(self, url, database=None, backend_auth=(None, None), token=None):
+        super().__init__(url, database, backend_auth, token)
+        if not database:
+            raise ValueError("Influx database missing")
+
+    @classmethod
+    def statement(cls, measurement, tag_keys, tag_values):
+        if measurement is None or measurement == '':
+            measurement = cls.default_measurement
+        return ''.join([measurement] + [',' + cls.escape(key) + '=' + cls.escape(val)
+                                        for key, val in zip(tag_keys, tag_values)])
+
+    def encode(self, timestamp, series, measurement, fields):
+        # https://docs.influxdata.com/influxdb/v1.7/write_protocols/line_protocol_reference/
+        return "{} {} {}\n".format(
+            series,
+            ','.join(self.escape(key) + '=' + self.format_value(key, val)
+                     for key, val in fields.items()),
+            timestamp * 1000000), 1 # in ns
+
+    def renderer(self, measurement, fields):
+        template = '%s ' + ','.join(self.escape(key).replace('%', '%%') + '='
+                                    + _printf(self.formats[kind])
+                                    for key, kind in fields.items()) + ' %s\n'
+
+        def render(timestamp, series, values):
+            return template % (series, *values, timestamp * 1000000) # in ns
+        return render, 1
+
+    def encode_columns(self, timestamps, series, measurement, columns):
+        """One line per timestamp"""
+        fields = []
+        for key, values in columns.items():
+            prefix = self.escape(key) + '='
+            fields.append([prefix + val for val in self.format_column(key, values)])
+        timestamps = scale_column(timestamps, self.timestamp_factor)
+        return ["{} {} {}\n".format(series, ','.join(row), nano_ts)
+                for nano_ts, row in zip(timestamps, zip(*fields))], 1
+
+    def request(self, payload):
+        # https://docs.influxdata.com/influxdb/v1.7/tools/api/#write-http-endpoint
+        # $ curl -i -XPOST "http://localhost:8086/write?db=mydb" \
+        #  --data-binary 'mymeas,mytag=1 myfield=90 1463683075000000000'
+        return requests.Request(
+            method='POST',
+            url=self.url + '/write',
+            params={'db': self.database, 'u': self.backend_auth[0], 'p': self.backend_auth[1]},
+            data=payload
+        )
+
+    def query_request(self, query, start=None, end=None):
+        # https://docs.influxdata.com/influxdb/v1.7/tools/api/#query-http-endpoint
+        # $ curl -G 'http://localhost:8086/query?db=mydb&epoch=ms&chunked=true' \
+        #  --data-urlencode 'q=SELECT * FROM cpu WHERE time >= $start AND time < $end' \
+        #  --data-urlencode 'params={"start": 1463683075000000000, "end": 1463683076000000000}'
+        params = {'db': self.database, 'u': self.backend_auth[0], 'p': self.backend_auth[1],
+                  'q': query, 'epoch': 'ms', 'chunked': 'true'}
+        bind = {}
+        if start is not None:
+            bind['start'] = start * self.timestamp_factor
+        if end is not None:
+            bind['end'] = end * self.timestamp_factor
+        if bind:
+            # bound to $start and $end in the query
+            params['params'] = json.dumps(bind)
+        return requests.Request(method='GET', url=self.url + '/query', params=params)
+
+    def decode(self, lines):
+        """One JSON object per chunk of results, one row per value tuple"""
+        for line in lines:
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if 'error' in chunk:
+                raise QueryException(chunk['error'])
+            for result in chunk.get('results', ()):
+                if 'error' in result:
+                    raise QueryException(result['error'])
+                for series in result.get('series', ()):
+                    tags = series.get('tags', {})
+                    columns = series['columns'][1:]
+                    for row in series.get('values', ()):
+                        yield row[0], dict(tags), {key: val for key, val in zip(columns, row[1:])
+                                                   if val is not None}
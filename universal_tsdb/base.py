@@ -0,0 +1,74 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Interface between Ingester and its mixins (see ingest.py and delivery.py)"""
+
+import threading
+import time
+
+
+class IngesterBase: # pylint: disable=too-few-public-methods
+    """Base class of Ingester and its mixins: the client, the payload accounting,
+    and the Ingester methods used by the mixins (raising NotImplementedError here).
+    The other attributes they use are listed in their docstrings."""
+
+    def __init__(self, client):
+        self.client = client
+        self._backend = client.backend
+        self._length = 0
+        self._lock = threading.Lock()
+        self._report = {'series': 0, 'values': 0, 'successes': 0, 'commits': 0, 'dropped': 0,
+                        'bytes': 0, 'bytes_sent': 0, 'compression_time': 0,
+                        'shards': 0, 'shards_failed': 0, 'rejected': 0,
+                        'retries': 0, 'backoff_time': 0, 'spooled': 0, 'replayed': 0,
+                        'trigger_count': 0, 'trigger_bytes': 0, 'trigger_linger': 0,
+                        'trigger_manual': 0, 'encode_time': 0, 'network_time': 0, 'requests': 0,
+                        'merged': 0, 'duplicates': 0,
+                        'time': 0, '_timer_main': time.monotonic(), '_timer_batch': None}
+
+    def purge(self):
+        """Empty the payload"""
+        raise NotImplementedError
+
+    def _point(self, timestamp, tags, measurement, fields, checked=False):
+        """Write a point to the payload, flush it once full"""
+        raise NotImplementedError
+
+    def _seal(self):
+        """Write the pending (grouped or compacted) points to the payload"""
+        raise NotImplementedError
+
+    def _full(self):
+        """Return the flush trigger fired by the current payload, if any"""
+        raise NotImplementedError
+
+    def _flush(self, trigger):
+        """Commit a full batch"""
+        raise NotImplementedError
+
+    def _fired(self):
+        """Account (and return) the trigger of the current commit"""
+        raise NotImplementedError
+
+    def _check_linger(self):
+        """Raise (once) the error of a flush triggered by the linger thread"""
+        raise NotImplementedError
+
+    def _policy(self):
+        """Return the retry policy of the commits"""
+        raise NotImplementedError
+
+    def _send(self, data, compressed, policy=None, length=0):
+        """Send a payload of `length` series, retrying according to `policy`"""
+        raise NotImplementedError
+
+    def _send_batch(self, batch):
+        """Send a detached batch (background sender)"""
+        raise NotImplementedError
+
+    def _succeeded(self, length, timer_batch, size, sent, compression_time):
+        """Account for a successful commit of `size` bytes (`sent` bytes on the wire)"""
+        raise NotImplementedError
+
+    def _failed_attempt(self, err, reason):
+        """Account for a failed commit without retry policy (raised after MAX_ERRORS)"""
+        raise NotImplementedError
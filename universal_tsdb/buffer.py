@@ -0,0 +1,105 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Payload buffers"""
+
+import time
+import zlib
+
+# zlib window bits per HTTP Content-Encoding
+COMPRESSIONS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def compressobj(compression, level=-1):
+    """Return a zlib compression object for a HTTP Content-Encoding"""
+    if compression not in COMPRESSIONS:
+        raise ValueError("Unsupported compression: {}".format(compression))
+    return zlib.compressobj(level, zlib.DEFLATED, COMPRESSIONS[compression])
+
+
+class PayloadBuffer:
+    """Append-only payload buffer
+
+    Data is stored as a list of UTF-8 encoded chunks: appending never copies
+    the previous content, and the bytes handed to the HTTP client are joined
+    only once, at commit time.
+    With a compression ('gzip' or 'deflate'), chunks are compressed as they
+    are written, and only the compressed stream is kept."""
+
+    ENCODING = 'utf-8'
+
+    def __init__(self, compression=None, level=-1):
+        self._chunks = []
+        self._size = 0
+        self.compression = compression
+        self.compression_time = 0
+        self._level = level
+        self._compressor = None
+        if compression is not None:
+            self._compressor = compressobj(compression, level)
+
+    def __len__(self):
+        """Return the size of the buffer, in bytes (before compression)"""
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    def write(self, data):
+        """Append a string (or bytes) to the buffer"""
+        if isinstance(data, str):
+            data = data.encode(self.ENCODING)
+        self._size += len(data)
+        if self._compressor is not None:
+            start = time.perf_counter()
+            data = self._compressor.compress(data)
+            self.compression_time += time.perf_counter() - start
+            if not data:
+                return
+        self._chunks.append(data)
+
+    def chunks(self):
+        """Return the list of encoded (and compressed) chunks"""
+        return self._chunks
+
+    def getvalue(self):
+        """Return the buffer content as bytes (compressed, if enabled).
+        The buffer remains writable."""
+        if self._compressor is None:
+            return b''.join(self._chunks)
+        # flush a copy, so the stream can still be appended to
+        start = time.perf_counter()
+        tail = self._compressor.copy().flush()
+        self.compression_time += time.perf_counter() - start
+        return b''.join(self._chunks + [tail])
+
+    def text(self):
+        """Return the buffer content as a string"""
+        data = self.getvalue()
+        if self.compression is not None:
+            data = zlib.decompress(data, COMPRESSIONS[self.compression])
+        return data.decode(self.ENCODING)
+
+    def clear(self):
+        """Empty the buffer"""
+        self._chunks = []
+        self._size = 0
+        if self._compressor is not None:
+            self._compressor = compressobj(self.compression, self._level)
+
+
+def split_lines(data, parts):
+    """Split a payload into (at most) `parts` slices of similar size, on line boundaries.
+    A slice never starts with a Warp10 continuation line"""
+    slices = []
+    start = 0
+    size = len(data)
+    for i in range(1, parts):
+        cut = data.find(b'\n', max(start, size * i // parts)) + 1
+        while 0 < cut < size and data[cut:cut+1] == b'=':
+            cut = data.find(b'\n', cut) + 1
+        if not 0 < cut < size:
+            break
+        slices.append(data[start:cut])
+        start = cut
+    slices.append(data[start:])
+    return slices
@@ -0,0 +1,149 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""HTTP client of the time-series databases: write requests and queries"""
+
+import contextlib
+import logging
+import time
+import requests
+from . import backends, query as queries, trace
+from .buffer import PayloadBuffer, compressobj
+
+
+class Client: # pylint: disable=too-many-instance-attributes
+    """Multi-backend abstraction class"""
+
+    DEFAULT_TIMEOUT = 30
+
+    def __init__(self, protocol, url, database=None, http_username=None, http_password=None,
+                 backend_username=None, backend_password=None, token=None, timeout=DEFAULT_TIMEOUT,
+                 compression=None, compression_level=-1, pool_maxsize=None, retry=None,
+                 trace_lines=None):
+        # the options are keyword arguments (see README.md)
+        # pylint: disable=too-many-arguments
+        self.backend = backends.get_backend(protocol)(
+            url, database=database, backend_auth=(backend_username, backend_password),
+            token=token)
+        self.protocol = self.backend.name
+        self._url = url
+        self._database = database
+        self._http_auth = (http_username, http_password)
+        self._backend_auth = (backend_username, backend_password)
+        self._token = token
+        self._timeout = timeout
+        self.compression = compression
+        self.compression_level = compression_level
+        self.retry = retry
+        self.trace_lines = trace_lines
+        if compression is not None:
+            compressobj(compression, compression_level)
+
+        # HTTP Session
+        self._session = requests.Session()
+        self.pool_maxsize = None
+        if pool_maxsize is not None:
+            self._mount(pool_maxsize)
+        if http_username or http_password:
+            self._session.auth = self._http_auth
+        self._session.headers.update(self.backend.headers())
+        logging.debug("%s client instanciated", self.protocol)
+
+    def _mount(self, pool_maxsize):
+        """Mount a HTTP adapter keeping up to `pool_maxsize` connections per host"""
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self.pool_maxsize = pool_maxsize
+
+    def reserve_connections(self, count):
+        """Grow the connection pool to keep at least `count` connections (concurrent
+        requests): beyond the pool size, connections are discarded once used"""
+        if (self.pool_maxsize or requests.adapters.DEFAULT_POOLSIZE) < count:
+            logging.debug("Connection pool grown to %d connections", count)
+            self._mount(count)
+
+    def new_buffer(self):
+        """Return an empty payload buffer, compressed as configured"""
+        return PayloadBuffer(self.compression, self.compression_level)
+
+    def compress(self, payload):
+        """Compress a whole payload (str or bytes)"""
+        if isinstance(payload, str):
+            payload = payload.encode(PayloadBuffer.ENCODING)
+        compressor = compressobj(self.compression, self.compression_level)
+        return compressor.compress(payload) + compressor.flush()
+
+    def prepare_request(self, payload, compressed=False):
+        """Prepare a HTTP Request.
+        With compression enabled, the payload is compressed unless `compressed` is set
+        Return: Requests.PreparedRequest"""
+        prepped = self._prepare_request(payload if compressed or self.compression is None
+                                        else self.compress(payload))
+        if self.compression is not None:
+            prepped.headers['Content-Encoding'] = self.compression
+        return prepped
+
+    def _prepare_request(self, payload):
+        return self._session.prepare_request(self.backend.request(payload))
+
+    def send(self, prepped):
+        """Send to backend"""
+        response = None
+        try:
+            response = self._session.send(prepped, verify=True, timeout=(3.05, self._timeout))
+            response.raise_for_status()
+        except Exception as err:
+            trace.LOGGER.debug("%s", trace.Exchange(prepped, response, self.trace_lines))
+            raise err
+
+    # read chunk of a query response
+    QUERY_CHUNK_SIZE = 64 * 1024
+
+    def query(self, query, start=None, end=None, parallel=1, cache=None, interval=None):
+        """Run a query (InfluxQL, or a Warp10 selector) over [start, end) (ms timestamps)
+        and yield the (timestamp, tags, fields) rows, decoded as the response is received.
+        InfluxQL queries refer to the time range as $start and $end.
+        With `parallel` > 1, the time range is split into as many sub-ranges, fetched
+        concurrently; rows are still yielded in order. A query with GROUP BY time() needs
+        its `interval` (in ms): sub-ranges are then cut on bucket boundaries, otherwise
+        the buckets cut in two are returned twice, with partial aggregates.
+        `cache` (a QueryCache) keeps the complete rows of each sub-range ending in the past."""
+        ranges = queries.split_range(start, end, parallel, interval)
+        if len(ranges) == 1:
+            return self._query(query, start, end, cache)
+        return queries.concat([self._query(query, lower, upper, cache)
+                               for lower, upper in ranges], parallel)
+
+    def query_columns(self, query, start=None, end=None, parallel=1, cache=None,
+                      interval=None):
+        """Run a query, return its results as columns (see query.to_columns())"""
+        return queries.to_columns(self.query(query, start, end, parallel, cache, interval))
+
+    def _query(self, query, start, end, cache):
+        """Yield the rows of a query over a time range, from the cache if possible"""
+        key = None
+        # only closed ranges: points may still be written after now
+        if cache is not None and end is not None and end <= int(time.time()*1000):
+            # rows are only shared between clients with the same credentials
+            key = (self.protocol, self._url, self._database, self._token, self._backend_auth,
+                   self._http_auth, query, start, end)
+            rows = cache.get(key)
+            if rows is not None:
+                yield from rows
+                return
+        prepped = self._session.prepare_request(self.backend.query_request(query, start, end))
+        response = self._session.send(prepped, stream=True, verify=True,
+                                      timeout=(3.05, self._timeout))
+        with contextlib.closing(response):
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError:
+                trace.LOGGER.debug("%s", trace.Exchange(prepped, response, self.trace_lines))
+                raise
+            rows = [] if key is not None else None
+            for row in self.backend.decode(response.iter_lines(self.QUERY_CHUNK_SIZE)):
+                if rows is not None:
+                    rows.append(row)
+                yield row
+        if rows is not None:
+            cache.put(key, rows)
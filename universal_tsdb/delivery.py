@@ -0,0 +1,263 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Delivery of the ingester payloads: spool (write-ahead, replay) and sharded commits"""
+
+import concurrent.futures
+import logging
+import mmap
+import threading
+import time
+import zlib
+import requests
+from .base import IngesterBase
+from .buffer import COMPRESSIONS, split_lines
+from .exceptions import MaxErrorsException
+from .retry import RetryPolicy
+from .spool import Spool
+
+
+# the abstract methods are implemented by Ingester
+class SpoolMixin(IngesterBase): # pylint: disable=abstract-method
+    """Ingester methods writing payloads to the spool and replaying them.
+    Ingester sets the `_buffer` attribute."""
+
+    def __init__(self, client, spool):
+        super().__init__(client)
+        self._spool = spool
+        self._replay_lock = threading.Lock()
+        # write-ahead segments of the batches being queued or sent: not replayed
+        self._in_flight = set()
+        self._flight_lock = threading.Lock()
+        self._drainer = None
+
+    def _detach(self):
+        """Detach the current payload, return it as a batch
+        (written to the spool first, in write-ahead mode)"""
+        self._seal()
+        self._fired()
+        segment = None
+        if self._spool is not None and self._spool.write_ahead:
+            segment = self._write_ahead(self._buffer.getvalue(), self._length,
+                                        self._buffer.compression)
+        batch = (self._buffer, self._length, self._report['_timer_batch'], segment)
+        self.purge()
+        return batch
+
+    def _write_ahead(self, data, length, encoding):
+        """Write a payload to the spool before sending it, return its segment
+        (in flight until released)"""
+        with self._flight_lock:
+            segment = self._spool.push(data, length, encoding)
+            self._in_flight.add(segment)
+        return segment
+
+    def _release(self, segment, sent=True):
+        """Release an in-flight segment: removed once sent, replayed otherwise"""
+        with self._flight_lock:
+            if sent:
+                self._spool.remove(segment)
+            self._in_flight.discard(segment)
+
+    def _drop_batch(self, batch):
+        buffer, length, _, segment = batch
+        if self._spool is not None:
+            if segment is None:
+                self._spool_data(buffer.getvalue(), length, buffer.compression)
+            else:
+                self._release(segment, sent=False)
+            return
+        with self._lock:
+            self._report['dropped'] += length
+
+    def _spool_data(self, data, length, encoding):
+        """Write a payload to the spool"""
+        self._spool.push(data, length, encoding)
+        with self._lock:
+            self._report['spooled'] += length
+
+    def _spool_payload(self):
+        """Move the current payload to the spool"""
+        self._seal()
+        if self._buffer:
+            self._spool_data(self._buffer.getvalue(), self._length, self._buffer.compression)
+        self.purge()
+
+    def _spool_lost_payload(self, segment):
+        """Spool the current payload after a failed commit (unless already written ahead)"""
+        if segment is None:
+            self._spool_payload()
+        else:
+            self._release(segment, sent=False)
+            with self._lock:
+                self._report['spooled'] += self._length
+            self.purge()
+
+    def _replay_or_spool(self):
+        """Replay the spool before a commit. While the backend is still unavailable,
+        the payload is spooled behind the others and MaxErrorsException raised"""
+        if self._spool is None or self.replay():
+            return
+        self._spool_payload()
+        self._report['time'] = time.monotonic() - self._report['_timer_main']
+        raise MaxErrorsException
+
+    def replay(self):
+        """Send spooled payloads, oldest first, until the first failure.
+        Payloads rejected by the backend are dropped, write-ahead segments
+        of the batches in flight are skipped.
+        Return: True if the spool is empty"""
+        if self._spool is None:
+            return True
+        policy = self._policy() or RetryPolicy(max_attempts=1)
+        with self._replay_lock:
+            with self._flight_lock:
+                segments = [name for name in self._spool.segments()
+                            if name not in self._in_flight]
+            for name in segments:
+                length, encoding = Spool.parse(name)
+                try:
+                    data = self._spool.read(name)
+                except FileNotFoundError: # expired meanwhile
+                    continue
+                try:
+                    compressed = encoding is not None
+                    if encoding != self.client.compression:
+                        if compressed:
+                            data = zlib.decompress(data, COMPRESSIONS[encoding])
+                        compressed = False
+                    self._send(data, compressed, policy, length)
+                except requests.exceptions.RequestException as err:
+                    if policy.is_retryable(err):
+                        logging.warning("Spool replay interrupted: %s", err)
+                        return False
+                    logging.error("Spooled segment %s rejected by backend: %s", name, err)
+                    with self._lock:
+                        self._report['rejected'] += length
+                else:
+                    with self._lock:
+                        self._report['replayed'] += length
+                    logging.info("%d spooled series replayed from %s", length, name)
+                finally:
+                    if isinstance(data, mmap.mmap):
+                        data.close()
+                self._spool.remove(name)
+        return True
+
+    @staticmethod
+    def _drain(ref, stop):
+        """Replay the spool of the ingester (weak reference) periodically,
+        until `stop` is set (drainer thread)"""
+        serie = ref()
+        while serie is not None:
+            interval = serie._spool.drain_interval # pylint: disable=protected-access
+            serie = None
+            if stop.wait(interval):
+                return
+            serie = ref()
+            try:
+                if serie is not None and serie._spool.segments(): # pylint: disable=protected-access
+                    serie.replay()
+            except Exception: # pylint: disable=broad-except
+                logging.exception("Spool drainer error")
+
+
+class ShardMixin(SpoolMixin): # pylint: disable=abstract-method
+    """Ingester methods splitting a payload into shards sent concurrently.
+    Ingester sets the `_buffer` and `_successive_fails` attributes."""
+
+    def __init__(self, client, shards, spool):
+        super().__init__(client, spool)
+        self._shards = shards
+        self._pool = None
+        # shards of a failed commit, retried by the next one
+        self._retry_shards = []
+
+    def _spool_payload(self):
+        """Move the current payload to the spool, failed shards first"""
+        for shard in self._retry_shards:
+            lines = shard.count(b'\n')
+            self._spool_data(shard, lines, None)
+            self._length -= lines
+        self._retry_shards = []
+        super()._spool_payload()
+
+    def _send_shard(self, shard, policy):
+        """Send a shard (shard pool thread).
+        Return: bytes sent, compression time"""
+        length = shard.count(b'\n')
+        start = time.perf_counter()
+        if self.client.compression is not None:
+            shard = self.client.compress(shard)
+        compression_time = time.perf_counter() - start
+        self._send(shard, True, policy, length)
+        return len(shard), compression_time
+
+    @staticmethod
+    def _shard_results(shards, futures, policy):
+        """Wait for the shards to be sent.
+        Return: failed shards, shards rejected by the backend, first error,
+        report counters of the sent shards"""
+        failed = []
+        rejected = []
+        error = None
+        sent = {'bytes': 0, 'bytes_sent': 0, 'compression_time': 0}
+        for shard, future in zip(shards, futures):
+            try:
+                shard_sent, shard_time = future.result()
+            except requests.exceptions.RequestException as err:
+                logging.warning("Shard HTTP Error: %s", err)
+                if policy is not None and not policy.is_retryable(err):
+                    rejected.append(shard)
+                else:
+                    failed.append(shard)
+                error = error or err
+            else:
+                sent['bytes'] += len(shard)
+                sent['bytes_sent'] += shard_sent
+                sent['compression_time'] += shard_time
+        return failed, rejected, error, sent
+
+    def _commit_shards(self):
+        """Split the payload on line boundaries and send the shards concurrently.
+        Failed shards are kept: the next commit only retries them (and sends new points)"""
+        self._seal()
+        if self._length == 0:
+            return
+        self._replay_or_spool()
+        shards = self._retry_shards
+        if self._buffer:
+            shards = shards + split_lines(self._buffer.getvalue(), self._shards)
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._shards, thread_name_prefix='universal_tsdb-shard')
+        self._report['commits'] += 1
+        logging.info("Sending %d HTTP requests (trigger: %s)", len(shards), self._fired())
+        policy = self._policy()
+        futures = [self._pool.submit(self._send_shard, shard, policy) for shard in shards]
+        failed, rejected, error, sent = self._shard_results(shards, futures, policy)
+        length, timer_batch = self._length, self._report['_timer_batch']
+        self._report['shards'] += len(shards) - len(failed) - len(rejected)
+        self._report['shards_failed'] += len(failed) + len(rejected)
+        self._report['rejected'] += sum(shard.count(b'\n') for shard in rejected)
+        self.purge()
+        if not failed and not rejected:
+            self._successive_fails = 0
+            self._succeeded(length, timer_batch, sent['bytes'], sent['bytes_sent'],
+                            sent['compression_time'])
+            return
+
+        for key, val in sent.items():
+            self._report[key] += val
+        self._retry_shards = failed
+        self._length = sum(shard.count(b'\n') for shard in failed)
+        self._report['_timer_batch'] = timer_batch
+        if policy is not None:
+            if failed:
+                logging.error("Commit aborted: %d/%d shards failed", len(failed), len(shards))
+                if self._spool is not None:
+                    self._spool_payload()
+                raise MaxErrorsException from error
+            logging.error("Commit rejected by backend: %s", error)
+            raise error
+        # Same policy as a single request
+        self._failed_attempt(error, "{}/{} shards failed".format(len(failed), len(shards)))
@@ -6,3 +6,9 @@ from requests import RequestException
 
 class MaxErrorsException(RequestException):
     """Requests' Exception that means no more retry will be executed"""
+
+class QueueFullException(Exception):
+    """The background sending queue is full"""
+
+class QueryException(RequestException):
+    """The backend reported an error in a query response"""
@@ -0,0 +1,146 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Fan-out of points to several backends, with routing by measurement or tag"""
+
+import concurrent.futures
+import logging
+from requests import RequestException
+from .exceptions import QueueFullException
+from .metrics import Ingester
+
+# field value types supported by all the backends
+_VALUE_TYPES = (str, bool, int, float)
+
+
+def _route(rule):
+    """Return the predicate (measurement, tags) -> bool of a routing rule: a callable, or
+    a dict with a `measurement` (a name or a collection of names) and/or `tags` key
+    (a dict of tag key -> value or collection of values) that must all match"""
+    if callable(rule):
+        return rule
+    if not isinstance(rule, dict) or not set(rule) <= {'measurement', 'tags'}:
+        raise ValueError("Invalid routing rule: {!r}".format(rule))
+    measurements = rule.get('measurement')
+    if isinstance(measurements, str):
+        measurements = {measurements}
+    elif measurements is not None:
+        measurements = set(measurements)
+    tags = {key: {val} if isinstance(val, str) else set(val)
+            for key, val in rule.get('tags', {}).items()}
+
+    def match(measurement, point_tags):
+        if measurements is not None and measurement not in measurements:
+            return False
+        for key, values in tags.items():
+            if point_tags is None or point_tags.get(key) not in values:
+                return False
+        return True
+    return match
+
+
+class MultiIngester:
+    """Ingester writing to several backends: `clients` is a dict of name -> Client.
+    Each point is validated (and timestamped, if needed) once, routed, then encoded
+    by one Ingester per backend, created with `kwargs` updated with the `options` of its name.
+    By default each backend has its own background sender (senders=1): buffers, retries
+    and sends are independent, and a slow backend only blocks the others once its queue
+    is full (see `backpressure`).
+    `routes` is a dict of name -> rule (see _route()): a backend without a rule gets
+    all the points.
+    Send errors of a backend do not stop the others: they are kept in `errors`
+    (name -> last exception) and the first one is raised by commit() or close(),
+    once all the backends have been committed."""
+
+    def __init__(self, clients, routes=None, options=None, **kwargs):
+        if not clients:
+            raise ValueError("No client")
+        routes = routes or {}
+        options = options or {}
+        for name in list(routes) + list(options):
+            if name not in clients:
+                raise ValueError("Unknown client: {}".format(name))
+        kwargs.setdefault('senders', 1)
+        self.ingesters = {name: Ingester(client, **dict(kwargs, **options.get(name, {})))
+                          for name, client in clients.items()}
+        self.errors = {}
+        self._routes = [(name, _route(routes[name]) if name in routes else None)
+                        for name in self.ingesters]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _targets(self, measurement, tags):
+        """Yield the (name, ingester) of the backends a series is routed to"""
+        for name, match in self._routes:
+            if match is None or match(measurement, tags):
+                yield name, self.ingesters[name]
+
+    def _isolated(self, name, call, *args):
+        """Call a method of a backend's ingester, keeping its send errors"""
+        try:
+            call(*args)
+        except (RequestException, QueueFullException) as err:
+            logging.error("Backend %s: %s", name, err)
+            self.errors[name] = err
+
+    def append(self, timestamp=None, tags=None, measurement=None, **kwargs):
+        """Add a point to the payload of the backends it is routed to"""
+        # pylint: disable=protected-access
+        timestamp = Ingester._check_point(timestamp, tags, measurement)
+        for key, val in kwargs.items():
+            if not isinstance(val, _VALUE_TYPES):
+                raise ValueError("Invalid or unsupported value (key: {})".format(key))
+        for name, serie in self._targets(measurement, tags):
+            self._isolated(name, serie._point, timestamp, tags, measurement, kwargs, True)
+
+    def append_columns(self, timestamps, tags=None, measurement=None, **kwargs):
+        """Add a block of points (see Ingester.append_columns()) to the backends
+        it is routed to"""
+        Ingester._check_point(0, tags, measurement) # pylint: disable=protected-access
+        for name, serie in self._targets(measurement, tags):
+            self._isolated(name, lambda serie=serie: serie.append_columns(
+                timestamps, tags=tags, measurement=measurement, **kwargs))
+
+    def ingest(self, records):
+        """Write a stream of points (see Ingester.ingest())"""
+        for record in records:
+            self.append(record.get('timestamp'), record.get('tags'),
+                        record.get('measurement'), **record['fields'])
+
+    def _raise(self):
+        if self.errors:
+            error = next(iter(self.errors.values()))
+            self.errors = {}
+            raise error
+
+    def _each(self, method):
+        """Call a method of all the ingesters concurrently, then raise the first send error"""
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.ingesters),
+                thread_name_prefix="universal_tsdb-fanout") as executor:
+            futures = [executor.submit(self._isolated, name, getattr(serie, method))
+                       for name, serie in self.ingesters.items()]
+        for future in futures:
+            future.result()
+        self._raise()
+
+    def commit(self):
+        """Commit all the backends concurrently, then raise the first send error, if any"""
+        self._each('commit')
+
+    def purge(self):
+        """Empty the payloads of all the backends"""
+        for serie in self.ingesters.values():
+            serie.purge()
+
+    def close(self):
+        """Commit and close all the backends concurrently, then raise the first send error,
+        if any"""
+        self._each('close')
+
+    def stats(self):
+        """Return the statistics (see Ingester.stats()) of each backend"""
+        return {name: serie.stats() for name, serie in self.ingesters.items()}
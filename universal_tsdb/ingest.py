@@ -0,0 +1,238 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Ingestion of streams of points, files and partitions encoded in parallel"""
+
+import contextlib
+import os
+import re
+import time
+from . import pool, readers
+from .base import IngesterBase
+from .sender import BackgroundSender
+
+# lines of an encoded payload which are not continuation lines
+_FIRST_LINE = re.compile(rb'^[^=\n]', re.MULTILINE)
+
+
+# the abstract methods are implemented by Ingester
+class IngestMixin(IngesterBase): # pylint: disable=abstract-method
+    """Ingester methods writing streams of records, files and partitions.
+    Ingester sets the `on_append`, `_buffer`, `_batch`, `_max_bytes`, `_opened`, `_index`,
+    `_last_selector`, `_first_line`, `_write_lock`, `_sender`, `_condensed`, `_reorder`,
+    `_compact` and `_compact_size` attributes, ShardMixin sets `_shards`."""
+
+    def ingest(self, records):
+        """Write a stream of points: mappings with a `fields` dict and optional
+        `timestamp` (in ms), `tags` and `measurement` keys, read one at a time.
+        Full batches are sent while the next ones are encoded (see _overlapped())"""
+        with self._overlapped():
+            for record in records:
+                self._point(record.get('timestamp'), record.get('tags'),
+                            record.get('measurement'), record['fields'])
+
+    def ingest_file(self, path, file_format='csv', tags=(), fields=None, measurement=None,
+                    chunk_size=readers.CHUNK_SIZE):
+        """Write the points of a file, streamed in constant memory:
+        - 'csv': see readers.read_csv() for `tags`, `fields` and `measurement`
+        - 'jsonl': JSON lines, one record per line (see ingest())
+        - 'line': pre-formatted lines in the backend format, validated but not re-encoded.
+          Blank lines and lines starting with '#' are skipped, values are not counted."""
+        records = self._records(path, file_format, tags, fields, measurement)
+        if records is not None:
+            self.ingest(records)
+            return
+        with self._overlapped():
+            for chunk in readers.read_chunks(path, chunk_size):
+                self._lines(chunk)
+            with self._write_lock:
+                trigger = self._full()
+                if trigger is not None:
+                    self._flush(trigger)
+
+    def ingest_parallel(self, partitions, processes=None, file_format=None, tags=(), fields=None,
+                        measurement=None):
+        """Write partitions of points, encoded by a pool of `processes` worker processes
+        (default: one per CPU). Partitions are lists of records (see ingest()) or, with
+        `file_format`, paths of files (see ingest_file()), each one encoded by a single worker.
+        The payloads are batched and sent (in the partitions order) by the calling process,
+        as by append(): reports and errors are the same, but batches are cut on lines
+        (a multi-value Warp10 point may span two batches).
+        With reorder or compaction, points are grouped or compacted within each partition."""
+        if file_format is not None:
+            # unsupported formats are rejected before starting the workers
+            self._records(None, file_format, tags, fields, measurement)
+        tasks = ((self._backend, partition, file_format,
+                  {'tags': tags, 'fields': fields, 'measurement': measurement},
+                  self._condensed, self._reorder, self._compact, self._compact_size)
+                 for partition in partitions)
+        processes = processes or os.cpu_count()
+        with pool.process_pool(processes) as workers:
+            for data, lines, report in pool.imap(workers, pool.encode_partition, tasks,
+                                                 2 * processes):
+                with self._write_lock:
+                    self._check_linger()
+                    for key, val in report.items():
+                        self._report[key] += val
+                    for trigger in self._write_encoded(data, lines):
+                        self._flush(trigger)
+                    if self.on_append is not None:
+                        self.on_append(lines)
+
+    def _write_encoded(self, data, lines):
+        """Write a block of `lines` encoded lines (bytes) to the payload, cut on line
+        boundaries, yield the trigger each time a batch is full.
+        A batch starting with a continuation line gets it expanded to a full line."""
+        self._last_selector = None
+        if self._index:
+            # compacted points first
+            self._seal()
+        pos = 0
+        size = len(data)
+        first = 0 # start of the last first line of a series (condensed format)
+        while pos < size:
+            if self._opened is None:
+                self._opened = time.monotonic()
+            if self._batch > 0 and self._report['_timer_batch'] is None:
+                self._report['_timer_batch'] = time.monotonic()
+            if self._length == 0 and self._backend.condensed and data.startswith(b'=', pos):
+                for match in _FIRST_LINE.finditer(data, first, pos):
+                    first = match.start()
+                end = data.find(b'\n', pos) + 1
+                self._buffer.write(self._backend.expand(data[pos:end],
+                                                        data[first:data.find(b'\n', first)]))
+                self._length += 1
+                self._report['series'] += 1
+                lines -= 1
+                pos = end
+                trigger = self._full()
+                if trigger is not None:
+                    yield trigger
+                continue
+            cut = self._cut(data, pos, lines)
+            if cut is None:
+                yield 'bytes'
+                continue
+            count = data.count(b'\n', pos, cut)
+            self._buffer.write(data[pos:cut])
+            self._length += count
+            self._report['series'] += count
+            lines -= count
+            pos = cut
+            trigger = self._full()
+            if trigger is not None:
+                yield trigger
+
+    def _cut(self, data, pos, lines):
+        """Return the end of the encoded lines from `pos` which fit in the current batch
+        and within max_bytes (at least one line in a payload), None if none fits"""
+        cut = len(data)
+        if 0 < self._batch - self._length < lines:
+            cut = pos
+            for _ in range(self._batch - self._length):
+                cut = data.find(b'\n', cut) + 1
+        if self._max_bytes is not None:
+            end = data.rfind(b'\n', pos, pos + self._max_bytes - len(self._buffer)) + 1
+            if end == 0:
+                if self._length > 0:
+                    return None
+                end = data.find(b'\n', pos) + 1
+            cut = min(cut, end)
+        return cut
+
+    @staticmethod
+    def _records(path, file_format, tags, fields, measurement):
+        """Return the records of a csv or jsonl file (None for pre-formatted lines)"""
+        if file_format == 'csv':
+            return readers.read_csv(path, tags, fields, measurement)
+        if file_format == 'jsonl':
+            return readers.read_jsonl(path)
+        if file_format == 'line':
+            return None
+        raise ValueError("Unsupported format: {}".format(file_format))
+
+    def _lines(self, data):
+        with self._write_lock:
+            self._check_linger()
+            start = time.perf_counter()
+            length = self._length
+            count = 0
+            for trigger in self._write_lines(data):
+                self._report['encode_time'] += time.perf_counter() - start
+                count += self._length - length
+                self._flush(trigger)
+                start = time.perf_counter()
+                length = 0
+            self._report['encode_time'] += time.perf_counter() - start
+            count += self._length - length
+            if self.on_append is not None:
+                self.on_append(count)
+
+    def _write_lines(self, data):
+        """Write pre-formatted lines (bytes ending with a newline) to the payload,
+        yield the trigger each time a batch is full.
+        A batch never starts with a continuation line."""
+        pattern = self._backend.line_pattern
+        condensed = self._backend.condensed
+        self._last_selector = None
+        if self._index:
+            # compacted points first
+            self._seal()
+        start = pos = 0
+        first = None # start of the last first line of a series
+        size = len(data)
+        while pos < size:
+            end = data.find(b'\n', pos) + 1
+            if end - pos <= 1 or data.startswith((b'#', b'\r\n'), pos):
+                # blank line or comment
+                self._buffer.write(data[start:pos])
+                start = pos = end
+                continue
+            if pattern is not None and not pattern.match(data, pos, end):
+                self._buffer.write(data[start:pos])
+                raise ValueError("Invalid line: {!r}".format(data[pos:end].rstrip()[:100]))
+            continuation = condensed and data.startswith(b'=', pos)
+            if condensed and not continuation:
+                first = pos
+            if continuation and first is not None:
+                self._first_line = data[first:data.find(b'\n', first)]
+                first = None
+            full = 0 < self._batch <= self._length and not continuation
+            # a line crossing max_bytes starts the next payload
+            crossing = self._max_bytes is not None and \
+                len(self._buffer) + end - start > self._max_bytes and \
+                (not continuation or self._first_line is not None)
+            if self._length > 0 and (full or crossing):
+                self._buffer.write(data[start:pos])
+                start = pos
+                yield 'count' if full else 'bytes'
+                if continuation:
+                    # a payload never starts with a continuation line
+                    self._buffer.write(self._backend.expand(data[pos:end], self._first_line))
+                    start = end
+            if self._opened is None:
+                self._opened = time.monotonic()
+            if self._batch > 0 and self._report['_timer_batch'] is None:
+                self._report['_timer_batch'] = time.monotonic()
+            self._length += 1
+            self._report['series'] += 1
+            pos = end
+        self._buffer.write(data[start:pos])
+        if first is not None:
+            self._first_line = data[first:data.find(b'\n', first)]
+
+    @contextlib.contextmanager
+    def _overlapped(self):
+        """Without background senders (nor shards), send the full batches in a sender thread
+        while the caller encodes the next one, as in background mode (senders=1, queue_size=1).
+        Errors are raised when the block exits, if not earlier by the next full batch."""
+        if self._sender is not None or self._shards > 1:
+            yield
+            return
+        self._sender = BackgroundSender(self._send_batch, queue_size=1)
+        try:
+            yield
+            self._sender.join()
+        finally:
+            sender, self._sender = self._sender, None
+            sender.close()
+        sender.check()
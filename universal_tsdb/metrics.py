@@ -2,131 +2,138 @@
 
 """A Universal Time-Series Database Python Client"""
 
+import bisect
+import itertools
+import threading
 import time
-import urllib.parse
 import logging
+import weakref
 import requests
+from . import backends, trace
+from .buffer import PayloadBuffer
+from .client import Client # pylint: disable=unused-import
+from .delivery import ShardMixin
 from .exceptions import MaxErrorsException
+from .ingest import IngestMixin
+from .retry import RetryPolicy
+from .sender import BackgroundSender
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
-class Client:
-    """Multi-backend abstraction class"""
-
-    DEFAULT_TIMEOUT = 30
-
-    def __init__(self, protocol, url, database=None, http_username=None, http_password=None,
-                 backend_username=None, backend_password=None, token=None, timeout=DEFAULT_TIMEOUT):
-        self.protocol = protocol
-        self._url = url
-        self._database = database
-        self._http_auth = (http_username, http_password)
-        self._backend_auth = (backend_username, backend_password)
-        self._token = token
-        self._timeout = timeout
-
-        # Sanitary check
-        if self.protocol == 'warp10':
-            pass
-        elif self.protocol == 'influx':
-            if not database:
-                raise ValueError("Influx database missing")
-        else:
-            raise ValueError("Unsupported backend: {}".format(self.protocol))
-
-        # HTTP Session
-        self._session = requests.Session()
-        if http_username or http_password:
-            self._session.auth = self._http_auth
-        if token:
-            if self.protocol == 'warp10':
-                self._session.headers.update({'X-Warp10-Token': self._token})
-            else:
-                raise ValueError("Token authentification not supported for {} backend"
-                                 .format(self.protocol))
-        logging.debug("%s client instanciated", self.protocol)
-
-    def prepare_request(self, payload):
-        """Prepare a HTTP Request
-        Return: Requests.PreparedRequest"""
-        if self.protocol == 'warp10':
-            # https://www.warp10.io/content/03_Documentation/03_Interacting_with_Warp_10/03_Ingesting_data/01_Ingress
-            # $ curl -H 'X-Warp10-Token: TOKEN_WRITE' -H 'Transfer-Encoding: chunked' \
-            #  -T METRICS_FILE 'https://HOST:PORT/api/v0/update'
-            req = requests.Request(
-                method='POST',
-                url=self._url + '/update',
-                data=payload
-            )
-            return self._session.prepare_request(req)
-        if self.protocol == 'influx':
-            # https://docs.influxdata.com/influxdb/v1.7/tools/api/#write-http-endpoint
-            # $ curl -i -XPOST "http://localhost:8086/write?db=mydb" \
-            #  --data-binary 'mymeas,mytag=1 myfield=90 1463683075000000000'
-            req = requests.Request(
-                method='POST',
-                url=self._url + '/write',
-                params={'db':self._database, 'u':self._backend_auth[0], 'p':self._backend_auth[1]},
-                data=payload
-            )
-            return self._session.prepare_request(req)
-        return None
-
-    def send(self, prepped):
-        """Send to backend"""
-        try:
-            response = self._session.send(prepped, verify=True, timeout=(3.05, self._timeout))
-            response.raise_for_status()
-        except Exception as err:
-            logging.debug("Response:")
-            logging.debug(self._dump_response(response))
-            logging.debug("-----------------------------------------")
-            logging.debug("Request:")
-            logging.debug(self._dump_request(prepped))
-            raise err
-
-    @staticmethod
-    def _dump_request(req):
-        """HTTP request dumper
-        https://stackoverflow.com/a/23816211"""
-        return '{}\n{}\r\n{}\r\n\r\n{}'.format(
-            '----------HTTP REQUEST----------',
-            req.method + ' ' + req.url,
-            '\r\n'.join('{}: {}'.format(k, v) for k, v in req.headers.items()),
-            req.body,
-        )
+def _weak(method):
+    """Return a function calling a bound method through a weak reference
+    (background threads do not keep their ingester alive)"""
+    ref = weakref.WeakMethod(method)
 
-    @staticmethod
-    def _dump_response(resp):
-        """HTTP response dumper"""
-        return '{}\n{}\r\n{}\r\n\r\n{}'.format(
-            '----------HTTP RESPONSE----------',
-            str(resp.status_code) + ' ' + resp.url,
-            '\r\n'.join('{}: {}'.format(k, v) for k, v in resp.headers.items()),
-            resp.content,
-        )
+    def call(*args):
+        function = ref()
+        if function is not None:
+            function(*args)
+    return call
 
+def _same(value, other):
+    """Return whether two field values are equal and of the same type (1 != 1.0 != True)"""
+    return value == other and type(value) is type(other)
 
-class Ingester:
+class Ingester(IngestMixin, ShardMixin): # pylint: disable=too-many-instance-attributes
     """Ingester class"""
 
-    INFLUX_DEFAULT_MEASUREMENT_NAME = 'data'
+    INFLUX_DEFAULT_MEASUREMENT_NAME = backends.InfluxBackend.default_measurement
     MAX_ERRORS = 3
+    # upper bounds (in s) of the request latency histogram
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    COMPACTIONS = ('merge', 'last')
+    # maximum number of pending points indexed for compaction
+    COMPACT_SIZE = 10000
 
-    def __init__(self, client, batch=0):
-        self.client = client
+    def __init__(self, client, batch=0, senders=0, queue_size=8, backpressure='block',
+                 condensed=False, reorder=False, shards=1, retry=None, spool=None,
+                 max_bytes=None, linger_ms=None, on_append=None, on_commit_start=None,
+                 on_commit_end=None, compact=None, compact_size=COMPACT_SIZE):
+        # the options are keyword arguments (see README.md)
+        # pylint: disable=too-many-arguments,too-many-locals
+        super().__init__(client, shards, spool)
+        self.on_append = on_append
+        self.on_commit_start = on_commit_start
+        self.on_commit_end = on_commit_end
+        self._retry = retry
         self._batch = batch
-        self._payload = ""
-        self._length = 0
-        self._report = {'series': 0, 'values': 0, 'successes': 0, 'commits': 0,
-                        'time': 0, '_timer_main': time.monotonic(), '_timer_batch': None}
+        self._max_bytes = max_bytes
+        self._linger = linger_ms / 1000 if linger_ms else None
+        self._opened = None
+        self._trigger = 'manual'
+        self._condensed = condensed or reorder
+        self._reorder = reorder
+        self._last_selector = None
+        self._first_line = None # last first line of a series written by ingest_file()
+        self._groups = {}
+        self._compact = compact
+        self._compact_size = compact_size
+        self._index = {}
+        self._carry = None # point held back by max_bytes, written after the flush
+        self._buffer = self._new_buffer()
+        self._latency = [0] * (len(self.LATENCY_BUCKETS) + 1)
         self._successive_fails = 0
+        self._write_lock = threading.RLock()
+        self._sender = None
+        self._lingerer = None
+        self._linger_error = None
+        self._check_options(senders)
+        # one connection per shard sent concurrently
+        client.reserve_connections(shards)
+        # background threads only hold weak references: an ingester which is not closed
+        # is still collected, and its threads stopped (see __del__)
+        if senders > 0:
+            self._sender = BackgroundSender(_weak(self._send_batch), threads=senders,
+                                            queue_size=queue_size, backpressure=backpressure,
+                                            on_drop=_weak(self._drop_batch))
+        if spool is not None and spool.drain_interval:
+            self._drainer = threading.Event()
+            threading.Thread(target=self._drain, args=(weakref.ref(self), self._drainer),
+                             name="universal_tsdb-drainer", daemon=True).start()
+        if self._linger is not None:
+            self._lingerer = threading.Event()
+            threading.Thread(target=self._linger_loop, args=(weakref.ref(self), self._lingerer),
+                             name="universal_tsdb-linger", daemon=True).start()
         logging.debug("ingester instanciated")
 
+    def _check_options(self, senders):
+        """Raise ValueError on unsupported or exclusive options"""
+        if self._condensed and not self._backend.condensed:
+            raise ValueError("Condensed format not supported for {} backend"
+                             .format(self.client.protocol))
+        if self._compact is not None and self._compact not in self.COMPACTIONS:
+            raise ValueError("Unsupported compaction: {}".format(self._compact))
+        if self._compact is not None and self._condensed:
+            raise ValueError("Compaction and condensed format are exclusive")
+        if self._compact_size < 1:
+            raise ValueError("Invalid compaction size")
+        if self._max_bytes is not None and (self._reorder or self._compact is not None):
+            # grouped or compacted points are only encoded when the batch is sent
+            raise ValueError("max_bytes is not supported with reordering or compaction")
+        if self._shards > 1 and senders > 0:
+            raise ValueError("Sharded commits and background senders are exclusive")
+        if self._shards > 1 and self._spool is not None and self._spool.write_ahead:
+            raise ValueError("Sharded commits and write-ahead spool are exclusive")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def __del__(self):
-        if self._batch > 0 and self._length > 0:
+        if self._batch > 0 and self._length > 0 or \
+                self._sender is not None and self._sender.depth() > 0:
             logging.warning(("Destroying instance with non-flushed payload. "
                              "Always purge() or commit() before destruction."))
+        # not closed: stop the background threads, queued batches are lost
+        if self._lingerer is not None:
+            self._lingerer.set()
+        if self._drainer is not None:
+            self._drainer.set()
+        if self._sender is not None:
+            self._sender.close(wait=False)
         if self._batch > 0 and self._report['time'] > 0:
             logging.info("REPORT: %d commits (%d successes), %d series, %d values "
                          "in %.2f s @ %.1f values/s",
@@ -138,105 +145,223 @@ class Ingester:
                          self._report['commits'], self._report['successes'],
                          self._report['series'], self._report['values'])
 
-    def _esc(self, value):
-        if self.client.protocol == 'warp10':
-            return urllib.parse.quote(str(value), safe='')
-        if self.client.protocol == 'influx':
-            value = str(value).replace(
-                "\\", "\\\\"
-                ).replace(
-                    " ", "\\ "
-                    ).replace(
-                        ",", "\\,"
-                        ).replace(
-                            "=", "\\="
-                            ).replace(
-                                "\n", "\\n"
-                                ).replace(
-                                    "'", "\\'"
-                                    ).replace(
-                                        "\"", "\\\""
-                                        )
-            if value.endswith('\\'):
-                value += ' '
-            return value
-        return None
+    def _series(self, measurement=None, tags=None):
+        """Return the escaped series statement (cached):
+        'measurement,tags' (InfluxDB) or '{labels}' (Warp10)"""
+        if tags:
+            return self._backend.series(measurement, tuple(map(str, tags)),
+                                        tuple(map(str, tags.values())))
+        return self._backend.series(measurement, (), ())
+
+    @staticmethod
+    def cache_info():
+        """Return hit/miss statistics of the escaping and series caches"""
+        # pylint: disable=protected-access,no-value-for-parameter
+        return {'escape_influx': backends.InfluxBackend.escape.cache_info(),
+                'escape_warp10': backends.Warp10Backend.escape.cache_info(),
+                'series': backends._series_statement.cache_info()}
+
+    def _new_buffer(self):
+        if self._shards > 1:
+            # shards are split then compressed at commit time
+            return PayloadBuffer()
+        return self.client.new_buffer()
 
     def payload(self):
         """Return current payload"""
-        return self._payload
+        # pending points are not written: later points may still be grouped or merged
+        text = self._buffer.text() + self._pending_text()
+        if self._retry_shards:
+            return b''.join(self._retry_shards).decode(PayloadBuffer.ENCODING) + text
+        return text
 
     def length(self):
         """Return number of series included in the current payload.
         A Series can have multiple field=value couples"""
         return self._length
 
-    def _append_warp10(self, timestamp, tags_statement="", measurement=None, **kwargs):
-        """Translate to Warp10 GTS series"""
-        for key, val in kwargs.items():
-            if measurement is not None:
-                key = measurement+'.'+key
-            if isinstance(val, str):
-                val = "'"+self._esc(val)+"'"
-            elif isinstance(val, bool):
-                if val:
-                    val = 'T'
-                else:
-                    val = 'F'
-            elif isinstance(val, int):
-                pass
-            elif isinstance(val, float):
-                pass
-            else:
-                raise ValueError("Invalid or unsupported value (key: {})".format(key))
-
-            micro_ts = timestamp * 1000 # in µs
-            self._payload += "{}// {}{{{}}} {}\n".format(micro_ts, self._esc(key),
-                                                         tags_statement, val)
-            self._length += 1
-            self._report['values'] += 1
-            self._report['series'] += 1
-#TODO(gmasse): support condensed format with continuation lines
-# https://www.warp10.io/content/03_Documentation/03_Interacting_with_Warp_10/03_Ingesting_data/02_GTS_input_format#continuation-lines
-
-    def _append_influx(self, timestamp, tags_statement="", measurement=None, **kwargs):
-        # https://docs.influxdata.com/influxdb/v1.7/write_protocols/line_protocol_reference/
-        fields_statement = ''
-        separator = ''
-        for key, val in kwargs.items():
-            if isinstance(val, str):
-                val = "\""+self._esc(val)+"\""
-            elif isinstance(val, bool):
-                if val:
-                    val = 'T'
-                else:
-                    val = 'F'
-            elif isinstance(val, int):
-                val = str(val)+'i'
-            elif isinstance(val, float):
-                pass
+    def size(self):
+        """Return size of the current payload, in bytes"""
+        return sum(map(len, self._retry_shards)) + len(self._buffer) + \
+            len(self._pending_text().encode(PayloadBuffer.ENCODING))
+
+    def _append(self, timestamp, series, measurement, fields):
+        text, lines = self._backend.encode(timestamp, series, measurement, fields)
+        if self._max_bytes is not None:
+            self._write_bounded(text, lines, len(fields))
+            return
+        self._buffer.write(text)
+        self._length += lines
+        self._report['series'] += lines
+        self._report['values'] += len(fields)
+
+    def _write_bounded(self, text, lines, values, carried=None):
+        """Write an encoded point, unless it would take the payload beyond max_bytes:
+        it is then held back (as `carried`, if set), _full() fires the flush
+        and _flush() writes it to the next payload"""
+        data = text.encode(PayloadBuffer.ENCODING)
+        if self._length > 0 and len(self._buffer) + len(data) > self._max_bytes:
+            if carried is not None:
+                data = carried.encode(PayloadBuffer.ENCODING)
+            self._carry = (data, lines, values, self._last_selector)
+            return
+        self._buffer.write(data)
+        self._length += lines
+        self._report['series'] += lines
+        self._report['values'] += values
+
+    def _write_carry(self):
+        """Write the point held back by max_bytes to the (new) payload"""
+        if self._carry is None:
+            return
+        data, lines, values, self._last_selector = self._carry
+        self._carry = None
+        if self._opened is None:
+            self._opened = time.monotonic()
+        if self._batch > 0 and self._report['_timer_batch'] is None:
+            self._report['_timer_batch'] = time.monotonic()
+        self._buffer.write(data)
+        self._length += lines
+        self._report['series'] += lines
+        self._report['values'] += values
+
+    def _append_condensed(self, timestamp, series, measurement, fields):
+        """Encode a point using continuation lines
+        (consecutive values of a series are written after its first line)"""
+        backend = self._backend
+        values = backend.values(timestamp, series, measurement, fields)
+        if not values:
+            return
+        if self._reorder:
+            for micro_ts, selector, val in values:
+                self._groups.setdefault(selector, []).append((micro_ts, val))
+            self._length += len(values)
+            self._report['values'] += len(values)
+            self._report['series'] += len(values)
+            return
+        chunks = []
+        previous = self._last_selector
+        for micro_ts, selector, val in values:
+            if selector == previous:
+                chunks.append(backend.continuation(micro_ts, val))
             else:
-                raise ValueError("Invalid or unsupported value (key: {})".format(key))
-            fields_statement = "{}{}{!s}={!s}".format(fields_statement, separator,
-                                                      self._esc(key), val)
-            separator = ','
-            self._report['values'] += 1
-
-        if measurement is None or measurement == '':
-            measurement = self.INFLUX_DEFAULT_MEASUREMENT_NAME
-        if tags_statement:
-            tags_statement = ','+tags_statement
-        nano_ts = timestamp * 1000000 # in ns
-        self._payload += "{}{} {} {}\n".format(measurement, tags_statement,
-                                               fields_statement, nano_ts)
-        self._length += 1
-        self._report['series'] += 1
+                chunks.append(backend.line(micro_ts, selector, val))
+            previous = selector
+        self._last_selector = previous
+        if self._max_bytes is not None:
+            # held back, the point starts the next payload: no continuation line first
+            micro_ts, selector, val = values[0]
+            self._write_bounded(''.join(chunks), len(values), len(values),
+                                backend.line(micro_ts, selector, val) + ''.join(chunks[1:]))
+            return
+        self._buffer.write(''.join(chunks))
+        self._length += len(values)
+        self._report['values'] += len(values)
+        self._report['series'] += len(values)
+
+    def _append_compact(self, timestamp, series, measurement, fields):
+        """Index a point by series and timestamp, merging its fields into the pending point
+        with the same key (written to the payload by _seal()).
+        Duplicate values are dropped. A conflicting value replaces the pending one
+        in 'last' mode; otherwise the pending point is written and replaced by the new one"""
+        key = (series, measurement, timestamp)
+        pending = self._index.get(key)
+        if pending is None:
+            if len(self._index) >= self._compact_size:
+                self._seal()
+            self._index[key] = dict(fields)
+            self._length += self._backend.lines(fields)
+            self._report['series'] += self._backend.lines(fields)
+            self._report['values'] += len(fields)
+            return
+        if self._compact == 'merge' and any(name in pending and not _same(pending[name], val)
+                                            for name, val in fields.items()):
+            # conflicting value: both points are sent unchanged, the new one last
+            self._buffer.write(self._backend.encode(timestamp, series, measurement,
+                                                    self._index.pop(key))[0])
+            self._index[key] = dict(fields)
+            self._length += self._backend.lines(fields)
+            self._report['series'] += self._backend.lines(fields)
+            self._report['values'] += len(fields)
+            return
+        lines = self._backend.lines(pending)
+        added = changed = 0
+        for name, val in fields.items():
+            if name not in pending:
+                pending[name] = val
+                added += 1
+            elif not _same(pending[name], val):
+                pending[name] = val
+                changed += 1
+        if added or changed:
+            self._report['merged'] += 1
+        else:
+            self._report['duplicates'] += 1
+        self._length += self._backend.lines(pending) - lines
+        self._report['series'] += self._backend.lines(pending) - lines
+        self._report['values'] += added
+
+    def _pending_text(self):
+        """Return the encoded compacted points, and the values grouped by series
+        (condensed format with reordering), not written to the payload yet"""
+        backend = self._backend
+        chunks = [backend.encode(timestamp, series, measurement, fields)[0]
+                  for (series, measurement, timestamp), fields in self._index.items()]
+        for selector, points in self._groups.items():
+            first_ts, first_val = points[0]
+            chunks.append(backend.line(first_ts, selector, first_val))
+            chunks.extend(backend.continuation(micro_ts, val) for micro_ts, val in points[1:])
+        return ''.join(chunks)
+
+    def _seal(self):
+        """Write the pending points (see _pending_text()) to the payload"""
+        if self._index or self._groups:
+            self._buffer.write(self._pending_text())
+            self._index = {}
+            self._groups = {}
 
     def append(self, timestamp=None, tags=None, measurement=None, **kwargs):
         """Write a new point"""
-        if self._batch > 0:
-            if self._report['_timer_batch'] is None:
-                self._report['_timer_batch'] = time.monotonic()
+        self._point(timestamp, tags, measurement, kwargs)
+
+    def _point(self, timestamp, tags, measurement, fields, checked=False):
+        with self._write_lock:
+            self._check_linger()
+            trigger = self._add_point(timestamp, tags, measurement, fields, checked)
+            if trigger is not None:
+                self._flush(trigger)
+
+    def _add_point(self, timestamp, tags, measurement, fields, checked):
+        """Encode a point into the payload, return the flush trigger fired, if any"""
+        start = time.perf_counter()
+        if checked:
+            self._encode_point(timestamp, tags, measurement, fields)
+        else:
+            self._write(timestamp, tags, measurement, fields)
+        self._report['encode_time'] += time.perf_counter() - start
+        if self.on_append is not None:
+            self.on_append(1)
+        return self._full()
+
+    def _full(self):
+        """Return the flush trigger fired by the current payload, if any"""
+        if self._carry is not None:
+            return 'bytes'
+        if 0 < self._batch <= self._length:
+            return 'count'
+        if self._max_bytes is not None and len(self._buffer) >= self._max_bytes:
+            return 'bytes'
+        return None
+
+    def _write(self, timestamp, tags, measurement, fields):
+        """Encode a point into the payload"""
+        timestamp = self._check_point(timestamp, tags, measurement)
+        self._encode_point(timestamp, tags, measurement, fields)
+
+    @staticmethod
+    def _check_point(timestamp, tags, measurement):
+        """Validate the timestamp, tags and measurement of a point,
+        return its timestamp (now, if None)"""
         if timestamp is None:
             timestamp = int(time.time()*1000) # UTC Epoch in ms
         elif not isinstance(timestamp, int):
@@ -245,73 +370,571 @@ class Ingester:
             raise ValueError('Invalid tags format')
         if measurement is not None and not isinstance(measurement, str):
             raise ValueError('Invalid measurement')
+        return timestamp
+
+    def _encode_point(self, timestamp, tags, measurement, fields):
+        """Encode a checked point into the payload"""
+        if self._opened is None:
+            self._opened = time.monotonic()
+        if self._batch > 0:
+            if self._report['_timer_batch'] is None:
+                self._report['_timer_batch'] = time.monotonic()
+        series = self._series(measurement, tags)
+        if self._condensed:
+            self._append_condensed(timestamp, series, measurement, fields)
+        elif self._compact:
+            self._append_compact(timestamp, series, measurement, fields)
+        else:
+            self._append(timestamp, series, measurement, fields)
+
+    def schema(self, measurement=None, tags_keys=(), fields=None):
+        """Return a writer of points with a fixed shape: writer(timestamp, tag_values, *values)
+        fields: mapping of the field names to their type (str, bool, int or float), in the order
+        of the writer values. Keys are escaped and the point template built once: the writer
+        only checks the value types (an int is accepted for a float field)."""
+        if self._lingerer is None:
+            # no concurrent flush: the encoder is the writer
+            return self._schema_encoder(measurement, tags_keys, fields, flush=True)
+        encode = self._schema_encoder(measurement, tags_keys, fields)
+
+        def writer(timestamp, tag_values, *values):
+            with self._write_lock:
+                self._check_linger()
+                trigger = encode(timestamp, tag_values, *values)
+                if trigger is not None:
+                    self._flush(trigger)
+        return writer
+
+    def _schema_encoder(self, measurement, tags_keys, fields, flush=False):
+        """Return a function encoding a point of a schema into the payload,
+        encode(timestamp, tag_values, *values). It returns the flush trigger fired, if any,
+        or flushes the payload itself with `flush`."""
+        # the hot path is inlined, on closure variables (see benchmarks/bench_append.py)
+        # pylint: disable=too-many-locals,too-many-statements,too-many-branches
+        if not fields:
+            raise ValueError('No field')
+        for key, kind in fields.items():
+            if kind not in (str, bool, int, float):
+                raise ValueError("Invalid or unsupported field type (key: {})".format(key))
+        if measurement is not None and not isinstance(measurement, str):
+            raise ValueError('Invalid measurement')
+        tags_keys = tuple(map(str, tags_keys))
+        names = list(fields)
+        kinds = tuple(fields.values())
+        size = len(kinds)
 
-        tags_statement = ''
-        if tags is not None:
-            separator = ''
-            for (key, val) in tags.items():
-                tags_statement = "{}{}{!s}={!s}".format(tags_statement, separator,
-                                                        self._esc(key), self._esc(val))
-                separator = ','
+        if self._condensed or self._compact:
+            # continuation lines depend on the previous line, compaction on pending points:
+            # no template
+            def encode_point(timestamp, tag_values, *values):
+                if len(values) != size:
+                    raise ValueError("Invalid number of values (expected: {})".format(size))
+                start = time.perf_counter()
+                self._write(timestamp, dict(zip(tags_keys, tag_values)), measurement,
+                            dict(zip(names, values)))
+                self._report['encode_time'] += time.perf_counter() - start
+                if self.on_append is not None:
+                    self.on_append(1)
+                trigger = self._full()
+                if flush and trigger is not None:
+                    self._flush(trigger)
+                    return None
+                return trigger
+            return encode_point
 
-        if self.client.protocol == 'warp10':
-            self._append_warp10(timestamp, tags_statement, measurement, **kwargs)
-        elif self.client.protocol == 'influx':
-            self._append_influx(timestamp, tags_statement, measurement, **kwargs)
+        backend = self._backend
+        render, lines = backend.renderer(measurement, fields)
+        escape = backend.escape
+        bools = backend.formats[bool]
+        strings = [index for index, kind in enumerate(kinds) if kind is str]
+        booleans = [index for index, kind in enumerate(kinds) if kind is bool]
+        report = self._report
+        perf_counter = time.perf_counter
+        static_series = None if tags_keys else backend.series(measurement, (), ())
+        series_cache = {}
 
-        if self._batch > 0 and self._length >= self._batch:
-            self.commit()
+        def check(values):
+            """Slow path: raise on invalid values, convert int values of float fields"""
+            if len(values) != size:
+                raise ValueError("Invalid number of values (expected: {})".format(size))
+            values = list(values)
+            for index, (kind, val) in enumerate(zip(kinds, values)):
+                if kind is float and type(val) is int: # pylint: disable=unidiomatic-typecheck
+                    values[index] = float(val)
+                elif type(val) is not kind: # pylint: disable=unidiomatic-typecheck
+                    raise ValueError("Invalid or unsupported value (key: {})"
+                                     .format(names[index]))
+            return values
+
+        types = list(kinds)
+        convert = bool(strings or booleans)
+        # options fixed for the life of the ingester
+        batched = self._batch > 0
+        bounded = self._max_bytes is not None
+
+        def encode(timestamp, tag_values, *values):
+            start = perf_counter()
+            # a list display is cheaper to build than a tuple
+            if [*map(type, values)] != types:
+                values = check(values) # a copy
+            elif convert:
+                values = list(values)
+            if convert:
+                for index in strings:
+                    values[index] = escape(values[index])
+                for index in booleans:
+                    values[index] = bools[values[index]]
+            if timestamp is None:
+                timestamp = int(time.time()*1000) # UTC Epoch in ms
+            elif type(timestamp) is not int: # pylint: disable=unidiomatic-typecheck
+                raise ValueError('Invalid timestamp')
+            series = static_series
+            if series is None:
+                try:
+                    series = series_cache.get(tag_values)
+                except TypeError: # unhashable tag values (a list): not cached
+                    series = None
+                if series is None:
+                    if len(tag_values) != len(tags_keys):
+                        raise ValueError('Invalid number of tag values')
+                    series = backend.series(measurement, tags_keys, tuple(map(str, tag_values)))
+                    # only string tuples are cached (1, True and 1.0 share the same key)
+                    if isinstance(tag_values, tuple) and \
+                            all(isinstance(val, str) for val in tag_values):
+                        if len(series_cache) >= backends.SERIES_CACHE_SIZE:
+                            series_cache.clear()
+                        series_cache[tag_values] = series
+            if self._opened is None:
+                self._opened = time.monotonic()
+            if batched and report['_timer_batch'] is None:
+                report['_timer_batch'] = time.monotonic()
+            if bounded:
+                self._write_bounded(render(timestamp, series, values), lines, size)
+            else:
+                self._buffer.write(render(timestamp, series, values))
+                self._length += lines
+                report['series'] += lines
+                report['values'] += size
+            report['encode_time'] += perf_counter() - start
+            if self.on_append is not None:
+                self.on_append(1)
+            if batched or bounded:
+                trigger = self._full()
+                if flush and trigger is not None:
+                    self._flush(trigger)
+                    return None
+                return trigger
+            return None
+        return encode
+
+    def append_columns(self, timestamps, tags=None, measurement=None, **kwargs):
+        """Write a block of points sharing the same tags and measurement.
+        Timestamps (in ms) and field values are columns (lists, tuples, NumPy arrays...)
+        of the same length. The payload is the same as calling append() for each row."""
+        with self._write_lock:
+            self._check_linger()
+            start = time.perf_counter()
+            for trigger in self._write_columns(timestamps, tags, measurement, kwargs):
+                self._report['encode_time'] += time.perf_counter() - start
+                self._flush(trigger)
+                start = time.perf_counter()
+            self._report['encode_time'] += time.perf_counter() - start
+            if self.on_append is not None:
+                self.on_append(len(timestamps))
+
+    def _write_columns(self, timestamps, tags, measurement, fields):
+        """Encode a block of points into the payload, yield the trigger each time
+        a batch is full"""
+        columns = self._check_columns(timestamps, tags, measurement, fields)
+        count = len(timestamps)
+        if count == 0:
+            return
+        if self._condensed or self._compact:
+            # continuation lines depend on the previous line, compaction on pending points:
+            # encode row by row
+            yield from self._write_rows(timestamps, tags, measurement, columns)
+            return
+
+        rows, lines_per_row = self._backend.encode_columns(
+            timestamps, self._series(measurement, tags), measurement, columns)
+
+        start = 0
+        while start < count:
+            if self._opened is None:
+                self._opened = time.monotonic()
+            if self._batch > 0:
+                if self._report['_timer_batch'] is None:
+                    self._report['_timer_batch'] = time.monotonic()
+                remaining = self._batch - self._length
+                end = start + max(1, -(-remaining // lines_per_row))
+            else:
+                end = count
+            if self._max_bytes is not None:
+                end = self._rows_within(rows, start, min(end, count))
+                if end == start:
+                    yield 'bytes'
+                    continue
+            block = rows[start:end]
+            self._buffer.write(''.join(block))
+            self._length += len(block) * lines_per_row
+            self._report['series'] += len(block) * lines_per_row
+            self._report['values'] += len(block) * len(columns)
+            start += len(block)
+            trigger = self._full()
+            if trigger is not None:
+                yield trigger
+
+    @staticmethod
+    def _check_columns(timestamps, tags, measurement, fields):
+        """Validate the tags, measurement and columns of a block of points,
+        return its field columns"""
+        if tags is not None and not isinstance(tags, dict):
+            raise ValueError('Invalid tags format')
+        if measurement is not None and not isinstance(measurement, str):
+            raise ValueError('Invalid measurement')
+        if not fields:
+            raise ValueError('No field')
+        columns = {key: backends.column(values) for key, values in fields.items()}
+        for key, column in columns.items():
+            if len(column) != len(timestamps):
+                raise ValueError("Column length mismatch (key: {})".format(key))
+        return columns
+
+    def _write_rows(self, timestamps, tags, measurement, columns):
+        """Encode a block of points row by row, yield the trigger each time a batch is full"""
+        for i, timestamp in enumerate(backends.column(timestamps)):
+            self._write(timestamp, tags, measurement,
+                        {key: column[i] for key, column in columns.items()})
+            trigger = self._full()
+            if trigger is not None:
+                yield trigger
+
+    def _rows_within(self, rows, start, end):
+        """Return the end of the encoded rows[start:end] which fit in max_bytes:
+        stop before the first row crossing it (the first row of a payload is always written)"""
+        room = self._max_bytes - len(self._buffer)
+        stop = start
+        while stop < end:
+            size = len(rows[stop].encode(PayloadBuffer.ENCODING))
+            if size > room and (stop > start or self._length > 0):
+                break
+            room -= size
+            stop += 1
+        return stop
 
     def purge(self):
         """Flusgh payload"""
-        self._payload = ""
+        self._buffer = self._new_buffer()
+        self._retry_shards = []
+        self._last_selector = None
+        self._groups = {}
+        self._index = {}
         self._length = 0
+        self._opened = None
         self._report['_timer_batch'] = None
 
-    def commit(self):
-        """Send previous added point to backend"""
-        if self._length > 0:
-            self._report['commits'] += 1
-            logging.info("Sending HTTP request")
-            logging.debug("Data: %s", self.payload().rstrip())
-            prepped = self.client.prepare_request(self.payload())
+    def _flush(self, trigger):
+        """Commit a full batch: queue it in background mode, send it otherwise.
+        A point held back by max_bytes is then written to the payload"""
+        self._trigger = trigger
+        try:
+            if self._sender is None:
+                self._commit()
+                return
+            self._sender.check()
+            self._sender.put(self._detach())
+        finally:
+            self._write_carry()
+
+    def _fired(self):
+        """Account (and return) the trigger of the current commit"""
+        trigger, self._trigger = self._trigger, 'manual'
+        self._report['trigger_' + trigger] += 1
+        return trigger
+
+    @staticmethod
+    def _linger_loop(ref, stop):
+        """Flush the payload of the ingester (weak reference) once its first point
+        is linger_ms old, until `stop` is set (linger thread)"""
+        while True:
+            serie = ref()
+            if serie is None:
+                return
+            opened, linger = serie._opened, serie._linger # pylint: disable=protected-access
+            serie = None
+            delay = linger if opened is None else opened + linger - time.monotonic()
+            if stop.wait(max(delay, 0.001)):
+                return
+            serie = ref()
+            if serie is not None:
+                serie._linger_flush() # pylint: disable=protected-access
+            serie = None
+
+    def _linger_flush(self):
+        """Flush the payload if its first point is linger_ms old"""
+        with self._write_lock:
+            if (self._length == 0 or self._opened is None
+                    or time.monotonic() - self._opened < self._linger):
+                return
             try:
-                self.client.send(prepped)
-            except requests.exceptions.RequestException as err:
-                # In batch mode, even if we encouter HTTP error,
-                # we keep the payload until we reach
-                # MAX-ERRORS successive failures
-                if self._batch > 0:
-                    self._successive_fails += 1
-                    logging.warning("Attempt#%d/%d HTTP Error: %s",
-                                    self._successive_fails, self.MAX_ERRORS, err)
-                    if self._successive_fails >= self.MAX_ERRORS:
-                        logging.error("Commit aborted after %d unsuccessful attempts",
-                                      self._successive_fails)
-                        self._report['time'] = time.monotonic() - self._report['_timer_main']
-                        raise MaxErrorsException
+                self._flush('linger')
+            except Exception as err: # pylint: disable=broad-except
+                logging.error("Linger flush failed: %s", err)
+                if self._linger_error is None:
+                    self._linger_error = err
+            if self._length > 0:
+                # payload kept after a failure: try again after another linger period
+                self._opened = time.monotonic()
+
+    def _check_linger(self):
+        """Raise (once) the error of a flush triggered by the linger thread"""
+        err, self._linger_error = self._linger_error, None
+        if err is not None:
+            raise err
+
+    def _policy(self):
+        """Return the retry policy of the ingester (or of its client)"""
+        if self._retry is not None:
+            return self._retry
+        return self.client.retry
+
+    def _default_policy(self):
+        """Return the retry policy of detached batches (background or asyncio senders):
+        without explicit policy, MAX_ERRORS attempts without delay"""
+        policy = self._policy()
+        if policy is None:
+            policy = RetryPolicy(max_attempts=self.MAX_ERRORS, backoff_base=0, jitter=False,
+                                 retry_statuses=None)
+        return policy
+
+    def _account_retries(self, stats):
+        if stats:
+            with self._lock:
+                self._report['retries'] += stats.get('retries', 0)
+                self._report['backoff_time'] += stats.get('backoff_time', 0)
+
+    def _send(self, data, compressed, policy=None, length=0):
+        """Send a payload of `length` series, retrying according to `policy`"""
+        prepped = self.client.prepare_request(data, compressed=compressed)
+        if self.on_commit_start is not None:
+            self.on_commit_start(length, len(prepped.body))
+        start = time.perf_counter()
+        try:
+            if policy is None:
+                self._timed_send(prepped)
+            else:
+                stats = {}
+                try:
+                    policy.call(lambda: self._timed_send(prepped), stats)
+                finally:
+                    self._account_retries(stats)
+        except requests.exceptions.RequestException as err:
+            if self.on_commit_end is not None:
+                result = 'rejected' if policy is not None and not policy.is_retryable(err) \
+                    else 'failed'
+                self.on_commit_end(result, time.perf_counter() - start, len(prepped.body))
+            raise
+        if self.on_commit_end is not None:
+            self.on_commit_end('success', time.perf_counter() - start, len(prepped.body))
+
+    def _timed_send(self, prepped):
+        """Send a request, account for its latency"""
+        start = time.perf_counter()
+        try:
+            self.client.send(prepped)
+        finally:
+            self._observe(time.perf_counter() - start)
+
+    def _observe(self, latency):
+        """Account for a HTTP request latency"""
+        with self._lock:
+            self._report['requests'] += 1
+            self._report['network_time'] += latency
+            self._latency[bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+
+    def stats(self):
+        """Return ingestion statistics: counters, encoding and network times (in s),
+        request latency histogram (cumulative counts per upper bound, in s)
+        and current queue depth"""
+        with self._lock:
+            stats = {key: val for key, val in self._report.items() if not key.startswith('_')}
+            latency = list(itertools.accumulate(self._latency))
+        stats['time'] = time.monotonic() - self._report['_timer_main']
+        stats['latency'] = dict(zip(self.LATENCY_BUCKETS + (float('inf'),), latency))
+        stats['length'] = self._length
+        stats['queue_depth'] = self.queue_depth()
+        if self._spool is not None:
+            stats['spool'] = self._spool.depth()
+            stats['spool_dropped'] = self._spool.dropped
+        return stats
+
+    def _abort(self, length, err, policy):
+        """Account for `length` series that could not be sent, raise the resulting exception:
+        MaxErrorsException when all attempts failed, the error when the backend rejected them"""
+        with self._lock:
+            self._report['time'] = time.monotonic() - self._report['_timer_main']
+            if policy.is_retryable(err):
+                self._report['dropped'] += length
+            else:
+                self._report['rejected'] += length
+        if policy.is_retryable(err):
+            logging.error("Commit aborted after %d unsuccessful attempts", policy.max_attempts)
+            raise MaxErrorsException from err
+        logging.error("Commit rejected by backend: %s", err)
+        raise err
+
+    def _send_batch(self, batch):
+        """Send a detached batch (background sender)"""
+        buffer, length, timer_batch, segment = batch
+        data = buffer.getvalue()
+        policy = self._default_policy()
+        with self._lock:
+            self._report['commits'] += 1
+        try:
+            if self._spool is not None and not self.replay():
+                raise requests.exceptions.ConnectionError("Spool replay failed")
+            self._send(data, buffer.compression is not None, policy, length)
+        except requests.exceptions.RequestException as err:
+            if self._spool is not None and policy.is_retryable(err):
+                if segment is None:
+                    self._spool_data(data, length, buffer.compression)
+                else:
+                    self._release(segment, sent=False)
+                raise MaxErrorsException from err
+            if segment is not None:
+                self._release(segment)
+            self._abort(length, err, policy)
+        if segment is not None:
+            self._release(segment)
+        self._succeeded(length, timer_batch, len(buffer), len(data), buffer.compression_time)
+
+    def _succeeded(self, length, timer_batch, size, sent, compression_time):
+        """Account for a successful commit of `size` bytes (`sent` bytes on the wire)"""
+        with self._lock:
+            self._report['successes'] += 1
+            self._report['bytes'] += size
+            self._report['bytes_sent'] += sent
+            self._report['compression_time'] += compression_time
+            self._report['time'] = time.monotonic() - self._report['_timer_main']
+            if self._batch > 0:
+                if timer_batch is None:
+                    batch_duration = 0
+                    batch_freq = 0
                 else:
-                    raise err
-            except Exception as err:
-                raise err
+                    batch_duration = time.monotonic() - timer_batch
+                    batch_freq = length/batch_duration
+                logging.info("Commit#%d Sent %d new series (total: %d) in %.2f s "
+                             "@ %.1f series/s (total execution: %.2f s)",
+                             self._report['commits'], length,
+                             self._report['series'], batch_duration,
+                             batch_freq, self._report['time'])
             else:
-                self._successive_fails = 0
-                if self._batch > 0:
-                    if self._report['_timer_batch'] is None:
-                        batch_duration = 0
-                        batch_freq = 0
-                    else:
-                        batch_duration = time.monotonic() - self._report['_timer_batch']
-                        batch_freq = self._length/batch_duration
-                self._report['successes'] += 1
+                logging.info("Commit#%d Sent %d new series (total: %d)",
+                             self._report['commits'], length, self._report['series'])
+
+    def queue_depth(self):
+        """Return the number of batches waiting to be sent (background mode)"""
+        if self._sender is None:
+            return 0
+        return self._sender.depth()
+
+    def commit(self):
+        """Send previous added point to backend.
+        In background mode, queue the current payload and wait for all batches to be sent"""
+        with self._write_lock:
+            self._check_linger()
+            self._commit()
+
+    def _commit(self):
+        if self._sender is not None:
+            if self._length > 0:
+                self._sender.put(self._detach())
+            self._sender.join()
+            self._sender.check()
+            return
+        if self._shards > 1:
+            self._commit_shards()
+            return
+        if self._length == 0:
+            return
+        self._seal()
+        self._report['commits'] += 1
+        logging.info("Sending HTTP request (trigger: %s)", self._fired())
+        data = self._buffer.getvalue()
+        trace.LOGGER.debug("Data: %s", trace.Payload(data, self.client.trace_lines,
+                                                     self._buffer.compression))
+        policy = self._policy()
+        self._replay_or_spool()
+        segment = None
+        if self._spool is not None and self._spool.write_ahead:
+            segment = self._write_ahead(data, self._length, self._buffer.compression)
+        try:
+            self._send(data, self._buffer.compression is not None, policy, self._length)
+        except requests.exceptions.RequestException as err:
+            self._commit_failed(err, policy, segment)
+        else:
+            self._successive_fails = 0
+            if segment is not None:
+                self._release(segment)
+            self._succeeded(self._length, self._report['_timer_batch'], len(self._buffer),
+                            len(data), self._buffer.compression_time)
+            self.purge()
+
+    def _commit_failed(self, err, policy, segment):
+        """Handle the failure of a commit. With a retry policy, the payload is kept
+        (or spooled) when the backend is unavailable, dropped when it is rejected"""
+        if policy is not None:
+            if policy.is_retryable(err):
+                # the backend is unavailable: we keep (or spool) the payload
+                logging.error("Commit aborted after %d unsuccessful attempts",
+                              policy.max_attempts)
                 self._report['time'] = time.monotonic() - self._report['_timer_main']
-                if self._batch > 0:
-                    logging.info("Commit#%d Sent %d new series (total: %d) in %.2f s "
-                                 "@ %.1f series/s (total execution: %.2f s)",
-                                 self._report['commits'], self.length(),
-                                 self._report['series'], batch_duration,
-                                 batch_freq, self._report['time'])
-                else:
-                    logging.info("Commit#%d Sent %d new series (total: %d)",
-                                 self._report['commits'], self.length(), self._report['series'])
-                self.purge()
+                if self._spool is not None:
+                    self._spool_lost_payload(segment)
+                raise MaxErrorsException from err
+            length = self._length
+            self.purge()
+            if segment is not None:
+                self._release(segment)
+            self._abort(length, err, policy)
+        if segment is not None:
+            # the payload is safe in the spool, the next commit replays it
+            self._spool_lost_payload(segment)
+        self._failed_attempt(err, "HTTP Error: {}".format(err))
+
+    def _failed_attempt(self, err, reason):
+        """Account for a failed commit without retry policy.
+        In batch mode, even if we encouter HTTP error, we keep the payload until we reach
+        MAX-ERRORS successive failures. Otherwise, the error is raised"""
+        if self._batch == 0:
+            raise err
+        self._successive_fails += 1
+        logging.warning("Attempt#%d/%d %s", self._successive_fails, self.MAX_ERRORS, reason)
+        if self._successive_fails >= self.MAX_ERRORS:
+            logging.error("Commit aborted after %d unsuccessful attempts",
+                          self._successive_fails)
+            self._report['time'] = time.monotonic() - self._report['_timer_main']
+            if self._spool is not None and self._length > 0:
+                self._spool_payload()
+            raise MaxErrorsException from err
+
+    def close(self):
+        """Commit the current payload and stop the background threads.
+        With a spool, a payload which could not be sent is spooled"""
+        try:
+            self.commit()
+        finally:
+            if self._spool is not None and self._length > 0:
+                self._spool_payload()
+            if self._drainer is not None:
+                self._drainer.set()
+                self._drainer = None
+            if self._lingerer is not None:
+                self._lingerer.set()
+                self._lingerer = None
+            if self._sender is not None:
+                self._sender.close()
+                self._sender = None
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
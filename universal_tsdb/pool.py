@@ -0,0 +1,75 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Process-pool encoding for Ingester.ingest_parallel()
+
+Each partition (a list of records, or a file) is encoded by a worker process into one
+block of bytes, pickled back to the parent. The parent only cuts the blocks into
+batches, compresses and sends them: encoding is spread over the CPU cores."""
+
+import collections
+import concurrent.futures
+from . import readers
+
+# report counters of the workers, added up by the parent
+REPORTED = ('values', 'encode_time', 'merged', 'duplicates')
+
+
+def _encoder(backend, condensed, reorder, compact, compact_size):
+    """Return an Ingester (which never sends) encoding with a backend (instance)"""
+    # imported here: workers only need the encoder
+    # pylint: disable=import-outside-toplevel,cyclic-import
+    from .client import Client
+    from .metrics import Ingester
+    username, password = backend.backend_auth
+    client = Client(type(backend), backend.url, database=backend.database,
+                    backend_username=username, backend_password=password, token=backend.token)
+    return Ingester(client, condensed=condensed, reorder=reorder, compact=compact,
+                    compact_size=compact_size or Ingester.COMPACT_SIZE)
+
+
+def encode_partition(backend, partition, file_format=None, options=None, condensed=False,
+                     reorder=False, compact=None, compact_size=None):
+    """Encode a partition with a backend (instance) in a worker process.
+    `partition` is a list of records or, with `file_format`, the path of a file
+    (read with the `options` of Ingester.ingest_file()).
+    Return: (payload bytes, number of lines, report counters to add up)"""
+    # pylint: disable=protected-access
+    serie = _encoder(backend, condensed, reorder, compact, compact_size)
+    if file_format is None:
+        records = partition
+    else:
+        records = serie._records(partition, file_format, **(options or {}))
+    if records is None:
+        for chunk in readers.read_chunks(partition):
+            serie._lines(chunk)
+    else:
+        for record in records:
+            serie._point(record.get('timestamp'), record.get('tags'),
+                         record.get('measurement'), record['fields'])
+    serie._seal()
+    report = serie._report
+    result = (serie._buffer.getvalue(), serie.length(),
+              {key: report[key] for key in REPORTED})
+    serie.purge()
+    return result
+
+
+def imap(executor, function, iterable, window):
+    """Like executor.map(), with at most `window` pending calls:
+    results are yielded in order, while the next ones are computed"""
+    pending = collections.deque()
+    for args in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, *args))
+    try:
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def process_pool(processes=None):
+    """Return a process pool"""
+    return concurrent.futures.ProcessPoolExecutor(max_workers=processes)
@@ -0,0 +1,149 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Query helpers: time range splitting, ordered read-ahead of sub-range results,
+result cache and columnar conversion"""
+
+import collections
+import concurrent.futures
+import queue
+import threading
+
+# rows passed at once from a read-ahead thread, and chunks buffered per sub-range
+CHUNK_ROWS = 512
+QUEUE_SIZE = 8
+
+
+def split_range(start, end, parts, interval=None):
+    """Split [start, end) into (at most) `parts` contiguous sub-ranges.
+    With `interval`, the sub-ranges are cut on its multiples (the boundaries of the
+    GROUP BY time(interval) buckets): a bucket is never split between two sub-ranges"""
+    if parts <= 1:
+        return [(start, end)]
+    if start is None or end is None:
+        raise ValueError("Parallel queries need a time range")
+    if interval is not None and interval < 1:
+        raise ValueError("Invalid interval")
+    origin = start if interval is None else start - start % interval
+    step = max(-(-(end - origin) // parts), 1)
+    if interval is not None:
+        step = -(-step // interval) * interval
+    bounds = [start] + list(range(origin + step, end, step)) + [end]
+    return list(zip(bounds, bounds[1:]))
+
+
+def _put(output, item, stop):
+    """Queue an item, unless the consumer has stopped. Return False if stopped"""
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _read(iterable, output, stop):
+    """Read an iterable into a queue of chunks, then None (or the exception raised)"""
+    if stop.is_set():
+        return
+    try:
+        chunk = []
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) >= CHUNK_ROWS:
+                if not _put(output, chunk, stop):
+                    return
+                chunk = []
+        if chunk and not _put(output, chunk, stop):
+            return
+        _put(output, None, stop)
+    except Exception as err: # pylint: disable=broad-except
+        _put(output, err, stop)
+
+
+def concat(iterables, threads):
+    """Yield the items of the iterables, in order, while up to `threads` of them are read
+    ahead in background threads (at most QUEUE_SIZE chunks of CHUNK_ROWS items each)"""
+    stop = threading.Event()
+    queues = [queue.Queue(QUEUE_SIZE) for _ in iterables]
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads,
+                                                     thread_name_prefix="universal_tsdb-query")
+    try:
+        for iterable, output in zip(iterables, queues):
+            executor.submit(_read, iterable, output, stop)
+        for output in queues:
+            while True:
+                chunk = output.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield from chunk
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+
+def to_columns(rows):
+    """Return (timestamp, tags, fields) rows as columns: a dict of lists, 'timestamp'
+    then the tag and field keys (a tag and a field with the same key share their column),
+    None for missing values"""
+    columns = {'timestamp': []}
+    count = 0
+    for timestamp, tags, fields in rows:
+        columns['timestamp'].append(timestamp)
+        for values in (tags, fields):
+            for key, val in values.items():
+                column = columns.get(key)
+                if column is None:
+                    column = columns[key] = []
+                if len(column) < count:
+                    column.extend([None] * (count - len(column)))
+                column.append(val)
+        count += 1
+    for column in columns.values():
+        if len(column) < count:
+            column.extend([None] * (count - len(column)))
+    return columns
+
+
+class QueryCache:
+    """LRU cache of query results, keyed by the backend, the credentials, the query and
+    the time range.
+    Only the complete results of closed time ranges are stored."""
+
+    def __init__(self, max_entries=128):
+        if max_entries < 1:
+            raise ValueError("Invalid number of cache entries")
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the cached rows (a list) of a key, or None"""
+        with self._lock:
+            rows = self._entries.get(key)
+            if rows is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return rows
+
+    def put(self, key, rows):
+        """Store the rows of a key, evicting the least recently used entries"""
+        with self._lock:
+            self._entries[key] = rows
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Empty the cache"""
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,82 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Streaming file readers for Ingester.ingest_file()
+
+Files are read sequentially, a chunk at a time: memory use does not depend on the file size.
+Records are mappings with a `fields` dict and optional `timestamp` (in ms), `tags`
+and `measurement` keys."""
+
+import csv
+import json
+
+CHUNK_SIZE = 1024 * 1024 # in bytes
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    """Yield the content of a file as chunks of whole lines (bytes),
+    each of about `chunk_size` bytes and ending with a newline"""
+    with open(path, 'rb') as stream:
+        rest = b''
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            cut = chunk.rfind(b'\n') + 1
+            if cut == 0:
+                rest += chunk
+                continue
+            yield rest + chunk[:cut] if rest else chunk[:cut]
+            rest = chunk[cut:]
+        if rest:
+            yield rest + b'\n'
+
+
+def _convert(value):
+    """Return a CSV cell as an int, a float or a string"""
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+
+def read_csv(path, tags=(), fields=None, measurement=None):
+    """Yield the records of a CSV file with a header line.
+    The `timestamp` and `measurement` columns are optional; the columns listed in `tags`
+    are tags, the others are fields, converted by the functions of the `fields` mapping
+    (column -> type) or detected (int, float or string). Empty cells are skipped."""
+    fields = fields or {}
+    with open(path, newline='', encoding='utf-8') as stream:
+        reader = csv.reader(stream)
+        header = next(reader, None)
+        if header is None:
+            return
+        for row in reader:
+            if not row:
+                continue
+            record = {'measurement': measurement, 'tags': {}, 'fields': {}}
+            for key, val in zip(header, row):
+                if val == '':
+                    continue
+                if key == 'timestamp':
+                    record['timestamp'] = int(val)
+                elif key == 'measurement':
+                    record['measurement'] = val
+                elif key in tags:
+                    record['tags'][key] = val
+                else:
+                    record['fields'][key] = fields[key](val) if key in fields else _convert(val)
+            yield record
+
+
+def read_jsonl(path):
+    """Yield the records of a JSON lines file: one record (a JSON object) per line"""
+    with open(path, encoding='utf-8') as stream:
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not isinstance(record, dict) or not isinstance(record.get('fields'), dict):
+                raise ValueError("Invalid record (line {})".format(number))
+            yield record
@@ -0,0 +1,119 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Retry policy"""
+
+import asyncio
+import email.utils
+import logging
+import random
+import time
+import requests
+
+
+class RetryPolicy:
+    """Retry policy for HTTP requests
+
+    A request is attempted up to `max_attempts` times. Before each new attempt,
+    the policy waits for an exponential backoff (`backoff_base` * 2^n, capped to
+    `backoff_max`), randomized with full jitter, or for the delay requested by
+    a Retry-After header, if longer.
+    Connection errors, timeouts and `retry_statuses` responses are retried
+    (all errors if `retry_statuses` is None). Other HTTP errors (e.g. a 400
+    partial write) are not. With a `deadline` (in seconds), no attempt starts
+    after this delay from the first one."""
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_attempts=3, backoff_base=0.5, backoff_max=30, jitter=True,
+                 retry_statuses=RETRY_STATUSES, deadline=None):
+        if max_attempts < 1:
+            raise ValueError("Invalid number of attempts")
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+        self.deadline = deadline
+
+    def is_retryable(self, err):
+        """Return whether a requests' exception is worth retrying"""
+        if self.retry_statuses is None:
+            return True
+        response = getattr(err, 'response', None)
+        if response is None:
+            return isinstance(err, (requests.exceptions.ConnectionError,
+                                    requests.exceptions.Timeout))
+        return response.status_code in self.retry_statuses
+
+    @staticmethod
+    def retry_after(err):
+        """Return the delay (in s) requested by the Retry-After header of an error response"""
+        response = getattr(err, 'response', None)
+        if response is None:
+            return None
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0, date.timestamp() - time.time())
+
+    def backoff(self, attempt, err=None):
+        """Return the delay (in s) before the attempt following attempt number `attempt`"""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt-1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        retry_after = self.retry_after(err)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _next_delay(self, attempt, err, start):
+        """Return the delay before the next attempt, or None to give up"""
+        if attempt >= self.max_attempts or not self.is_retryable(err):
+            return None
+        delay = self.backoff(attempt, err)
+        if self.deadline is not None and time.monotonic() + delay - start > self.deadline:
+            return None
+        logging.warning("Attempt#%d/%d HTTP Error: %s (retrying in %.2f s)",
+                        attempt, self.max_attempts, err, delay)
+        return delay
+
+    def call(self, func, stats):
+        """Call func() until it succeeds or the policy gives up (the last error is raised).
+        `stats` is a dict updated with 'retries' and 'backoff_time'"""
+        start = time.monotonic()
+        attempt = 1
+        while True:
+            try:
+                return func()
+            except requests.exceptions.RequestException as err:
+                delay = self._next_delay(attempt, err, start)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            stats['retries'] = stats.get('retries', 0) + 1
+            stats['backoff_time'] = stats.get('backoff_time', 0) + delay
+            attempt += 1
+
+    async def acall(self, func, stats):
+        """Coroutine version of call(), func() returns an awaitable"""
+        start = time.monotonic()
+        attempt = 1
+        while True:
+            try:
+                return await func()
+            except requests.exceptions.RequestException as err:
+                delay = self._next_delay(attempt, err, start)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            stats['retries'] = stats.get('retries', 0) + 1
+            stats['backoff_time'] = stats.get('backoff_time', 0) + delay
+            attempt += 1
@@ -0,0 +1,107 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Background sender"""
+
+import logging
+import queue
+import threading
+from .exceptions import QueueFullException
+
+
+class BackgroundSender:
+    """Drain a bounded queue of batches in background threads
+
+    `send` is called in a sender thread for each queued batch. The first
+    exception it raises is kept, and re-raised by check() in the producer."""
+
+    BACKPRESSURES = ('block', 'drop_oldest', 'raise')
+
+    def __init__(self, send, threads=1, queue_size=8, backpressure='block', on_drop=None):
+        if backpressure not in self.BACKPRESSURES:
+            raise ValueError("Unsupported backpressure: {}".format(backpressure))
+        if threads < 1:
+            raise ValueError("Invalid number of sender threads")
+        self._send = send
+        self._on_drop = on_drop
+        self._backpressure = backpressure
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._threads = [threading.Thread(target=self._run, name="universal_tsdb-sender-{}"
+                                          .format(i), daemon=True) for i in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                self._send(batch)
+            except Exception as err: # pylint: disable=broad-except
+                if self._error is None:
+                    self._error = err
+            finally:
+                self._queue.task_done()
+
+    def depth(self):
+        """Return the number of batches waiting in the queue"""
+        return self._queue.qsize()
+
+    def put(self, batch):
+        """Queue a batch, applying the backpressure policy when the queue is full"""
+        if self._backpressure == 'block':
+            self._queue.put(batch)
+        elif self._backpressure == 'raise':
+            try:
+                self._queue.put_nowait(batch)
+            except queue.Full:
+                raise QueueFullException("Sending queue is full") from None
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(batch)
+                    return
+                except queue.Full:
+                    pass
+                try:
+                    dropped = self._queue.get_nowait()
+                except queue.Empty:
+                    continue
+                self._queue.task_done()
+                logging.warning("Sending queue is full, oldest batch dropped")
+                if self._on_drop is not None:
+                    self._on_drop(dropped)
+
+    def check(self):
+        """Raise (once) the first error encountered by the sender threads"""
+        err, self._error = self._error, None
+        if err is not None:
+            raise err
+
+    def join(self):
+        """Wait for all queued batches to be processed"""
+        self._queue.join()
+
+    def close(self, wait=True):
+        """Process queued batches then stop the sender threads.
+        Without `wait`, queued batches are dropped and the threads are not waited for"""
+        if not wait:
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._queue.task_done()
+            for _ in self._threads:
+                try:
+                    self._queue.put_nowait(None)
+                except queue.Full:
+                    break
+            self._threads = []
+            return
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
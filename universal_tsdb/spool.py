@@ -0,0 +1,118 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Durable on-disk spool"""
+
+import logging
+import mmap
+import os
+import threading
+import time
+
+
+class Spool:
+    """Durable on-disk spool of payloads
+
+    Each payload is written to its own segment file, named after a sequence
+    number, the number of series it holds and its content encoding:
+    00000000000000000042-5000.gzip.seg
+    Segments are replayed in sequence order, and removed once sent.
+
+    fsync: flush segments to disk before considering them written
+    max_bytes: maximum size of the spool, oldest segments are dropped beyond
+    max_age: maximum age of a segment (in s), older segments are dropped
+    use_mmap: replay segments from memory-mapped files instead of reading them
+    write_ahead: spool every batch before sending it (not only failed ones)
+    drain_interval: if set, replay the spool every `drain_interval` s in a background thread"""
+
+    SUFFIX = '.seg'
+
+    def __init__(self, directory, fsync=True, max_bytes=None, max_age=None, use_mmap=False,
+                 write_ahead=False, drain_interval=None):
+        self.directory = directory
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.use_mmap = use_mmap
+        self.write_ahead = write_ahead
+        self.drain_interval = drain_interval
+        self.dropped = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        segments = self.segments()
+        self._seq = int(segments[-1].split('-', 1)[0]) if segments else 0
+
+    @staticmethod
+    def parse(name):
+        """Return (number of series, content encoding) of a segment name"""
+        length, encoding = name[:-len(Spool.SUFFIX)].split('-', 1)[1].split('.', 1)
+        return int(length), None if encoding == 'raw' else encoding
+
+    def segments(self):
+        """Return segment names, oldest first"""
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(self.SUFFIX))
+
+    def depth(self):
+        """Return the number of segments and the size of the spool, in bytes"""
+        segments = self.segments()
+        return {'segments': len(segments),
+                'bytes': sum(os.path.getsize(os.path.join(self.directory, name))
+                             for name in segments)}
+
+    def push(self, data, length, encoding=None):
+        """Write a payload of `length` series to a new segment, return its name"""
+        with self._lock:
+            self._seq += 1
+            name = "{:020d}-{}.{}{}".format(self._seq, length, encoding or 'raw', self.SUFFIX)
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'wb') as segment:
+            segment.write(data)
+            segment.flush()
+            if self.fsync:
+                os.fsync(segment.fileno())
+        os.replace(path + '.tmp', path)
+        logging.info("%d series spooled to %s", length, name)
+        self.expire()
+        return name
+
+    def read(self, name):
+        """Return the content of a segment (bytes, or a read-only mmap object)"""
+        with open(os.path.join(self.directory, name), 'rb') as segment:
+            if self.use_mmap and os.fstat(segment.fileno()).st_size > 0:
+                return mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+            return segment.read()
+
+    def remove(self, name):
+        """Remove a segment"""
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def expire(self):
+        """Drop segments older than max_age, then the oldest ones beyond max_bytes"""
+        if self.max_age is None and self.max_bytes is None:
+            return
+        segments = []
+        for name in self.segments():
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            if self.max_age is not None and time.time() - stat.st_mtime > self.max_age:
+                self._drop(name, "too old")
+            else:
+                segments.append((name, stat.st_size))
+        if self.max_bytes is not None:
+            total = sum(size for _, size in segments)
+            for name, size in segments[:-1]:
+                if total <= self.max_bytes:
+                    break
+                self._drop(name, "spool full")
+                total -= size
+
+    def _drop(self, name, reason):
+        length, _ = self.parse(name)
+        logging.error("Spooled segment %s dropped (%s): %d series lost", name, reason, length)
+        self.remove(name)
+        with self._lock:
+            self.dropped += length
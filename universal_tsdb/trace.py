@@ -0,0 +1,100 @@
+# vim: ai:ts=4:sw=4:sts=4:expandtab:textwidth=100:colorcolumn=+0
+
+"""Payload tracing
+
+Payloads and HTTP exchanges are logged at DEBUG level on the 'universal_tsdb.trace'
+logger: set its level, handlers or `propagate` flag to route them to a separate sink.
+Dumps are rendered only when a handler emits the record, and can be truncated
+to their first lines."""
+
+import logging
+import zlib
+from .buffer import COMPRESSIONS, PayloadBuffer
+
+LOGGER = logging.getLogger('universal_tsdb.trace')
+# decompressed bytes read at once, when looking for the first lines of a compressed payload
+_CHUNK_SIZE = 64 * 1024
+
+
+def head(data, max_lines=None, compression=None):
+    """Return the first `max_lines` lines of a payload (bytes, compressed or not),
+    and whether it was truncated. Only the returned lines are copied (or decompressed)."""
+    if compression is not None:
+        return _compressed_head(data, max_lines, compression)
+    if max_lines is None:
+        return data, False
+    end = 0
+    for _ in range(max_lines):
+        end = data.find(b'\n', end) + 1
+        if end == 0:
+            return data, False
+    return data[:end], end < len(data)
+
+
+def _compressed_head(data, max_lines, compression):
+    decompressor = zlib.decompressobj(COMPRESSIONS[compression])
+    if max_lines is None:
+        return decompressor.decompress(data) + decompressor.flush(), False
+    chunks = []
+    lines = 0
+    pending = data
+    while pending:
+        chunk = decompressor.decompress(pending, _CHUNK_SIZE)
+        pending = decompressor.unconsumed_tail
+        lines += chunk.count(b'\n')
+        chunks.append(chunk)
+        if lines >= max_lines:
+            text, _ = head(b''.join(chunks), max_lines)
+            return text, bool(pending) or len(text) < sum(map(len, chunks))
+    return b''.join(chunks), False
+
+
+class Payload: # pylint: disable=too-few-public-methods
+    """Lazy payload dump: decoded (and truncated to `max_lines` lines) by str(),
+    i.e. only when a log record is emitted"""
+
+    __slots__ = ('data', 'max_lines', 'compression')
+
+    def __init__(self, data, max_lines=None, compression=None):
+        self.data = data
+        self.max_lines = max_lines
+        self.compression = compression
+
+    def __str__(self):
+        if isinstance(self.data, str):
+            self.data = self.data.encode(PayloadBuffer.ENCODING)
+        text, truncated = head(self.data or b'', self.max_lines, self.compression)
+        text = text.decode(PayloadBuffer.ENCODING, 'replace').rstrip()
+        if truncated:
+            text += "\n[... truncated to {} lines]".format(self.max_lines)
+        return text
+
+
+class Exchange: # pylint: disable=too-few-public-methods
+    """Lazy dump of a HTTP request (requests.PreparedRequest)
+    and of its response (if any), bodies truncated to `max_lines` lines"""
+
+    __slots__ = ('request', 'response', 'max_lines')
+
+    def __init__(self, request, response=None, max_lines=None):
+        self.request = request
+        self.response = response
+        self.max_lines = max_lines
+
+    def __str__(self):
+        dumps = []
+        if self.response is not None:
+            dumps.append(self._dump('RESPONSE', '{} {}'.format(self.response.status_code,
+                                                             self.response.url),
+                                    self.response.headers, self.response.content, None))
+        if self.request is not None:
+            dumps.append(self._dump('REQUEST', '{} {}'.format(self.request.method,
+                                                            self.request.url),
+                                    self.request.headers, self.request.body,
+                                    self.request.headers.get('Content-Encoding')))
+        return '\n'.join(dumps)
+
+    def _dump(self, kind, first_line, headers, body, compression):
+        return '----------HTTP {}----------\n{}\r\n{}\r\n\r\n{}'.format(
+            kind, first_line, '\r\n'.join('{}: {}'.format(k, v) for k, v in headers.items()),
+            Payload(body, self.max_lines, compression if compression in COMPRESSIONS else None))